@@ -0,0 +1,213 @@
+"""POST /api/batch/ — несколько запросов к API за один HTTP-вызов.
+
+Тело запроса — список объектов {"method", "path", "body"}. Каждый
+подзапрос передаётся прямо в view через resolve(), минуя middleware;
+пользователь берётся из внешнего запроса, повторной аутентификации нет.
+Избранное, список покупок и подписки пользователя загружаются один раз
+на пакет (RelationCache) вместо Exists в запросе каждого подзапроса
+и перечитываются после каждого изменяющего подзапроса. MetricsMiddleware
+подзапросы тоже не проходят: в метриках пакет — один запрос к BatchView.
+
+Подряд идущие GET выполняются параллельно в пуле потоков, остальные
+запросы — строго по порядку. Пул создаётся один раз на процесс; после
+каждого подзапроса поток закрывает соединение с БД, как в конце обычного
+запроса (с учётом CONN_MAX_AGE). Ответ — список {"status", "body"}
+в порядке подзапросов.
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.urls import Resolver404, resolve
+from rest_framework import status
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+logger = logging.getLogger(__name__)
+
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+API_PREFIX = '/api/'
+
+_pool = {'pid': None, 'executor': None}
+
+RELATIONS = {
+    'favorites': lambda user: user.favorites.values_list(
+        'recipe_id', flat=True
+    ),
+    'shopping_cart': lambda user: user.shopping_cart_items.values_list(
+        'recipe_id', flat=True
+    ),
+    'subscriptions': lambda user: user.subscriptions.values_list(
+        'author_id', flat=True
+    ),
+}
+
+
+class RelationCache:
+    """id из RELATIONS текущего пользователя, общие для подзапросов пакета."""
+
+    def __init__(self, user):
+        self.user = user
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        # Параллельные подзапросы ждут одну загрузку, а не делают свою
+        with self._lock:
+            if name not in self._values:
+                self._values[name] = set(RELATIONS[name](self.user))
+            return self._values[name]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+def get_relations(request):
+    """RelationCache пакета или None вне пакета."""
+    return getattr(request, 'batch_relations', None)
+
+
+def get_executor():
+    # Потоки не переживают fork, у воркера gunicorn должен быть свой пул
+    if _pool['pid'] != os.getpid():
+        _pool['executor'] = ThreadPoolExecutor(
+            max_workers=settings.BATCH_MAX_WORKERS,
+            thread_name_prefix='batch'
+        )
+        _pool['pid'] = os.getpid()
+    return _pool['executor']
+
+
+def error(status_code, message):
+    return {'status': status_code, 'body': {'errors': message}}
+
+
+def make_subrequest(request, method, path, body):
+    url = urlsplit(path)
+    payload = b'' if body is None else json.dumps(body).encode()
+    environ = {
+        key: value for key, value in request.META.items()
+        if not key.startswith(('wsgi.', 'HTTP_IF_'))
+    }
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(payload)),
+        'wsgi.input': BytesIO(payload),
+        'wsgi.url_scheme': request.scheme,
+    })
+    subrequest = WSGIRequest(environ)
+    subrequest.user = request.user
+    subrequest.batch_relations = get_relations(request)
+    if request.user.is_authenticated:
+        # DRF использует уже проверенного пользователя без запросов к БД
+        subrequest._force_auth_user = request.user
+        subrequest._force_auth_token = request.auth
+    return subrequest
+
+
+def read_body(response):
+    if hasattr(response, 'render'):
+        response.render()
+    if response.streaming:
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+    if not content:
+        return None
+    if response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(content)
+    return content.decode(response.charset)
+
+
+def dispatch(request, item):
+    if not isinstance(item, dict):
+        return error(400, 'Подзапрос должен быть объектом')
+    method = str(item.get('method', 'GET')).upper()
+    path = item.get('path')
+    if method not in BATCH_METHODS:
+        return error(405, f'Метод {method} не поддерживается')
+    if not isinstance(path, str) or not path.startswith(API_PREFIX):
+        return error(400, f'path должен начинаться с {API_PREFIX}')
+    try:
+        match = resolve(urlsplit(path).path)
+    except Resolver404:
+        return error(404, 'Страница не найдена')
+    if getattr(match.func, 'view_class', None) is BatchView:
+        return error(400, 'Вложенные пакеты запрещены')
+
+    subrequest = make_subrequest(request, method, path, item.get('body'))
+    try:
+        response = match.func(subrequest, *match.args, **match.kwargs)
+        return {'status': response.status_code, 'body': read_body(response)}
+    except Exception:
+        logger.exception('Ошибка подзапроса %s %s', method, path)
+        return error(500, 'Внутренняя ошибка сервера')
+
+
+def dispatch_in_thread(request, item):
+    # У каждого потока пула своё соединение с БД; сигнала request_finished
+    # для подзапроса нет, поэтому соединение закрывается здесь
+    close_old_connections()
+    try:
+        return dispatch(request, item)
+    finally:
+        close_old_connections()
+
+
+def is_parallel(item):
+    return isinstance(item, dict) and (
+        str(item.get('method', 'GET')).upper() == 'GET'
+    )
+
+
+class BatchView(APIView):
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        items = request.data
+        if not isinstance(items, list) or not items:
+            return Response(
+                {'errors': 'Передайте непустой список подзапросов'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > settings.BATCH_MAX_REQUESTS:
+            return Response(
+                {'errors': f'Не больше {settings.BATCH_MAX_REQUESTS} '
+                           'подзапросов за раз'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if request.user.is_authenticated:
+            request.batch_relations = RelationCache(request.user)
+        results = []
+        position = 0
+        while position < len(items):
+            end = position
+            while end < len(items) and is_parallel(items[end]):
+                end += 1
+            if end - position > 1 and settings.BATCH_MAX_WORKERS > 1:
+                # Чтения между двумя изменениями не зависят друг от друга
+                results.extend(get_executor().map(
+                    lambda item: dispatch_in_thread(request, item),
+                    items[position:end]
+                ))
+                position = end
+            else:
+                results.append(dispatch(request, items[position]))
+                if not is_parallel(items[position]) and get_relations(request):
+                    # Подзапрос мог изменить избранное, покупки или подписки
+                    request.batch_relations.clear()
+                position += 1
+        return Response(results)
@@ -0,0 +1,355 @@
+"""Сброс кешей в памяти воркеров после изменения моделей.
+
+После коммита изменения Recipe, Ingredient, User, Token или Subscription
+публикуется сообщение (пространство имён, ключ, версия); для подписок
+ключ — id подписчика. Создание рецепта дополнительно публикуется
+в RECIPE_CREATED_NAMESPACE, чтобы поток событий отличал его от изменения.
+
+Основной транспорт — кольцевой буфер в файле CACHE_BUS_PATH,
+отображённом в память всеми воркерами машины: заголовок [последний
+номер][поколение] и слоты [номер][пространство имён][ключ]. Номер
+сообщения служит его версией. Если файл недоступен или
+CACHE_BUS_TRANSPORT = 'db', сообщения пишутся в таблицу
+CacheInvalidation и читаются не чаще CACHE_BUS_POLL_INTERVAL.
+
+Воркер дочитывает новые сообщения перед каждым обращением к LocalCache.
+Если он отстал больше чем на размер буфера или поколение изменилось
+(publish_all), все кеши очищаются целиком.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.db.models.signals import post_delete, post_save
+
+from .metrics import record_cache_access
+from .models import CacheInvalidation
+
+HEADER = struct.Struct('QQ')
+SLOT = struct.Struct('Q24s48s')
+
+TRANSPORT_MMAP = 'mmap'
+TRANSPORT_DB = 'db'
+
+SUBSCRIPTIONS_NAMESPACE = 'recipes.subscription'
+RECIPE_CREATED_NAMESPACE = 'recipes.recipe.created'
+
+
+class RingTransport:
+    def __init__(self, path, capacity):
+        self.capacity = capacity
+        self._file = open(path, 'a+b')
+        size = HEADER.size + SLOT.size * capacity
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def state(self):
+        return HEADER.unpack_from(self._map, 0)
+
+    def publish(self, namespace, key):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            sequence, generation = self.state()
+            sequence += 1
+            if namespace is None:
+                generation += 1
+            else:
+                SLOT.pack_into(
+                    self._map, self._offset(sequence), sequence,
+                    namespace.encode(), key.encode()
+                )
+            # Заголовок пишется последним: читатель не увидит
+            # номер раньше содержимого слота
+            HEADER.pack_into(self._map, 0, sequence, generation)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def read(self, after, until):
+        """Сообщения с номерами after+1..until или None при потере."""
+        if until - after > self.capacity:
+            return None
+        messages = []
+        for sequence in range(after + 1, until + 1):
+            stored, namespace, key = SLOT.unpack_from(
+                self._map, self._offset(sequence)
+            )
+            if stored > sequence:
+                # Писатель успел обогнать читателя на целый круг
+                return None
+            if stored < sequence:
+                # Смена поколения не занимает слот
+                continue
+            messages.append((
+                namespace.rstrip(b'\0').decode(),
+                key.rstrip(b'\0').decode(),
+                sequence
+            ))
+        return messages
+
+    def _offset(self, sequence):
+        return HEADER.size + SLOT.size * (sequence % self.capacity)
+
+
+class DatabaseTransport:
+    def __init__(self, capacity):
+        self.model = CacheInvalidation
+        self.capacity = capacity
+
+    def state(self):
+        # Поколение — id последнего сообщения publish_all
+        last = self.model.objects.aggregate(
+            sequence=Max('id'),
+            generation=Max('id', filter=Q(namespace=''))
+        )
+        return last['sequence'] or 0, last['generation'] or 0
+
+    def publish(self, namespace, key):
+        message = self.model.objects.create(
+            namespace=namespace or '', key=key or ''
+        )
+        # Хранятся только последние capacity сообщений
+        self.model.objects.filter(id__lte=message.id - self.capacity).delete()
+
+    def read(self, after, until):
+        if until - after > self.capacity:
+            return None
+        return [
+            (namespace, key, sequence)
+            for sequence, namespace, key in self.model.objects.filter(
+                id__gt=after, id__lte=until
+            ).exclude(namespace='').order_by('id').values_list(
+                'id', 'namespace', 'key'
+            )
+        ]
+
+
+class CacheBus:
+    def __init__(self):
+        self.caches = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._transport = None
+        self._sequence = 0
+        self._generation = 0
+        self._polled_at = 0
+
+    def register(self, namespace, cache):
+        self.caches.setdefault(namespace, []).append(cache)
+
+    def transport(self):
+        # После fork у воркера должен быть свой mmap
+        if self._pid != os.getpid():
+            self._transport = None
+            if settings.CACHE_BUS_TRANSPORT == TRANSPORT_MMAP:
+                try:
+                    self._transport = RingTransport(
+                        settings.CACHE_BUS_PATH, settings.CACHE_BUS_SIZE
+                    )
+                except OSError:
+                    pass
+            if self._transport is None:
+                self._transport = DatabaseTransport(settings.CACHE_BUS_SIZE)
+            self._sequence, self._generation = self._transport.state()
+            self._pid = os.getpid()
+        return self._transport
+
+    def publish(self, namespace, key=None):
+        """Без key сбрасываются все записи пространства имён."""
+        # flock не разделяет потоки одного процесса
+        with self._lock:
+            self.transport().publish(
+                namespace, '' if key is None else str(key)
+            )
+
+    def publish_all(self):
+        """Сбрасывает все кеши, например после массового импорта."""
+        with self._lock:
+            self.transport().publish(None, None)
+
+    def poll(self):
+        """Применяет новые сообщения и возвращает номер последнего."""
+        with self._lock:
+            transport = self.transport()
+            if isinstance(transport, DatabaseTransport):
+                now = time.monotonic()
+                if now - self._polled_at < settings.CACHE_BUS_POLL_INTERVAL:
+                    return self._sequence
+                self._polled_at = now
+            sequence, generation = transport.state()
+            if sequence == self._sequence:
+                return sequence
+            messages = transport.read(self._sequence, sequence)
+            if messages is None or generation != self._generation:
+                for caches in self.caches.values():
+                    for cache in caches:
+                        cache.clear(sequence)
+            else:
+                for namespace, key, version in messages:
+                    for cache in self.caches.get(namespace, ()):
+                        cache.invalidate(key, version)
+            self._sequence, self._generation = sequence, generation
+            return sequence
+
+    def last_version(self, namespace):
+        """Номер последнего сообщения namespace, хранящегося в буфере.
+
+        Если сообщение уже вытеснено, возвращается номер, начиная с
+        которого буфер полон: настоящая версия не больше него.
+        """
+        with self._lock:
+            transport = self.transport()
+            sequence, _ = transport.state()
+            after = max(0, sequence - transport.capacity)
+            messages = transport.read(after, sequence)
+        if messages is None:
+            # Буфер перезаписан во время чтения
+            return sequence
+        for name, _, version in reversed(messages):
+            if name == namespace:
+                return version
+        return after
+
+
+bus = CacheBus()
+
+
+class LocalCache:
+    """LRU-кеш воркера, который сбрасывается сообщениями шины.
+
+    При per_object=True сообщение удаляет запись с ключом объекта,
+    иначе любое изменение в пространстве имён очищает кеш целиком.
+    """
+
+    def __init__(self, name, namespace, maxsize=1024, per_object=True):
+        self.name = name
+        self.maxsize = maxsize
+        self.per_object = per_object
+        self._entries = OrderedDict()
+        self._invalidated = OrderedDict()
+        self._cleared_at = 0
+        self._lock = threading.Lock()
+        bus.register(namespace, self)
+
+    def get_or_set(self, key, load):
+        key = str(key)
+        version = bus.poll()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        record_cache_access(self.name, entry is not None)
+        if entry is not None:
+            return entry[0]
+
+        value = load()
+        with self._lock:
+            # Сообщение могло прийти, пока значение загружалось
+            if version >= max(
+                self._cleared_at, self._invalidated.get(key, 0)
+            ):
+                self._entries[key] = (value, version)
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key, version):
+        if not self.per_object or not key:
+            self.clear(version)
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < version:
+                del self._entries[key]
+            self._invalidated[key] = version
+            self._invalidated.move_to_end(key)
+            if len(self._invalidated) > self.maxsize:
+                self._invalidated.popitem(last=False)
+
+    def clear(self, version):
+        with self._lock:
+            self._entries.clear()
+            self._invalidated.clear()
+            self._cleared_at = version
+
+
+class NamespaceVersion:
+    """Версия пространства имён — номер его последнего сообщения.
+
+    Меняется при любом изменении объектов пространства имён, поэтому
+    входит в ETag ответов вместо агрегирующих запросов к БД. Воркер,
+    запущенный позже других, берёт версию из буфера шины; она может
+    оказаться больше настоящей, но не меньше, так что устаревший ETag
+    с ней не совпадёт.
+    """
+
+    def __init__(self, namespace):
+        self._version = None
+        self._lock = threading.Lock()
+        bus.register(namespace, self)
+        self.namespace = namespace
+
+    def get(self):
+        bus.poll()
+        if self._version is None:
+            version = bus.last_version(self.namespace)
+            with self._lock:
+                if self._version is None:
+                    self._version = version
+        # Смена поколения (publish_all) тоже меняет версию
+        return f'{bus._generation}.{self._version}'
+
+    def invalidate(self, key, version):
+        with self._lock:
+            self._version = version
+
+    def clear(self, version):
+        self.invalidate(None, version)
+
+
+def publish_on_commit(model, key=None):
+    """Публикует изменение после коммита; без key — весь namespace.
+
+    Нужна там, где строки меняются через update() без сигналов.
+    """
+    namespace = model._meta.label_lower
+    transaction.on_commit(lambda: bus.publish(namespace, key))
+
+
+def publish_change(sender, instance, **kwargs):
+    publish_on_commit(sender, instance.pk)
+
+
+def publish_recipe_created(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(
+            lambda: bus.publish(RECIPE_CREATED_NAMESPACE, instance.pk)
+        )
+
+
+def publish_subscription_change(sender, instance, **kwargs):
+    # Ключ — подписчик: поток событий перечитывает его подписки
+    transaction.on_commit(
+        lambda: bus.publish(SUBSCRIPTIONS_NAMESPACE, instance.user_id)
+    )
+
+
+def connect_signals():
+    from django.contrib.auth import get_user_model
+    from rest_framework.authtoken.models import Token
+
+    from recipes.models import Ingredient, Recipe, Subscription
+
+    for model in (Recipe, Ingredient, get_user_model(), Token):
+        post_save.connect(publish_change, sender=model)
+        post_delete.connect(publish_change, sender=model)
+    post_save.connect(publish_recipe_created, sender=Recipe)
+    post_save.connect(publish_subscription_change, sender=Subscription)
+    post_delete.connect(publish_subscription_change, sender=Subscription)
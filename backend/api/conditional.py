@@ -0,0 +1,101 @@
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import (
+    get_conditional_response, patch_cache_control, patch_vary_headers
+)
+from django.utils.http import http_date
+
+
+class ConditionalGetMixin:
+    """Отвечает 304 на If-None-Match / If-Modified-Since до сериализации.
+
+    Валидатор строится одним агрегирующим запросом по отфильтрованному
+    queryset (максимумы conditional_fields и количество строк) и по
+    updated_at текущего пользователя, который меняется вместе с его
+    избранным, списком покупок и подписками. Поверх него добавляются
+    версии пространств имён шины api.cachebus: conditional_versions —
+    для данных без своей отметки времени, list_versions — для списков.
+    """
+
+    conditional_fields = ('updated_at',)
+    conditional_versions = ()
+    list_versions = ()
+
+    def list(self, request, *args, **kwargs):
+        # Удаление строки не сдвигает максимум updated_at, поэтому для
+        # списков используется только ETag, учитывающий количество строк
+        return self.conditional_response(
+            self.filter_queryset(self.get_queryset()),
+            lambda: super(ConditionalGetMixin, self).list(
+                request, *args, **kwargs
+            ),
+            use_last_modified=False,
+            versions=self.list_versions
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg not in self.kwargs:
+            return super().retrieve(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        )
+        return self.conditional_response(
+            queryset,
+            lambda: super(ConditionalGetMixin, self).retrieve(
+                request, *args, **kwargs
+            )
+        )
+
+    def conditional_response(self, queryset, get_response,
+                             use_last_modified=True, fields=None,
+                             versions=()):
+        etag, last_modified = self.get_validators(
+            queryset, fields or self.conditional_fields,
+            (*self.conditional_versions, *versions)
+        )
+        if etag is None:
+            return get_response()
+        if not use_last_modified:
+            last_modified = None
+        response = get_conditional_response(
+            self.request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = get_response()
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, no_cache=True)
+            patch_vary_headers(response, ['Authorization'])
+        return response
+
+    def get_validators(self, queryset, fields, versions):
+        values = queryset.order_by().aggregate(
+            count=Count('pk', distinct=True),
+            **{
+                f'max_{index}': Max(field)
+                for index, field in enumerate(fields)
+            }
+        )
+        count = values.pop('count')
+        if not count:
+            return None, None
+
+        timestamps = [
+            value for value in values.values() if value is not None
+        ]
+        user = self.request.user
+        if user.is_authenticated:
+            timestamps.append(user.updated_at)
+        state = '|'.join([
+            self.request.get_full_path(),
+            str(user.pk),
+            *(str(timestamp.timestamp()) for timestamp in timestamps),
+            str(count),
+            *(version.get() for version in versions),
+        ])
+        etag = '"{}"'.format(hashlib.md5(state.encode()).hexdigest())
+        return etag, int(max(timestamps).timestamp())
@@ -0,0 +1,329 @@
+"""Поток событий /api/events/ (Server-Sent Events) для ASGI-приложения.
+
+Клиент получает событие, когда автор, на которого он подписан, публикует
+или изменяет рецепт. Изменения рецептов и подписок приходят через шину
+api.cachebus из любого процесса: фоновая задача опрашивает её, одним
+запросом загружает изменённые рецепты и раздаёт события подключениям
+процесса через Hub. У каждого подключения своя ограниченная очередь;
+если клиент не успевает читать и очередь переполнилась, он отключается
+и переподключится сам (EventSource делает это автоматически).
+
+Браузер подключается с билетом ?ticket= (см. api/tickets.py), другие
+клиенты передают заголовок Authorization: Token.
+"""
+import asyncio
+import json
+import logging
+import threading
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.authtoken.models import Token
+
+from recipes.models import Recipe, Subscription, User
+
+from .cachebus import (
+    RECIPE_CREATED_NAMESPACE, SUBSCRIPTIONS_NAMESPACE, bus
+)
+from .tickets import read_ticket
+
+logger = logging.getLogger(__name__)
+
+RECIPES_NAMESPACE = 'recipes.recipe'
+EVENTS_PATH = '/api/events/'
+
+# Служебные сообщения в очереди подключения
+DROP = object()
+REFRESH = object()
+
+
+def discard(index, key, listener):
+    listeners = index.get(key)
+    if listeners is not None:
+        listeners.discard(listener)
+        if not listeners:
+            del index[key]
+
+
+class Listener:
+    def __init__(self, user_id, authors):
+        self.user_id = user_id
+        self.authors = authors
+        self.queue = asyncio.Queue(maxsize=settings.EVENTS_QUEUE_SIZE)
+        self.dropped = False
+
+    def put(self, message):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped = True
+            # Место для DROP освобождается за счёт непрочитанных событий
+            self.queue.get_nowait()
+            self.queue.put_nowait(DROP)
+
+
+class Hub:
+    """Подключения процесса и раздача им событий из шины."""
+
+    def __init__(self):
+        self.listeners = set()
+        self.by_author = {}
+        self.by_user = {}
+        self._changed = set()
+        self._resync = False
+        self._lock = threading.Lock()
+        self._feeder = None
+
+    # Вызываются из bus.poll() в любом потоке процесса
+    def changed(self, namespace, key):
+        with self._lock:
+            self._changed.add((namespace, key))
+
+    def resync(self):
+        with self._lock:
+            self._resync = True
+
+    def take(self):
+        with self._lock:
+            changed, resync = self._changed, self._resync
+            self._changed, self._resync = set(), False
+        return changed, resync
+
+    def subscribe(self, listener):
+        self.listeners.add(listener)
+        self.by_user.setdefault(listener.user_id, set()).add(listener)
+        for author_id in listener.authors:
+            self.by_author.setdefault(author_id, set()).add(listener)
+        if self._feeder is None or self._feeder.done():
+            self._feeder = asyncio.create_task(self.feed())
+
+    def unsubscribe(self, listener):
+        self.listeners.discard(listener)
+        discard(self.by_user, listener.user_id, listener)
+        for author_id in listener.authors:
+            discard(self.by_author, author_id, listener)
+
+    def follow(self, listener, authors):
+        for author_id in listener.authors - authors:
+            discard(self.by_author, author_id, listener)
+        for author_id in authors - listener.authors:
+            self.by_author.setdefault(author_id, set()).add(listener)
+        listener.authors = authors
+
+    def publish(self, author_id, event):
+        for listener in list(self.by_author.get(author_id, ())):
+            listener.put(event)
+
+    async def feed(self):
+        """Опрашивает шину, пока у процесса есть подключения."""
+        while self.listeners:
+            try:
+                await self.deliver()
+            except Exception:
+                logger.exception('Ошибка рассылки событий')
+            await asyncio.sleep(settings.EVENTS_POLL_INTERVAL)
+
+    async def deliver(self):
+        await database_sync_to_async(bus.poll, thread_sensitive=False)()
+        changed, resync = self.take()
+        if resync:
+            # Сообщения потеряны: клиенты перечитают ленту сами
+            for listener in list(self.listeners):
+                listener.put({'event': 'resync', 'data': {}})
+                listener.put(REFRESH)
+        recipe_ids = {
+            int(key) for namespace, key in changed
+            if namespace in (RECIPES_NAMESPACE, RECIPE_CREATED_NAMESPACE)
+        }
+        created_ids = {
+            int(key) for namespace, key in changed
+            if namespace == RECIPE_CREATED_NAMESPACE
+        }
+        if recipe_ids:
+            for recipe in await load_recipes(recipe_ids):
+                self.publish(
+                    recipe['author_id'],
+                    recipe_event(recipe, recipe['id'] in created_ids)
+                )
+        for namespace, key in changed:
+            if namespace == SUBSCRIPTIONS_NAMESPACE:
+                for listener in list(self.by_user.get(int(key), ())):
+                    listener.put(REFRESH)
+
+
+class HubCache:
+    """Подключает Hub к шине как кеш пространства имён."""
+
+    def __init__(self, hub, namespace):
+        self.hub = hub
+        self.namespace = namespace
+
+    def invalidate(self, key, version):
+        if key:
+            self.hub.changed(self.namespace, key)
+
+    def clear(self, version):
+        self.hub.resync()
+
+
+hub = Hub()
+for namespace in (
+    RECIPES_NAMESPACE, RECIPE_CREATED_NAMESPACE, SUBSCRIPTIONS_NAMESPACE
+):
+    bus.register(namespace, HubCache(hub, namespace))
+
+
+def database_sync_to_async(func, thread_sensitive=True):
+    """sync_to_async, закрывающий устаревшие соединения с БД.
+
+    Вне цикла запроса Django сам не закрывает соединения потоков,
+    поэтому это делается до и после вызова, как в начале и конце запроса.
+    """
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(wrapper, thread_sensitive=thread_sensitive)
+
+
+@database_sync_to_async
+def load_recipes(recipe_ids):
+    return list(Recipe.objects.filter(id__in=recipe_ids).values(
+        'id', 'name', 'author_id'
+    ))
+
+
+def recipe_event(recipe, created):
+    return {
+        'event': 'recipe_published' if created else 'recipe_updated',
+        'data': {
+            'id': recipe['id'],
+            'name': recipe['name'],
+            'author': recipe['author_id'],
+        },
+    }
+
+
+@database_sync_to_async
+def authenticate(scope):
+    key = get_token(scope)
+    if key:
+        token = Token.objects.select_related('user').filter(key=key).first()
+        user = token and token.user
+    else:
+        query = parse_qs(scope.get('query_string', b'').decode())
+        user_id = read_ticket(query.get('ticket', [''])[0])
+        if user_id is None:
+            return None
+        user = User.objects.filter(pk=user_id).first()
+    if user is None or not user.is_active:
+        return None
+    return user
+
+
+@database_sync_to_async
+def followed_authors(user_id):
+    return set(Subscription.objects.filter(user_id=user_id).values_list(
+        'author_id', flat=True
+    ))
+
+
+def get_token(scope):
+    for name, value in scope['headers']:
+        if name == b'authorization':
+            keyword, _, key = value.decode('latin-1').partition(' ')
+            if keyword == 'Token':
+                return key.strip()
+    return ''
+
+
+def encode(message):
+    return (
+        f'event: {message["event"]}\n'
+        f'data: {json.dumps(message["data"], ensure_ascii=False)}\n\n'
+    ).encode()
+
+
+async def respond(send, status, message):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json; charset=utf-8')],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': json.dumps({'detail': message}, ensure_ascii=False).encode(),
+    })
+
+
+async def events_app(scope, receive, send):
+    user = await authenticate(scope)
+    if user is None:
+        return await respond(send, 401, 'Нужен токен или билет авторизации')
+    if len(hub.listeners) >= settings.EVENTS_MAX_CONNECTIONS:
+        return await respond(send, 503, 'Слишком много подключений')
+
+    listener = Listener(user.id, await followed_authors(user.id))
+    hub.subscribe(listener)
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                # nginx не должен буферизовать поток
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': f'retry: {settings.EVENTS_RETRY_MS}\n\n'.encode(),
+            'more_body': True,
+        })
+        while not disconnected.done():
+            getter = asyncio.ensure_future(listener.queue.get())
+            done, _ = await asyncio.wait(
+                (getter, disconnected),
+                timeout=settings.EVENTS_HEARTBEAT_INTERVAL,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter not in done:
+                getter.cancel()
+                if not done:
+                    # Комментарий-пинг держит соединение через прокси
+                    await send({
+                        'type': 'http.response.body',
+                        'body': b': ping\n\n',
+                        'more_body': True,
+                    })
+                continue
+            message = getter.result()
+            if message is DROP:
+                break
+            if message is REFRESH:
+                hub.follow(listener, await followed_authors(user.id))
+                continue
+            await send({
+                'type': 'http.response.body',
+                'body': encode(message),
+                'more_body': True,
+            })
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        hub.unsubscribe(listener)
+        disconnected.cancel()
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -0,0 +1,38 @@
+from rest_framework.permissions import SAFE_METHODS
+
+
+def parse_field_list(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def get_selected_fields(request, field_names):
+    """Поля ответа с учётом параметров ?fields= и ?omit=.
+
+    Параметры действуют только на чтение, чтобы не отключать поля
+    при валидации входных данных.
+    """
+    field_names = list(field_names)
+    if request is None or request.method not in SAFE_METHODS:
+        return field_names
+    only = parse_field_list(request.query_params.get('fields', ''))
+    omit = parse_field_list(request.query_params.get('omit', ''))
+    return [
+        name for name in field_names
+        if (not only or name in only) and name not in omit
+    ]
+
+
+class SparseFieldsetsMixin:
+    """Убирает из сериализатора поля, не запрошенные клиентом.
+
+    Применяется только к корневому сериализатору запроса: вложенные
+    сериализаторы, объявленные полями, создаются без контекста.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        selected = set(get_selected_fields(request, self.fields))
+        for name in list(self.fields):
+            if name not in selected:
+                self.fields.pop(name)
@@ -0,0 +1,97 @@
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+from django.utils.module_loading import import_string
+from rest_framework.authtoken.models import Token
+
+from api.middleware import TokenApiBypassMixin
+from recipes.models import User
+
+
+def get_full_middleware():
+    """Исходный стек: обёртки из api.middleware заменены родителями."""
+    middleware = []
+    for path in settings.MIDDLEWARE:
+        middleware_class = import_string(path)
+        if issubclass(middleware_class, TokenApiBypassMixin):
+            parent = middleware_class.base_class
+            path = f'{parent.__module__}.{parent.__qualname__}'
+        middleware.append(path)
+    return middleware
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает время запроса к API с токеном при полном стеке '
+        'middleware и при облегчённом'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default='/api/users/me/',
+            help='Адрес запроса'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=2000,
+            help='Количество запросов для каждого варианта'
+        )
+
+    def handle(self, *args, **options):
+        variants = {
+            'полный стек': get_full_middleware(),
+            'облегчённый стек': settings.MIDDLEWARE,
+        }
+        # Временный пользователь удаляется откатом транзакции; тысячи
+        # запросов одного пользователя не должны упираться в лимит частоты
+        with transaction.atomic(), override_settings(THROTTLE_ENABLED=False):
+            user = User.objects.create_user(
+                username='benchmark-middleware',
+                email='benchmark-middleware@example.com',
+                first_name='Benchmark',
+                last_name='Middleware',
+                password=None
+            )
+            token = Token.objects.create(user=user)
+            headers = {
+                'HTTP_AUTHORIZATION': f'Token {token.key}',
+                'HTTP_HOST': 'localhost',
+            }
+            results = {
+                name: self.measure(middleware, options, headers)
+                for name, middleware in variants.items()
+            }
+            transaction.set_rollback(True)
+
+        for name, timings in results.items():
+            self.stdout.write(
+                f'{name}: среднее {statistics.mean(timings):.1f} мкс, '
+                f'медиана {statistics.median(timings):.1f} мкс'
+            )
+        full, light = (
+            statistics.median(timings) for timings in results.values()
+        )
+        self.stdout.write(f'Экономия на запрос: {full - light:.1f} мкс')
+
+    def measure(self, middleware, options, headers):
+        # Цепочка middleware собирается при первом запросе клиента
+        with override_settings(MIDDLEWARE=middleware):
+            client = Client()
+            response = client.get(options['path'], **headers)
+        if response.status_code >= 400:
+            self.stderr.write(
+                f'{options["path"]}: ответ {response.status_code}'
+            )
+
+        timings = []
+        for _ in range(options['requests']):
+            start = time.perf_counter()
+            client.get(options['path'], **headers)
+            timings.append((time.perf_counter() - start) * 1e6)
+        return timings
@@ -0,0 +1,53 @@
+import io
+import pstats
+
+from django.core.management.base import BaseCommand
+
+from api.profiling import get_profile_files, make_profile_token
+
+
+class Command(BaseCommand):
+    help = 'Выводит самые затратные функции по собранным профилям'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--view',
+            help='Имя вида, например RecipeViewSet.list'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=30,
+            help='Количество строк в отчёте'
+        )
+        parser.add_argument(
+            '--sort',
+            default='cumulative',
+            help='Ключ сортировки pstats'
+        )
+        parser.add_argument(
+            '--token',
+            action='store_true',
+            help='Вывести значение заголовка X-Profile и выйти'
+        )
+
+    def handle(self, *args, **options):
+        if options['token']:
+            self.stdout.write(make_profile_token())
+            return
+
+        files = get_profile_files(options['view'])
+        if not files:
+            self.stdout.write('Профили не найдены')
+            return
+
+        views = sorted({path.stem.rsplit('.', 3)[0] for path in files})
+        self.stdout.write(f'Виды: {", ".join(views)}')
+        self.stdout.write(f'Файлов профилей: {len(files)}\n')
+
+        report = io.StringIO()
+        stats = pstats.Stats(*map(str, files), stream=report)
+        stats.strip_dirs().sort_stats(options['sort']).print_stats(
+            options['limit']
+        )
+        self.stdout.write(report.getvalue())
@@ -0,0 +1,456 @@
+"""Метрики процесса в формате Prometheus.
+
+Каждый поток воркера gunicorn пишет значения в собственный файл
+METRICS_DIR, отображённый в память (mmap), поэтому запись не требует
+блокировок. Эндпоинт /api/metrics/ читает и суммирует файлы всех потоков
+и воркеров; счётчики завершившихся воркеров переносятся в archive.db,
+а их файлы удаляются. Каталог следует очищать при перезапуске сервера.
+"""
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from .profiling import get_view_name
+
+INITIAL_FILE_SIZE = 1 << 16
+HEADER_SIZE = 8
+ARCHIVE_NAME = 'archive.db'
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class MmapStore:
+    """Файл вида [used][len key pad value]... с 8-байтовыми значениями."""
+
+    def __init__(self, path):
+        self._file = open(path, 'a+b')
+        # (метрика, значения меток) -> позиции значений серии
+        self.series = {}
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(INITIAL_FILE_SIZE)
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._positions = {}
+        self._used = struct.unpack_from('i', self._map, 0)[0]
+        if self._used == 0:
+            self._used = HEADER_SIZE
+            struct.pack_into('i', self._map, 0, self._used)
+        for key, _, position in read_entries(self._map, self._used):
+            self._positions[key] = position
+
+    def position(self, key):
+        position = self._positions.get(key)
+        if position is None:
+            position = self._allocate(key)
+        return position
+
+    def _allocate(self, key):
+        encoded = key.encode('utf-8')
+        padded = encoded + b' ' * (8 - (len(encoded) + 4) % 8)
+        entry = struct.pack(f'i{len(padded)}sd', len(encoded), padded, 0.0)
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._file.truncate(self._capacity)
+            old_map = self._map
+            self._map = mmap.mmap(self._file.fileno(), self._capacity)
+            old_map.close()
+        self._map[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        struct.pack_into('i', self._map, 0, self._used)
+        position = self._used - 8
+        self._positions[key] = position
+        return position
+
+    def add(self, position, amount):
+        value = struct.unpack_from('d', self._map, position)[0]
+        struct.pack_into('d', self._map, position, value + amount)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def read_entries(data, used):
+    position = HEADER_SIZE
+    while position < used:
+        key_length = struct.unpack_from('i', data, position)[0]
+        key_end = position + 4 + key_length
+        key = data[position + 4:key_end].decode('utf-8')
+        position = key_end + (8 - (key_length + 4) % 8)
+        value = struct.unpack_from('d', data, position)[0]
+        yield key, value, position
+        position += 8
+
+
+def read_file(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    if len(data) < HEADER_SIZE:
+        return []
+    used = struct.unpack_from('i', data, 0)[0]
+    return list(read_entries(data, used))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class StoreLease:
+    """Закрепляет файл за потоком и возвращает его, когда поток завершится.
+
+    Объект живёт в threading.local, поэтому удаляется при завершении
+    потока; файл переходит к следующему новому потоку процесса.
+    """
+
+    def __init__(self, registry, store):
+        self.registry = registry
+        self.store = store
+        self.pid = os.getpid()
+
+    def __del__(self):
+        # После fork в дочернем процессе удаляются аренды родителя
+        if self.pid == os.getpid():
+            self.registry.free.append(self.store)
+
+
+def file_pid(path):
+    pid = path.stem.split('_', 1)[0]
+    return int(pid) if pid.isdigit() else None
+
+
+class Registry:
+    """Метрики процесса и файлы его потоков.
+
+    У каждого потока свой файл {pid}_{номер}.db, в который пишет только
+    он, поэтому запись идёт без блокировок, а значения потоков
+    суммируются при чтении. Блокировка нужна лишь при создании файла.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.free = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._files = 0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def store(self):
+        """Файл текущего потока."""
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None and lease.pid == os.getpid():
+            return lease.store
+        with self._lock:
+            # После fork у воркера другой pid и, значит, свои файлы
+            if self._pid != os.getpid():
+                self.free = []
+                self._files = 0
+                self._local = threading.local()
+                self._pid = os.getpid()
+            try:
+                # list.pop и append атомарны, поэтому StoreLease
+                # возвращает файл без блокировки
+                store = self.free.pop()
+            except IndexError:
+                directory = Path(settings.METRICS_DIR)
+                directory.mkdir(parents=True, exist_ok=True)
+                self._files += 1
+                store = MmapStore(
+                    directory / f'{self._pid}_{self._files}.db'
+                )
+            self._local.lease = StoreLease(self, store)
+        return store
+
+    def archive_dead(self, directory):
+        """Переносит счётчики завершившихся воркеров в archive.db.
+
+        Значения gauge умирают вместе с воркером и не переносятся.
+        Сборщики в разных процессах не должны перенести файл дважды,
+        поэтому перенос выполняется под flock.
+        """
+        dead = [
+            path for path in directory.glob('*.db')
+            if file_pid(path) is not None and not pid_alive(file_pid(path))
+        ]
+        if not dead:
+            return
+        with open(directory / 'archive.lock', 'a+b') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = MmapStore(directory / ARCHIVE_NAME)
+            try:
+                for path in dead:
+                    try:
+                        entries = read_file(path)
+                    except FileNotFoundError:
+                        # Уже перенесён другим сборщиком
+                        continue
+                    for key, value, _ in entries:
+                        metric = self.metrics.get(json.loads(key)[0])
+                        if metric is not None and metric.kind != 'gauge':
+                            archive.add(archive.position(key), value)
+                    path.unlink()
+            finally:
+                archive.close()
+
+    def collect(self):
+        """Суммирует значения из файлов всех воркеров."""
+        directory = Path(settings.METRICS_DIR)
+        if directory.is_dir():
+            self.archive_dead(directory)
+        values = {}
+        for path in directory.glob('*.db'):
+            try:
+                entries = read_file(path)
+            except FileNotFoundError:
+                continue
+            for key, value, _ in entries:
+                if json.loads(key)[0] in self.metrics:
+                    values[key] = values.get(key, 0.0) + value
+        return values
+
+    def exposition(self):
+        by_metric = {}
+        for key, value in self.collect().items():
+            name, suffix, labels = json.loads(key)
+            by_metric.setdefault(name, []).append(
+                (suffix, tuple(map(tuple, labels)), value)
+            )
+        lines = []
+        for name in sorted(by_metric):
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.render(sorted(by_metric[name])))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name, str(value).replace('\\', r'\\').replace('"', r'\"')
+        )
+        for name, value in labels
+    )
+    return f'{{{pairs}}}'
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        registry.register(self)
+
+    def _key(self, suffix, labelvalues):
+        return json.dumps(
+            [self.name, suffix, list(zip(self.labelnames, labelvalues))],
+            ensure_ascii=False
+        )
+
+    def _position(self, labelvalues):
+        """Файл потока и позиция значения серии в нём."""
+        store = registry.store()
+        position = store.series.get((self.name, labelvalues))
+        if position is None:
+            position = store.position(self._key('', labelvalues))
+            store.series[self.name, labelvalues] = position
+        return store, position
+
+    def render(self, series):
+        return [
+            f'{self.name}{suffix}{format_labels(labels)} '
+            f'{format_value(value)}'
+            for suffix, labels, value in series
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        store, position = self._position(labelvalues)
+        store.add(position, amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labelvalues, amount=1):
+        store, position = self._position(labelvalues)
+        store.add(position, amount)
+
+    def dec(self, *labelvalues, amount=1):
+        store, position = self._position(labelvalues)
+        store.add(position, -amount)
+
+
+class Histogram(Metric):
+    """Хранит некумулятивные корзины, суммирование выполняется при чтении."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _position(self, labelvalues):
+        store = registry.store()
+        positions = store.series.get((self.name, labelvalues))
+        if positions is None:
+            positions = tuple(
+                store.position(self._key(f'_bucket:{bound}', labelvalues))
+                for bound in self.buckets + ('+Inf',)
+            ) + (
+                store.position(self._key('_sum', labelvalues)),
+                store.position(self._key('_count', labelvalues)),
+            )
+            store.series[self.name, labelvalues] = positions
+        return store, positions
+
+    def observe(self, value, *labelvalues):
+        store, positions = self._position(labelvalues)
+        store.add(positions[bisect.bisect_left(self.buckets, value)], 1)
+        store.add(positions[-2], value)
+        store.add(positions[-1], 1)
+
+    def render(self, series):
+        lines = []
+        buckets = {}
+        for suffix, labels, value in series:
+            if suffix.startswith('_bucket:'):
+                bound = suffix.split(':', 1)[1]
+                buckets.setdefault(labels, {})[bound] = value
+            else:
+                lines.append(
+                    f'{self.name}{suffix}{format_labels(labels)} '
+                    f'{format_value(value)}'
+                )
+        for labels, values in sorted(buckets.items()):
+            total = 0
+            for bound in self.buckets + ('+Inf',):
+                total += values.get(str(bound), 0)
+                lines.append(
+                    f'{self.name}_bucket'
+                    f'{format_labels(labels + (("le", str(bound)),))} '
+                    f'{format_value(total)}'
+                )
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'foodgram_http_request_duration_seconds',
+    'Длительность обработки запроса',
+    ('view', 'method', 'status'),
+    DURATION_BUCKETS
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'foodgram_http_requests_in_progress',
+    'Запросы, обрабатываемые в данный момент'
+)
+DB_QUERIES = Histogram(
+    'foodgram_db_queries_per_request',
+    'Количество SQL-запросов на HTTP-запрос',
+    ('view',),
+    QUERY_BUCKETS
+)
+RESPONSE_SIZE = Histogram(
+    'foodgram_http_response_size_bytes',
+    'Размер тела ответа',
+    ('view',),
+    SIZE_BUCKETS
+)
+CACHE_REQUESTS = Counter(
+    'foodgram_cache_requests_total',
+    'Обращения к внутрипроцессным кешам',
+    ('cache', 'result')
+)
+
+THROTTLED_REQUESTS = Counter(
+    'foodgram_throttled_requests_total',
+    'Запросы, отклонённые ограничением частоты',
+    ('scope', 'reason')
+)
+
+
+def record_cache_access(cache_name, hit):
+    CACHE_REQUESTS.inc(cache_name, 'hit' if hit else 'miss')
+
+
+def record_throttled(scope, reason):
+    THROTTLED_REQUESTS.inc(scope, reason)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith('/api/'):
+            return self.get_response(request)
+
+        queries = QueryCounter()
+        REQUESTS_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(queries):
+                response = self.get_response(request)
+        finally:
+            REQUESTS_IN_PROGRESS.dec()
+        duration = time.perf_counter() - start
+
+        view_name = getattr(request, '_metrics_view', 'unresolved')
+        REQUEST_DURATION.observe(
+            duration, view_name, request.method, str(response.status_code)
+        )
+        DB_QUERIES.observe(queries.count, view_name)
+        if not response.streaming:
+            RESPONSE_SIZE.observe(len(response.content), view_name)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = get_view_name(view_func, request.method)
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.7 on 2026-10-19 10:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheInvalidation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('namespace', models.CharField(blank=True, max_length=100, verbose_name='Пространство имён')),
+                ('key', models.CharField(blank=True, max_length=100, verbose_name='Ключ')),
+            ],
+            options={
+                'verbose_name': 'Сброс кеша',
+                'verbose_name_plural': 'Сбросы кеша',
+            },
+        ),
+    ]
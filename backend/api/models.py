@@ -0,0 +1,23 @@
+from django.db import models
+
+
+class CacheInvalidation(models.Model):
+    """Сообщение шины сброса кешей для транспорта через базу данных."""
+
+    namespace = models.CharField(
+        max_length=100,
+        blank=True,
+        verbose_name='Пространство имён'
+    )
+    key = models.CharField(
+        max_length=100,
+        blank=True,
+        verbose_name='Ключ'
+    )
+
+    class Meta:
+        verbose_name = 'Сброс кеша'
+        verbose_name_plural = 'Сбросы кеша'
+
+    def __str__(self):
+        return f'{self.namespace or "*"}:{self.key}'
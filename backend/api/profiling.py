@@ -0,0 +1,148 @@
+import cProfile
+import os
+import pstats
+import random
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_SALT = 'api.profiling'
+
+
+def make_profile_token():
+    """Подписанное значение заголовка X-Profile."""
+    return signing.TimestampSigner(salt=PROFILE_SALT).sign('profile')
+
+
+def is_valid_profile_token(value):
+    try:
+        signing.TimestampSigner(salt=PROFILE_SALT).unsign(
+            value, max_age=settings.PROFILING_TOKEN_MAX_AGE
+        )
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def get_view_name(view_func, method):
+    """Имя вида в формате RecipeViewSet.list."""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return getattr(view_func, '__name__', 'unknown')
+    actions = getattr(view_func, 'actions', None) or {}
+    action = actions.get(method.lower(), method.lower())
+    return f'{view_class.__name__}.{action}'
+
+
+def get_profile_files(view_name=None):
+    pattern = f'{view_name}.*.prof' if view_name else '*.prof'
+    return sorted(
+        Path(settings.PROFILING_DIR).glob(pattern),
+        key=lambda path: path.stat().st_mtime
+    )
+
+
+class ProfileAggregator:
+    """Накапливает статистику по видам и периодически сбрасывает её на диск.
+
+    На каждый вид хранится не более PROFILING_MAX_FILES файлов:
+    самые старые удаляются при записи нового.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._samples = {}
+        self._flushed_at = {}
+        self._sequence = 0
+
+    def add(self, view_name, profiler):
+        with self._lock:
+            stats = self._stats.get(view_name)
+            if stats is None:
+                self._stats[view_name] = pstats.Stats(profiler)
+                self._flushed_at.setdefault(view_name, time.monotonic())
+            else:
+                stats.add(profiler)
+            self._samples[view_name] = self._samples.get(view_name, 0) + 1
+            if self._should_flush(view_name):
+                self._flush(view_name)
+
+    def _should_flush(self, view_name):
+        return (
+            self._samples[view_name] >= settings.PROFILING_FLUSH_EVERY
+            or time.monotonic() - self._flushed_at[view_name]
+            >= settings.PROFILING_FLUSH_INTERVAL
+        )
+
+    def _flush(self, view_name):
+        stats = self._stats.pop(view_name)
+        self._samples.pop(view_name)
+        self._flushed_at[view_name] = time.monotonic()
+        self._sequence += 1
+
+        directory = Path(settings.PROFILING_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / (
+            f'{view_name}.{os.getpid()}.{int(time.time())}'
+            f'.{self._sequence}.prof'
+        )
+        tmp_path = path.with_suffix('.tmp')
+        stats.dump_stats(tmp_path)
+        os.replace(tmp_path, path)
+
+        for old_path in get_profile_files(view_name)[
+            :-settings.PROFILING_MAX_FILES
+        ]:
+            old_path.unlink(missing_ok=True)
+
+
+class ProfilingMiddleware:
+    """Профилирует cProfile'ом долю запросов к API.
+
+    Профилируется доля PROFILING_SAMPLE_RATE запросов, а также запросы
+    с подписанным заголовком X-Profile (см. profile_hotspots --token).
+    """
+
+    aggregator = ProfileAggregator()
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self._should_profile(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # В потоке уже работает другой профилировщик
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+
+        view_name = getattr(request, '_profiling_view', None)
+        if view_name:
+            self.aggregator.add(view_name, profiler)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._profiling_view = get_view_name(view_func, request.method)
+
+    def _should_profile(self, request):
+        if not request.path.startswith('/api/'):
+            return False
+        token = request.META.get(PROFILE_HEADER)
+        if token:
+            return is_valid_profile_token(token)
+        return random.random() < settings.PROFILING_SAMPLE_RATE
@@ -1,6 +1,11 @@
+from collections import Counter
 from rest_framework import serializers
+from django.db import transaction
 from django.contrib.auth.password_validation import validate_password
 from recipes.models import Recipe, RecipeIngredient, Ingredient, User
+from recipes.indexes import recipe_changed
+from .batch import get_relations
+from .fields import SparseFieldsetsMixin
 from djoser.serializers import UserSerializer as DjoserUserSerializer
 from drf_extra_fields.fields import Base64ImageField
 from djoser.serializers import SetPasswordSerializer as DjoserSetPasswordSerializer
@@ -13,7 +18,20 @@ class RecipeMinifiedSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'image', 'cooking_time')
         read_only_fields = ('id', 'name', 'cooking_time')
 
-class UserSerializer(DjoserUserSerializer):
+
+class PantryRecipeSerializer(RecipeMinifiedSerializer):
+    matched_count = serializers.IntegerField(read_only=True)
+    missing_count = serializers.IntegerField(read_only=True)
+
+    class Meta(RecipeMinifiedSerializer.Meta):
+        fields = (
+            *RecipeMinifiedSerializer.Meta.fields,
+            'matched_count', 'missing_count'
+        )
+        read_only_fields = fields
+
+
+class UserSerializer(SparseFieldsetsMixin, DjoserUserSerializer):
     is_subscribed = serializers.SerializerMethodField()
 
     class Meta(DjoserUserSerializer.Meta):
@@ -24,7 +42,13 @@ class UserSerializer(DjoserUserSerializer):
         )
 
     def get_is_subscribed(self, obj):
+        # Значение могло быть получено подзапросом в queryset
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         request = self.context.get('request')
+        relations = get_relations(request)
+        if relations is not None:
+            return obj.pk in relations.get('subscriptions')
         return (
             request 
             and request.user.is_authenticated 
@@ -82,7 +106,7 @@ class UserSubscriptionSerializer(UserSerializer):
         ).data
 
     def get_recipes_count(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
 class IngredientSerializer(serializers.ModelSerializer):
     class Meta:
@@ -105,7 +129,7 @@ class RecipeIngredientReadSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
         read_only_fields = fields
 
-class RecipeReadSerializer(serializers.ModelSerializer):
+class RecipeReadSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     ingredients = RecipeIngredientReadSerializer(
         source='recipe_ingredients',
@@ -123,8 +147,18 @@ class RecipeReadSerializer(serializers.ModelSerializer):
             'is_favorited', 'is_in_shopping_cart'
         )
 
+    def to_representation(self, instance):
+        if hasattr(instance, 'author_is_subscribed'):
+            instance.author.is_subscribed = instance.author_is_subscribed
+        return super().to_representation(instance)
+
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
+        relations = get_relations(request)
+        if relations is not None:
+            return obj.pk in relations.get('favorites')
         return (
             request 
             and request.user.is_authenticated 
@@ -132,23 +166,58 @@ class RecipeReadSerializer(serializers.ModelSerializer):
         )
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
+        relations = get_relations(request)
+        if relations is not None:
+            return obj.pk in relations.get('shopping_cart')
         return (
             request 
             and request.user.is_authenticated 
             and request.user.shopping_cart_items.filter(recipe=obj).exists()
         )
 
+class RecipeIngredientListSerializer(serializers.ListSerializer):
+    """Загружает все ингредиенты рецепта одним запросом id__in."""
+
+    def to_internal_value(self, data):
+        items = super().to_internal_value(data)
+        ingredient_ids = [item['ingredient'] for item in items]
+        ingredients = Ingredient.objects.in_bulk(ingredient_ids)
+
+        errors = []
+        unknown_ids = sorted(set(ingredient_ids) - ingredients.keys())
+        if unknown_ids:
+            errors.append(
+                'Ингредиенты не найдены: '
+                + ', '.join(map(str, unknown_ids))
+            )
+        duplicate_ids = sorted(
+            ingredient_id for ingredient_id, count
+            in Counter(ingredient_ids).items() if count > 1
+        )
+        if duplicate_ids:
+            errors.append(
+                'Ингредиенты не должны повторяться: '
+                + ', '.join(map(str, duplicate_ids))
+            )
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        for item in items:
+            item['ingredient'] = ingredients[item['ingredient']]
+        return items
+
+
 class RecipeIngredientCreateSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all(),
-        source='ingredient'
-    )
+    id = serializers.IntegerField(source='ingredient')
     amount = serializers.IntegerField(min_value=1)
 
     class Meta:
         model = RecipeIngredient
         fields = ('id', 'amount')
+        list_serializer_class = RecipeIngredientListSerializer
 
 class CreateUpdateRecipeSerializer(serializers.ModelSerializer):
     ingredients = RecipeIngredientCreateSerializer(many=True, write_only=True)
@@ -160,16 +229,9 @@ class CreateUpdateRecipeSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',) 
 
     def validate_ingredients(self, value):
+        # Существование и уникальность проверяет RecipeIngredientListSerializer
         if not value:
             raise serializers.ValidationError("Нужен хотя бы один ингредиент")
-        
-        ingredient_ids = []
-        for item in value:
-            ingredient_id = item['ingredient'].id
-            if ingredient_id in ingredient_ids:
-                raise serializers.ValidationError("Ингредиенты не должны повторяться")
-            ingredient_ids.append(ingredient_id)
-        
         return value
 
     
@@ -177,15 +239,52 @@ class CreateUpdateRecipeSerializer(serializers.ModelSerializer):
         ingredients_data = validated_data.pop('ingredients')
         recipe = super().create(validated_data)
         self._create_ingredients(recipe, ingredients_data)
+        recipe_changed(recipe.id)
         return recipe
 
     def update(self, instance, validated_data):
-        ingredients_data = validated_data.pop('ingredients')
-        instance.recipe_ingredients.all().delete()
-        self._create_ingredients(instance, ingredients_data)
-        return super().update(instance, validated_data)
+        # При PATCH без ingredients продукты рецепта не меняются
+        ingredients_data = validated_data.pop('ingredients', None)
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+            if ingredients_data is not None:
+                self._update_ingredients(instance, ingredients_data)
+                recipe_changed(instance.id)
+        return instance
+
+    def _update_ingredients(self, recipe, ingredients_data):
+        existing = {
+            link.ingredient_id: link
+            for link in recipe.recipe_ingredients.all()
+        }
+        amounts = {
+            item['ingredient'].id: item['amount']
+            for item in ingredients_data
+        }
+
+        removed_ids = [
+            link.id for ingredient_id, link in existing.items()
+            if ingredient_id not in amounts
+        ]
+        changed = []
+        for ingredient_id, link in existing.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and amount != link.amount:
+                link.amount = amount
+                changed.append(link)
+
+        if removed_ids:
+            RecipeIngredient.objects.filter(id__in=removed_ids).delete()
+        self._create_ingredients(recipe, [
+            item for item in ingredients_data
+            if item['ingredient'].id not in existing
+        ])
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['amount'])
 
     def _create_ingredients(self, recipe, ingredients_data):
+        if not ingredients_data:
+            return
         RecipeIngredient.objects.bulk_create(
             RecipeIngredient(
                 recipe=recipe,
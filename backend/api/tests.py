@@ -0,0 +1,542 @@
+import asyncio
+import importlib.util
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from argparse import ArgumentTypeError, Namespace
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.testing import LiveServerTestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes.models import Ingredient, Subscription
+from recipes.tests import (
+    TEST_MEDIA_ROOT, ApiTestCase, create_recipe, create_user
+)
+
+from . import batch, cachebus, events, metrics
+from .models import CacheInvalidation
+from .profiling import (
+    ProfileAggregator, ProfilingMiddleware, make_profile_token
+)
+from .tickets import make_ticket, read_ticket
+
+LOADTEST = Path(settings.BASE_DIR).parent / 'loadtest' / 'loadtest.py'
+
+
+def import_loadtest():
+    spec = importlib.util.spec_from_file_location('loadtest', LOADTEST)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ProfilingTestCase(ApiTestCase):
+    """Профилируются только выбранные запросы к API."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = Path(directory)
+        settings = override_settings(
+            PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0,
+            PROFILING_DIR=directory, PROFILING_FLUSH_EVERY=1,
+            PROFILING_MAX_FILES=2
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        aggregator = ProfilingMiddleware.aggregator
+        ProfilingMiddleware.aggregator = ProfileAggregator()
+        self.addCleanup(setattr, ProfilingMiddleware, 'aggregator', aggregator)
+        # Middleware загружаются при первом запросе клиента
+        self.client = APIClient()
+
+    def profiles(self):
+        return sorted(path.name.split('.')[1] for path in self.directory.glob(
+            '*.prof'
+        ))
+
+    def test_signed_header(self):
+        self.client.get('/api/recipes/', HTTP_X_PROFILE=make_profile_token())
+        self.assertEqual(self.profiles(), ['list'])
+        self.client.get('/api/recipes/', HTTP_X_PROFILE='подделка')
+        self.client.get('/api/recipes/')
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_sample_rate(self):
+        with override_settings(PROFILING_SAMPLE_RATE=1):
+            self.client.get('/api/ingredients/')
+            # Не API — не профилируется
+            self.client.get('/admin/login/')
+        self.assertEqual(
+            [path.name.split('.')[0] for path in self.directory.iterdir()],
+            ['IngredientViewSet']
+        )
+
+    def test_max_files_and_report(self):
+        token = make_profile_token()
+        for _ in range(3):
+            self.client.get('/api/recipes/', HTTP_X_PROFILE=token)
+        self.assertEqual(len(self.profiles()), 2)
+        stdout = StringIO()
+        call_command(
+            'profile_hotspots', view='RecipeViewSet.list', stdout=stdout
+        )
+        self.assertIn('Виды: RecipeViewSet.list', stdout.getvalue())
+        self.assertIn('Файлов профилей: 2', stdout.getvalue())
+
+
+class MetricsTestCase(ApiTestCase):
+    """Потоки пишут в свои файлы, значения суммируются при чтении."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = Path(directory)
+        settings = override_settings(METRICS_DIR=directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.registry = metrics.Registry()
+        self.registry.metrics = metrics.registry.metrics
+        patcher = mock.patch.object(metrics, 'registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_threads(self, count, parallel):
+        # Параллельные потоки живут одновременно: второй барьер не даёт
+        # первому завершиться и вернуть файл раньше остальных
+        barrier = threading.Barrier(count if parallel else 1)
+
+        def run():
+            self.count()
+            barrier.wait()
+            self.count()
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+            if not parallel:
+                thread.join()
+        for thread in threads:
+            thread.join()
+
+    def value(self, metric, suffix, *labelvalues):
+        return self.registry.collect().get(metric._key(suffix, labelvalues))
+
+    def count(self):
+        for _ in range(50):
+            metrics.record_cache_access('test', True)
+
+    def test_threads_are_summed(self):
+        self.run_threads(4, parallel=True)
+        self.assertEqual(len(list(self.directory.glob('*.db'))), 4)
+        self.assertEqual(
+            self.value(metrics.CACHE_REQUESTS, '', 'test', 'hit'), 400
+        )
+
+    def test_finished_thread_file_is_reused(self):
+        self.run_threads(3, parallel=False)
+        self.assertEqual(len(list(self.directory.glob('*.db'))), 1)
+        self.assertEqual(
+            self.value(metrics.CACHE_REQUESTS, '', 'test', 'hit'), 300
+        )
+
+    def test_histogram(self):
+        for value in (0, 3, 3, 500):
+            metrics.DB_QUERIES.observe(value, 'view')
+        exposition = self.registry.exposition()
+        self.assertIn(
+            'foodgram_db_queries_per_request_bucket{view="view",le="0"} 1',
+            exposition
+        )
+        self.assertIn(
+            'foodgram_db_queries_per_request_bucket{view="view",le="5"} 3',
+            exposition
+        )
+        self.assertIn(
+            'foodgram_db_queries_per_request_bucket{view="view",le="+Inf"} 4',
+            exposition
+        )
+        self.assertIn(
+            'foodgram_db_queries_per_request_sum{view="view"} 506',
+            exposition
+        )
+
+    def test_dead_worker_is_archived(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        store = metrics.MmapStore(self.directory / f'{process.pid}_1.db')
+        counter = metrics.CACHE_REQUESTS._key('', ('test', 'hit'))
+        gauge = metrics.REQUESTS_IN_PROGRESS._key('', ())
+        store.add(store.position(counter), 5)
+        store.add(store.position(gauge), 1)
+        store.close()
+        self.count()
+        values = self.registry.collect()
+        self.assertEqual(values[counter], 55)
+        # Значения gauge завершившегося воркера не переносятся
+        self.assertEqual(values.get(gauge, 0), 0)
+        self.assertEqual(
+            {path.name for path in self.directory.glob('*.db')},
+            {'archive.db', f'{os.getpid()}_1.db'}
+        )
+
+
+class TokenApiBypassTestCase(ApiTestCase):
+    """Запросы к API с токеном проходят мимо сессий, CSRF и X-Frame-Options."""
+
+    def setUp(self):
+        self.recipe = create_recipe(self.author, {self.ingredients[0]: 1})
+        self.token = Token.objects.create(user=self.author).key
+        self.client = Client(enforce_csrf_checks=True)
+
+    def test_token_request(self):
+        response = self.client.post(
+            f'/api/recipes/{self.recipe.id}/favorite/',
+            HTTP_AUTHORIZATION=f'Token {self.token}'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('X-Frame-Options', response)
+        self.assertFalse(response.cookies)
+
+    def test_request_without_token(self):
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+    def test_admin_keeps_full_stack(self):
+        # Токен не отключает защиту вне /api/
+        response = self.client.get(
+            '/admin/login/', HTTP_AUTHORIZATION=f'Token {self.token}'
+        )
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+        self.assertIn('csrftoken', response.cookies)
+        response = self.client.post('/admin/login/', {
+            'username': self.author.email, 'password': 'pass12345!'
+        })
+        self.assertEqual(response.status_code, 403)
+
+
+class CacheBusTestCase(ApiTestCase):
+    """Сообщения шины сбрасывают кеши всех воркеров."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'bus')
+        overrides = override_settings(
+            CACHE_BUS_TRANSPORT='mmap', CACHE_BUS_PATH=self.path,
+            CACHE_BUS_SIZE=4, CACHE_BUS_POLL_INTERVAL=0
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # Второй экземпляр шины в том же файле — другой воркер
+        self.other = cachebus.CacheBus()
+        patcher = mock.patch.object(cachebus, 'bus', cachebus.CacheBus())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = cachebus.LocalCache('test', 'test')
+        self.loads = []
+
+    def get(self, key):
+        def load():
+            self.loads.append(key)
+            return key
+        return self.cache.get_or_set(key, load)
+
+    def test_publish_and_poll(self):
+        self.get(1)
+        self.get(2)
+        self.get(1)
+        self.other.publish('test', 1)
+        self.other.publish('other', 2)
+        self.get(1)
+        self.get(2)
+        self.assertEqual(self.loads, [1, 2, 1])
+
+    def test_wraparound_clears_caches(self):
+        self.get(1)
+        # Воркер отстал больше чем на размер буфера
+        for key in range(5):
+            self.other.publish('other', key)
+        self.get(1)
+        self.assertEqual(self.loads, [1, 1])
+
+    def test_publish_all(self):
+        version = cachebus.NamespaceVersion('test')
+        before = version.get()
+        self.get(1)
+        self.other.publish_all()
+        self.get(1)
+        self.assertEqual(self.loads, [1, 1])
+        self.assertNotEqual(version.get(), before)
+
+    def test_database_fallback(self):
+        for transport, path in (('mmap', os.path.join(self.path, 'x')),
+                                ('db', self.path)):
+            with self.subTest(transport=transport), override_settings(
+                CACHE_BUS_TRANSPORT=transport, CACHE_BUS_PATH=path
+            ), mock.patch.object(cachebus, 'bus', cachebus.CacheBus()):
+                other = cachebus.CacheBus()
+                self.assertIsInstance(
+                    other.transport(), cachebus.DatabaseTransport
+                )
+                cache = cachebus.LocalCache('test', 'test')
+                cache.get_or_set(1, lambda: 'старое')
+                other.publish('test', 1)
+                self.assertEqual(cache.get_or_set(1, lambda: 'новое'), 'новое')
+        # В таблице хранятся только последние CACHE_BUS_SIZE сообщений
+        for key in range(5):
+            other.publish('other', key)
+        self.assertEqual(CacheInvalidation.objects.count(), 4)
+
+
+@skipUnless(LOADTEST.exists(), 'Каталог loadtest не входит в образ')
+@override_settings(
+    THROTTLE_ENABLED=False, MEDIA_ROOT=TEST_MEDIA_ROOT,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']
+)
+class LoadTestCase(LiveServerTestCase):
+    """Нагрузочный тест проходит сценарии на живом сервере."""
+
+    def setUp(self):
+        self.loadtest = import_loadtest()
+        Ingredient.objects.bulk_create([
+            Ingredient(name=name, measurement_unit='г')
+            for name in ('Молоко', 'Сахар', 'Мука')
+        ])
+
+    def test_percentile_and_mix(self):
+        values = [number / 1000 for number in range(1, 101)]
+        self.assertEqual(self.loadtest.percentile(values, 50), 50)
+        self.assertEqual(self.loadtest.percentile(values, 99), 99)
+        self.assertIsNone(self.loadtest.percentile([], 50))
+        self.assertEqual(
+            self.loadtest.parse_mix('browse=3,search'),
+            {'browse': 3, 'search': 1}
+        )
+        with self.assertRaises(ArgumentTypeError):
+            self.loadtest.parse_mix('unknown=1')
+
+    def test_report(self):
+        options = Namespace(
+            base_url=self.live_server_url, users=2, duration=2,
+            ramp_up=0, think_time=0, timeout=10, seed='test',
+            mix=self.loadtest.parse_mix(self.loadtest.DEFAULT_MIX)
+        )
+        report = asyncio.run(self.loadtest.main(options))
+        endpoints = report['endpoints']
+        self.assertEqual(report['errors'], 0, endpoints)
+        self.assertEqual(endpoints['POST /api/users/']['requests'], 2)
+        self.assertEqual(
+            endpoints['POST /api/auth/token/login/']['requests'], 2
+        )
+        # После входа пользователи выполняют сценарии
+        self.assertGreater(report['requests'], 4)
+        self.assertEqual(report['requests'], sum(
+            endpoint['requests'] for endpoint in endpoints.values()
+        ))
+        self.assertEqual(report['config']['users'], 2)
+
+
+@override_settings(BATCH_MAX_WORKERS=1)
+class BatchTestCase(ApiTestCase):
+    """Подзапросы пакета делят признаки пользователя и видят свои изменения."""
+
+    def setUp(self):
+        self.recipes = [
+            create_recipe(self.author, {self.ingredients[0]: 1}, name)
+            for name in ('Первый', 'Второй')
+        ]
+        self.client = self.client_for(create_user('reader'))
+
+    def post(self, items):
+        load = mock.Mock(wraps=batch.RELATIONS['favorites'])
+        with CaptureQueriesContext(connection) as context, \
+                mock.patch.dict(batch.RELATIONS, favorites=load):
+            response = self.client.post('/api/batch/', items, format='json')
+        self.assertEqual(response.status_code, 200)
+        sql = ' '.join(query['sql'] for query in context.captured_queries)
+        return response.data, load.call_count, sql
+
+    def test_relations_are_loaded_once(self):
+        first, second = self.recipes
+        results, loads, sql = self.post([
+            {'path': '/api/recipes/'},
+            {'path': f'/api/recipes/{first.id}/'},
+            {'path': f'/api/recipes/{second.id}/'},
+            {'method': 'POST', 'path': f'/api/recipes/{first.id}/favorite/'},
+            {'path': f'/api/recipes/{first.id}/'},
+        ])
+        self.assertEqual(
+            [result['status'] for result in results],
+            [200, 200, 200, 201, 200]
+        )
+        self.assertFalse(results[1]['body']['is_favorited'])
+        # Избранное перечитано после изменения
+        self.assertTrue(results[4]['body']['is_favorited'])
+        self.assertFalse(results[4]['body']['author']['is_subscribed'])
+        self.assertEqual(loads, 2)
+        self.assertNotIn('EXISTS', sql)
+
+    def test_outside_batch(self):
+        response = self.client.get(f'/api/recipes/{self.recipes[0].id}/')
+        self.assertFalse(response.data['is_favorited'])
+
+
+@override_settings(THROTTLE_ENABLED=False, BATCH_MAX_WORKERS=2)
+class BatchPoolTestCase(TransactionTestCase):
+    """Потоки пула закрывают соединения с БД после подзапроса.
+
+    Потоки работают со своими соединениями, поэтому данные должны быть
+    закоммичены: тест выполняется вне общей транзакции TestCase.
+    """
+
+    def test_parallel_reads(self):
+        author = create_user('author')
+        recipe = create_recipe(author, {
+            Ingredient.objects.create(name='Соль', measurement_unit='г'): 1
+        })
+        client = APIClient()
+        client.force_authenticate(author)
+        with mock.patch.object(
+            batch, 'close_old_connections',
+            wraps=batch.close_old_connections
+        ) as close:
+            response = client.post('/api/batch/', [
+                {'path': f'/api/recipes/{recipe.id}/'},
+                {'path': '/api/users/me/'},
+                {'path': '/api/recipes/'},
+            ], format='json')
+        self.assertEqual(
+            [result['status'] for result in response.data], [200, 200, 200]
+        )
+        self.assertEqual(response.data[2]['body']['count'], 1)
+        # До и после каждого подзапроса
+        self.assertEqual(close.call_count, 6)
+
+
+@override_settings(
+    THROTTLE_ENABLED=False, CACHE_BUS_TRANSPORT='mmap', CACHE_BUS_SIZE=16,
+    EVENTS_QUEUE_SIZE=2, EVENTS_POLL_INTERVAL=0
+)
+class EventsTestCase(TransactionTestCase):
+    """Поток событий: билеты, авторизация и раздача событий через Hub.
+
+    database_sync_to_async закрывает соединения, как обработчик запроса,
+    поэтому тесты выполняются вне общей транзакции TestCase.
+    """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        overrides = override_settings(
+            CACHE_BUS_PATH=os.path.join(directory, 'bus')
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.bus = cachebus.CacheBus()
+        patcher = mock.patch.object(events, 'bus', self.bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hub = events.Hub()
+        for namespace in (
+            events.RECIPES_NAMESPACE, cachebus.RECIPE_CREATED_NAMESPACE,
+            cachebus.SUBSCRIPTIONS_NAMESPACE
+        ):
+            self.bus.register(namespace, events.HubCache(self.hub, namespace))
+        self.bus.poll()
+        self.author = create_user('author')
+        self.reader = create_user('reader')
+
+    def test_ticket(self):
+        self.assertEqual(
+            APIClient().post('/api/events/ticket/').status_code, 401
+        )
+        client = APIClient()
+        client.force_authenticate(self.reader)
+        response = client.post('/api/events/ticket/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(read_ticket(response.data['ticket']), self.reader.id)
+        self.assertIsNone(read_ticket(response.data['ticket'] + 'x'))
+        with override_settings(EVENTS_TICKET_MAX_AGE=-1):
+            self.assertIsNone(read_ticket(response.data['ticket']))
+
+    async def test_authenticate(self):
+        token = await sync_to_async(Token.objects.create)(user=self.reader)
+        ticket = make_ticket(self.author)
+        for scope, user in (
+            ({'headers': [(b'authorization', f'Token {token.key}'.encode())]},
+             self.reader),
+            ({'headers': [], 'query_string': f'ticket={ticket}'.encode()},
+             self.author),
+            ({'headers': [(b'authorization', b'Token unknown')]}, None),
+            ({'headers': [], 'query_string': b'ticket=unknown'}, None),
+        ):
+            with self.subTest(scope=scope):
+                self.assertEqual(await events.authenticate(scope), user)
+
+    async def test_unauthorized(self):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await events.events_app({'headers': []}, None, send)
+        self.assertEqual(messages[0]['status'], 401)
+
+    async def test_recipe_events(self):
+        recipe = await sync_to_async(create_recipe)(self.author, {})
+        listener = events.Listener(self.reader.id, {self.author.id})
+        self.hub.subscribe(listener)
+        self.bus.publish(cachebus.RECIPE_CREATED_NAMESPACE, recipe.id)
+        self.bus.publish(events.RECIPES_NAMESPACE, recipe.id)
+        message = await asyncio.wait_for(listener.queue.get(), 5)
+        self.assertEqual(message, {
+            'event': 'recipe_published',
+            'data': {
+                'id': recipe.id, 'name': recipe.name,
+                'author': self.author.id,
+            },
+        })
+        self.hub.unsubscribe(listener)
+        await self.hub._feeder
+
+    async def test_follow(self):
+        listener = events.Listener(self.reader.id, set())
+        self.hub.subscribe(listener)
+        await sync_to_async(Subscription.objects.create)(
+            user=self.reader, author=self.author
+        )
+        self.bus.publish(cachebus.SUBSCRIPTIONS_NAMESPACE, self.reader.id)
+        # Подписчику нужно перечитать свои подписки
+        message = await asyncio.wait_for(listener.queue.get(), 5)
+        self.assertIs(message, events.REFRESH)
+        self.hub.follow(
+            listener, await events.followed_authors(self.reader.id)
+        )
+        self.hub.publish(self.author.id, {'event': 'test'})
+        self.assertEqual(listener.queue.get_nowait(), {'event': 'test'})
+        self.hub.unsubscribe(listener)
+        await self.hub._feeder
+
+    def test_full_queue_drops_listener(self):
+        listener = events.Listener(self.reader.id, {self.author.id})
+        for number in range(4):
+            listener.put({'event': number})
+        self.assertTrue(listener.dropped)
+        # Непрочитанное событие уступило место DROP, остальные отброшены
+        self.assertEqual(listener.queue.get_nowait(), {'event': 1})
+        self.assertIs(listener.queue.get_nowait(), events.DROP)
+        self.assertTrue(listener.queue.empty())
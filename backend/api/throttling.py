@@ -0,0 +1,268 @@
+"""Ограничение частоты запросов к API, общее для всех воркеров машины.
+
+Каждый клиент (пользователь или IP анонима) тратит токены из корзины
+'user' или 'anon' (token bucket): ёмкость и скорость пополнения задаются
+ставками DEFAULT_THROTTLE_RATES, а запрос стоит THROTTLE_COSTS[область]
+токенов, поэтому загрузки и выгрузки расходуют общий лимит быстрее.
+Если у области view (throttle_scope или throttle_scopes[action]) есть
+своя ставка, запрос дополнительно списывает токен из её корзины.
+ConcurrencyLimitMixin ограничивает число одновременных запросов клиента
+к дорогим действиям. При отказе DRF отвечает 429 с Retry-After.
+
+Корзины хранятся в таблице с открытой адресацией в файле THROTTLE_PATH,
+отображённом в память всеми воркерами. Слот вытесняется, только когда
+его корзина снова полна и занятых мест нет; если вытеснить некого,
+запрос пропускается без учёта и попадает в метрику (reason=table_full).
+Если файл недоступен, таблица живёт в памяти процесса.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .metrics import record_throttled
+
+# [хеш ключа][токены][время обновления][когда слот можно вытеснить]
+# [число выполняющихся запросов]
+SLOT = struct.Struct('Qdddq')
+# Сколько соседних слотов просматривается при поиске ключа
+PROBES = 8
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+# Таблица заполнена: запрос пропускается без учёта
+UNTRACKED = None
+
+
+def parse_rate(rate):
+    """'60/min' -> (ёмкость, токенов в секунду)."""
+    number, period = rate.split('/')
+    number = int(number)
+    return number, number / DURATIONS[period[0]]
+
+
+def key_hash(key):
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    # Ноль означает пустой слот
+    return int.from_bytes(digest, 'little') | 1
+
+
+class BucketTable:
+    def __init__(self, path, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._file = None
+        try:
+            self._file = open(path, 'a+b')
+            if os.fstat(self._file.fileno()).st_size < SLOT.size * size:
+                self._file.truncate(SLOT.size * size)
+            self._map = mmap.mmap(self._file.fileno(), SLOT.size * size)
+        except OSError:
+            self._file = None
+            self._map = bytearray(SLOT.size * size)
+
+    def locked(self, operation, *args):
+        # flock не разделяет потоки одного процесса
+        with self._lock:
+            if self._file is None:
+                return operation(*args)
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                return operation(*args)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def read(self, offset):
+        return SLOT.unpack_from(self._map, offset)
+
+    def write(self, offset, *values):
+        SLOT.pack_into(self._map, offset, *values)
+
+    def find(self, key, now, create=True):
+        """Смещение слота ключа и признак того, что слот новый.
+
+        Новый ключ занимает пустой слот или вытесняет соседа, чья корзина
+        уже полностью пополнилась и у которого нет выполняющихся запросов:
+        забыть такой слот — то же, что создать заново. Если вытеснить
+        некого, возвращается None.
+        """
+        hashed = key_hash(key)
+        start = hashed % self.size
+        free = None
+        for probe in range(PROBES):
+            offset = SLOT.size * ((start + probe) % self.size)
+            stored, _, _, idle_at, _ = self.read(offset)
+            if stored == hashed:
+                return offset, False
+            if free is None and (stored == 0 or idle_at <= now):
+                free = offset
+            if stored == 0:
+                break
+        if free is None or not create:
+            return None, False
+        self.write(free, hashed, 0, 0, 0, 0)
+        return free, True
+
+    def take(self, buckets, now=None):
+        """Списывает токены из всех корзин или ни из одной.
+
+        buckets — список (ключ, ёмкость, токенов в секунду, стоимость).
+        Возвращает 0 или число секунд до появления нужных токенов.
+        UNTRACKED — для корзины не нашлось места, запрос пропускается.
+        """
+        return self.locked(self._take, buckets, now or time.time())
+
+    def _take(self, buckets, now):
+        states = []
+        wait = 0
+        for key, capacity, refill, cost in buckets:
+            offset, created = self.find(key, now)
+            if offset is None:
+                return UNTRACKED
+            hashed, tokens, updated, _, running = self.read(offset)
+            if created:
+                tokens = capacity
+            else:
+                tokens = min(capacity, tokens + (now - updated) * refill)
+            cost = min(cost, capacity)
+            if tokens < cost:
+                wait = max(wait, (cost - tokens) / refill)
+            states.append((offset, hashed, tokens, cost, capacity, refill))
+        for offset, hashed, tokens, cost, capacity, refill in states:
+            if not wait:
+                tokens -= cost
+            self.write(
+                offset, hashed, tokens, now,
+                now + (capacity - tokens) / refill, 0
+            )
+        return wait
+
+    def acquire(self, key, limit, timeout, now=None):
+        """Занимает одно из limit мест.
+
+        Возвращает True, False или UNTRACKED, если для ключа нет места.
+        """
+        return self.locked(self._acquire, key, limit, timeout,
+                           now or time.time())
+
+    def _acquire(self, key, limit, timeout, now):
+        offset, _ = self.find(key, now)
+        if offset is None:
+            return UNTRACKED
+        hashed, _, updated, _, running = self.read(offset)
+        if now - updated > timeout:
+            # Воркер мог упасть, не освободив место
+            running = 0
+        if running >= limit:
+            return False
+        # Пока место занято, слот не вытесняется; после timeout
+        # его можно считать брошенным
+        self.write(offset, hashed, 0, now, now + timeout, running + 1)
+        return True
+
+    def release(self, key):
+        self.locked(self._release, key, time.time())
+
+    def _release(self, key, now):
+        offset, _ = self.find(key, now, create=False)
+        if offset is None:
+            return
+        hashed, tokens, updated, idle_at, running = self.read(offset)
+        if running > 1:
+            self.write(offset, hashed, tokens, updated, idle_at, running - 1)
+        elif running == 1:
+            self.write(offset, hashed, tokens, updated, now, 0)
+
+
+_tables = {}
+
+
+def get_table():
+    # После fork у воркера должен быть свой mmap
+    table = _tables.get(os.getpid())
+    if table is None:
+        _tables.clear()
+        table = _tables[os.getpid()] = BucketTable(
+            settings.THROTTLE_PATH, settings.THROTTLE_SLOTS
+        )
+    return table
+
+
+def get_scope(view):
+    scopes = getattr(view, 'throttle_scopes', {})
+    return scopes.get(
+        getattr(view, 'action', None), getattr(view, 'throttle_scope', None)
+    )
+
+
+def get_ident(request):
+    if request.user.is_authenticated:
+        return str(request.user.pk)
+    # Учитывает X-Forwarded-For от nginx
+    return f'ip:{BaseThrottle().get_ident(request)}'
+
+
+class ApiThrottle(BaseThrottle):
+    def allow_request(self, request, view):
+        self.wait_seconds = 0
+        if not settings.THROTTLE_ENABLED:
+            return True
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        kind = 'user' if request.user.is_authenticated else 'anon'
+        ident = get_ident(request)
+        scope = get_scope(view)
+        buckets = [(
+            f'{kind}:{ident}', *parse_rate(rates[kind]),
+            settings.THROTTLE_COSTS.get(scope, 1)
+        )]
+        if rates.get(scope):
+            buckets.append((f'{scope}:{ident}', *parse_rate(rates[scope]), 1))
+        wait = get_table().take(buckets)
+        if wait is UNTRACKED:
+            record_throttled(scope or kind, 'table_full')
+            return True
+        if wait:
+            record_throttled(scope or kind, 'rate')
+        self.wait_seconds = wait
+        return not wait
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class ConcurrencyLimitMixin:
+    """Не больше THROTTLE_CONCURRENCY[область] запросов клиента сразу."""
+
+    def initial(self, request, *args, **kwargs):
+        self.concurrency_key = None
+        super().initial(request, *args, **kwargs)
+        scope = get_scope(self)
+        limit = settings.THROTTLE_CONCURRENCY.get(scope)
+        if not settings.THROTTLE_ENABLED or not limit:
+            return
+        key = f'running:{scope}:{get_ident(request)}'
+        acquired = get_table().acquire(
+            key, limit, settings.THROTTLE_CONCURRENCY_TIMEOUT
+        )
+        if acquired is UNTRACKED:
+            record_throttled(scope, 'table_full')
+            return
+        if not acquired:
+            record_throttled(scope, 'concurrency')
+            raise Throttled(
+                wait=1, detail='Дождитесь завершения предыдущего запроса.'
+            )
+        self.concurrency_key = key
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # Вызывается и после исключения в view
+        if getattr(self, 'concurrency_key', None):
+            get_table().release(self.concurrency_key)
+            self.concurrency_key = None
+        return super().finalize_response(request, response, *args, **kwargs)
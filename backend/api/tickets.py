@@ -0,0 +1,39 @@
+"""Билеты подключения к потоку событий /api/events/.
+
+EventSource не умеет передавать заголовки, поэтому браузер получает
+билет POST /api/events/ticket/ и подключается с ?ticket=. Билет подписан
+SECRET_KEY, годится только для потока событий и живёт
+EVENTS_TICKET_MAX_AGE секунд, так что адрес, попавший в журналы прокси,
+не раскрывает токен API.
+"""
+from django.conf import settings
+from django.core import signing
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+SALT = 'api.events.ticket'
+
+
+def make_ticket(user):
+    return signing.dumps(user.pk, salt=SALT)
+
+
+def read_ticket(ticket):
+    """Id пользователя из билета или None."""
+    try:
+        return signing.loads(
+            ticket, salt=SALT, max_age=settings.EVENTS_TICKET_MAX_AGE
+        )
+    except signing.BadSignature:
+        return None
+
+
+class EventTicketView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        return Response({
+            'ticket': make_ticket(request.user),
+            'expires_in': settings.EVENTS_TICKET_MAX_AGE,
+        })
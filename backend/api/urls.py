@@ -1,6 +1,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import RecipeViewSet, UserViewSet, IngredientViewSet
+from .views import (
+    RecipeViewSet, UserViewSet, IngredientViewSet, metrics_view
+)
+from .batch import BatchView
+from .tickets import EventTicketView
 
 router = DefaultRouter()
 router.register('ingredients', IngredientViewSet)
@@ -9,5 +13,10 @@ router.register('users', UserViewSet)
 
 urlpatterns = [
     path('auth/', include('djoser.urls.authtoken')),
+    path('metrics/', metrics_view, name='metrics'),
+    path('batch/', BatchView.as_view(), name='batch'),
+    path(
+        'events/ticket/', EventTicketView.as_view(), name='events-ticket'
+    ),
     path('', include(router.urls)),
 ] 
\ No newline at end of file
@@ -3,45 +3,186 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.shortcuts import get_object_or_404
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Sum
 from datetime import datetime
 from django.urls import reverse
 from djoser.views import UserViewSet as DjoserUserViewSet
-from django.http import FileResponse
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, Http404
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from io import BytesIO
 from recipes.models import Recipe, User, Ingredient, RecipeIngredient, Favorite, ShoppingCart, Subscription
+from recipes import deletion, pantry, similarity
 from .serializers import (
     CreateUpdateRecipeSerializer,
     UserSerializer,
     SetAvatarSerializer,
     IngredientSerializer,
     RecipeReadSerializer,
+    RecipeMinifiedSerializer,
+    PantryRecipeSerializer,
     UserSubscriptionSerializer
 )
 from .permissions import IsAuthorOrReadOnly
+from .conditional import ConditionalGetMixin
+from .batch import get_relations
+from .fields import get_selected_fields
+from .metrics import registry
+from .cachebus import LocalCache, NamespaceVersion
+from .throttling import ConcurrencyLimitMixin
 
+RECIPES_BY_IDS_LIMIT = 50
+SIMILAR_RECIPES_LIMIT = 6
+SIMILAR_RECIPES_MAX_LIMIT = 30
 
-class UserViewSet(DjoserUserViewSet):
+# Справочник ингредиентов меняется редко, каждый воркер держит его
+# в памяти; любое изменение Ingredient сбрасывает кеш через шину
+INGREDIENT_CATALOG = LocalCache(
+    'ingredient_catalog', 'recipes.ingredient', maxsize=1, per_object=False
+)
+
+# Версии для ETag ответов (см. ConditionalGetMixin)
+RECIPES_VERSION = NamespaceVersion('recipes.recipe')
+USERS_VERSION = NamespaceVersion('recipes.user')
+INGREDIENTS_VERSION = NamespaceVersion('recipes.ingredient')
+
+RECIPE_ORDERINGS = {
+    'popular': ('-favorites_count', '-pub_date'),
+    'cooking_time': ('cooking_time', '-pub_date'),
+}
+
+
+# Столбцы, которые нужны полям сериализаторов для чтения
+USER_COLUMNS = {
+    'email': ('email',),
+    'id': ('id',),
+    'username': ('username',),
+    'first_name': ('first_name',),
+    'last_name': ('last_name',),
+    'avatar': ('avatar',),
+    'recipes_count': ('recipes_count',),
+}
+RECIPE_COLUMNS = {
+    'id': ('id',),
+    'name': ('name',),
+    'image': ('image',),
+    'text': ('text',),
+    'cooking_time': ('cooking_time',),
+    'author': ('author', *(
+        f'author__{column}'
+        for field in UserSerializer.Meta.fields
+        for column in USER_COLUMNS.get(field, ())
+    )),
+}
+
+
+def use_exists(request):
+    # В пакете признаки берутся из общего RelationCache (api/batch.py)
+    return request.user.is_authenticated and get_relations(request) is None
+
+
+def optimize_user_queryset(queryset, request, serializer_class):
+    fields = get_selected_fields(request, serializer_class.Meta.fields)
+    if 'is_subscribed' in fields and use_exists(request):
+        queryset = queryset.annotate(is_subscribed=Exists(
+            Subscription.objects.filter(
+                user=request.user, author=OuterRef('pk')
+            )
+        ))
+    return queryset.only('id', *(
+        column for field in fields for column in USER_COLUMNS.get(field, ())
+    ))
+
+
+def optimize_recipe_queryset(queryset, request):
+    """Загружает только то, что нужно полям RecipeReadSerializer в ответе."""
+    fields = get_selected_fields(request, RecipeReadSerializer.Meta.fields)
+    user = request.user
+    if 'author' in fields:
+        queryset = queryset.select_related('author')
+        if use_exists(request):
+            queryset = queryset.annotate(author_is_subscribed=Exists(
+                Subscription.objects.filter(
+                    user=user, author=OuterRef('author_id')
+                )
+            ))
+    if 'ingredients' in fields:
+        queryset = queryset.prefetch_related(Prefetch(
+            'recipe_ingredients',
+            queryset=RecipeIngredient.objects.select_related('ingredient')
+        ))
+    if use_exists(request):
+        if 'is_favorited' in fields:
+            queryset = queryset.annotate(is_favorited=Exists(
+                Favorite.objects.filter(user=user, recipe=OuterRef('pk'))
+            ))
+        if 'is_in_shopping_cart' in fields:
+            queryset = queryset.annotate(is_in_shopping_cart=Exists(
+                ShoppingCart.objects.filter(user=user, recipe=OuterRef('pk'))
+            ))
+    return queryset.only('id', *(
+        column for field in fields for column in RECIPE_COLUMNS.get(field, ())
+    ))
+
+
+def shift_counter(queryset, field, delta, **fields):
+    queryset.update(**{field: F(field) + delta}, **fields)
+
+
+def touch_user(user):
+    # updated_at пользователя входит в ETag всех его ответов
+    User.objects.filter(pk=user.pk).update(updated_at=timezone.now())
+
+
+class UserViewSet(ConcurrencyLimitMixin, ConditionalGetMixin,
+                  DjoserUserViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     lookup_field = 'id'
     permission_classes = [AllowAny]
+    throttle_scopes = {'set_avatar': 'uploads'}
+    list_versions = (USERS_VERSION,)
 
     def get_permissions(self):
         if self.action in ['me', 'set_avatar', 'subscribe', 'subscriptions']:
             return [IsAuthenticated()]
         return super().get_permissions()
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            queryset = optimize_user_queryset(
+                queryset, self.request, UserSerializer
+            )
+        return queryset
+
     @action(detail=False, methods=['get'])
     def subscriptions(self, request):
-        subscribed_users = User.objects.filter(authors__user=request.user)
-        page = self.paginate_queryset(subscribed_users)
-        serializer = UserSubscriptionSerializer(
-            page,
-            many=True,
-            context={'request': request}
+        subscribed_users = optimize_user_queryset(
+            User.objects.filter(authors__user=request.user),
+            request,
+            UserSubscriptionSerializer
+        )
+
+        def get_response():
+            page = self.paginate_queryset(subscribed_users)
+            serializer = UserSubscriptionSerializer(
+                page,
+                many=True,
+                context={'request': request}
+            )
+            return self.get_paginated_response(serializer.data)
+
+        return self.conditional_response(
+            subscribed_users,
+            get_response,
+            use_last_modified=False,
+            fields=('updated_at', 'recipes__updated_at'),
+            versions=(USERS_VERSION, RECIPES_VERSION)
         )
-        return self.get_paginated_response(serializer.data)
 
     @action(detail=False, methods=['put', 'delete'], url_path='me/avatar')
     def set_avatar(self, request):
@@ -74,10 +215,17 @@ class UserViewSet(DjoserUserViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            subscription, created = Subscription.objects.get_or_create(
-                user=request.user,
-                author=author
-            )
+            with transaction.atomic():
+                subscription, created = Subscription.objects.get_or_create(
+                    user=request.user,
+                    author=author
+                )
+                if created:
+                    shift_counter(
+                        User.objects.filter(pk=author.pk),
+                        'subscribers_count', 1
+                    )
+                    touch_user(request.user)
             
             if not created:
                 return Response(
@@ -91,12 +239,33 @@ class UserViewSet(DjoserUserViewSet):
         subscription = get_object_or_404(
             Subscription, user=request.user, author=author
         )
-        subscription.delete()
+        with transaction.atomic():
+            subscription.delete()
+            shift_counter(
+                User.objects.filter(pk=author.pk), 'subscribers_count', -1
+            )
+            touch_user(request.user)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class RecipeViewSet(viewsets.ModelViewSet):
+    def perform_destroy(self, instance):
+        # Строки удаляет purge_deleted, здесь объект только скрывается
+        deletion.hide_user(instance)
+
+class RecipeViewSet(ConcurrencyLimitMixin, ConditionalGetMixin,
+                    viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     permission_classes = [IsAuthorOrReadOnly]
+    # Загрузка картинок и выгрузка списка покупок нагружают сервер сильнее
+    throttle_scopes = {
+        'create': 'uploads',
+        'update': 'uploads',
+        'partial_update': 'uploads',
+        'download_shopping_cart': 'exports',
+    }
+    conditional_fields = ('updated_at', 'author__updated_at')
+    # Название и единица измерения ингредиента входят в ответ рецепта
+    conditional_versions = (INGREDIENTS_VERSION,)
+    list_versions = (RECIPES_VERSION, USERS_VERSION)
     
     def get_serializer_class(self):
         if self.action in ['create', 'update', 'partial_update']:
@@ -104,9 +273,27 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return RecipeReadSerializer
     
     def perform_create(self, serializer):
-        recipe = serializer.save(author=self.request.user)
+        with transaction.atomic():
+            recipe = serializer.save(author=self.request.user)
+            shift_counter(
+                User.objects.filter(pk=self.request.user.pk),
+                'recipes_count', 1, updated_at=timezone.now()
+            )
         return recipe
 
+    def perform_destroy(self, instance):
+        deletion.hide_recipe(instance)
+
+    def list(self, request, *args, **kwargs):
+        ordering = request.query_params.get('ordering')
+        if ordering is not None and ordering not in RECIPE_ORDERINGS:
+            return Response(
+                {'errors': 'ordering может быть одним из: '
+                           f'{", ".join(RECIPE_ORDERINGS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return super().list(request, *args, **kwargs)
+
     def get_queryset(self):
         queryset = Recipe.objects.all()
 
@@ -127,16 +314,28 @@ class RecipeViewSet(viewsets.ModelViewSet):
         if author:
             queryset = queryset.filter(author_id=author)
 
-        return queryset.order_by('-pub_date')
+        if self.action in ('list', 'retrieve'):
+            queryset = optimize_recipe_queryset(queryset, self.request)
 
-    def _handle_recipe_action(self, request, pk, model_class, error_message, success_message):
+        ordering = RECIPE_ORDERINGS.get(
+            self.request.query_params.get('ordering'), ('-pub_date',)
+        )
+        return queryset.order_by(*ordering)
+
+    def _handle_recipe_action(self, request, pk, model_class, counter_field,
+                              error_message, success_message):
         recipe = get_object_or_404(Recipe, id=pk)
+        recipes = Recipe.objects.filter(pk=recipe.pk)
         
         if request.method == 'POST':
-            item, created = model_class.objects.get_or_create(
-                user=request.user,
-                recipe=recipe
-            )
+            with transaction.atomic():
+                item, created = model_class.objects.get_or_create(
+                    user=request.user,
+                    recipe=recipe
+                )
+                if created:
+                    shift_counter(recipes, counter_field, 1)
+                    touch_user(request.user)
             if not created:
                 return Response(
                     {'errors': error_message},
@@ -148,7 +347,10 @@ class RecipeViewSet(viewsets.ModelViewSet):
             )
             
         item = get_object_or_404(model_class, user=request.user, recipe=recipe)
-        item.delete()
+        with transaction.atomic():
+            item.delete()
+            shift_counter(recipes, counter_field, -1)
+            touch_user(request.user)
         return Response(
             {'message': f'Рецепт удален из {success_message.lower()}'},
             status=status.HTTP_204_NO_CONTENT
@@ -160,6 +362,7 @@ class RecipeViewSet(viewsets.ModelViewSet):
             request,
             pk,
             ShoppingCart,
+            'carts_count',
             'Рецепт уже в списке покупок',
             'Рецепт добавлен в список покупок'
         )
@@ -170,20 +373,157 @@ class RecipeViewSet(viewsets.ModelViewSet):
             request,
             pk,
             Favorite,
+            'favorites_count',
             'Рецепт уже в избранном',
             'Рецепт добавлен в избранное'
         )
 
+    @action(detail=False, methods=['get'])
+    def trending(self, request):
+        recipes = optimize_recipe_queryset(
+            Recipe.objects.filter(trending__isnull=False), request
+        ).order_by('trending__rank')
+        page = self.paginate_queryset(recipes)
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+        # Рейтинг меняется только при запуске update_trending
+        patch_cache_control(
+            response,
+            max_age=settings.TRENDING_CACHE_SECONDS,
+            private=request.user.is_authenticated
+        )
+        patch_vary_headers(response, ['Authorization'])
+        return response
+
+    @action(detail=False, methods=['get'])
+    def pantry(self, request):
+        try:
+            ingredients = request.query_params.get('ingredients', '')
+            ingredient_ids = [
+                int(value) for value in ingredients.split(',') if value
+            ]
+            max_missing = request.query_params.get('max_missing')
+            max_missing = int(max_missing) if max_missing else None
+        except ValueError:
+            return Response(
+                {'errors': 'Укажите id ингредиентов и max_missing числами'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not ingredient_ids:
+            return Response(
+                {'errors': 'Укажите хотя бы один ингредиент'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if max_missing is not None and max_missing < 0:
+            return Response(
+                {'errors': 'max_missing не может быть отрицательным'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        ordering = request.query_params.get('ordering', pantry.ORDER_MISSING)
+        if ordering not in pantry.ORDERINGS:
+            return Response(
+                {'errors': 'ordering может быть одним из: '
+                           f'{", ".join(pantry.ORDERINGS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        matches = pantry.search(
+            ingredient_ids, max_missing=max_missing, ordering=ordering
+        )
+        page = self.paginate_queryset(matches)
+        recipes = Recipe.objects.in_bulk(
+            [recipe_id for recipe_id, _, _ in page]
+        )
+        results = []
+        for recipe_id, matched_count, missing_count in page:
+            recipe = recipes.get(recipe_id)
+            if recipe is not None:
+                recipe.matched_count = matched_count
+                recipe.missing_count = missing_count
+                results.append(recipe)
+        serializer = PantryRecipeSerializer(
+            results, many=True, context={'request': request}
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'], url_path='by-ids')
+    def by_ids(self, request):
+        try:
+            recipe_ids = [
+                int(value)
+                for value in request.query_params.get('ids', '').split(',')
+                if value
+            ]
+        except ValueError:
+            return Response(
+                {'errors': 'id рецептов должны быть числами'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not recipe_ids:
+            return Response(
+                {'errors': 'Укажите id рецептов в параметре ids'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(recipe_ids) > RECIPES_BY_IDS_LIMIT:
+            return Response(
+                {'errors': (
+                    f'Не больше {RECIPES_BY_IDS_LIMIT} рецептов за запрос'
+                )},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        recipes = optimize_recipe_queryset(
+            Recipe.objects.filter(id__in=recipe_ids), request
+        ).in_bulk()
+        found = [recipes.get(recipe_id) for recipe_id in recipe_ids]
+        serialized = iter(self.get_serializer(
+            [recipe for recipe in found if recipe is not None], many=True
+        ).data)
+        # Порядок ответа совпадает с запросом, ненайденные рецепты — null
+        return Response([
+            next(serialized) if recipe is not None else None
+            for recipe in found
+        ])
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        recipe = get_object_or_404(Recipe, id=pk)
+        try:
+            limit = min(
+                int(request.query_params.get('limit', SIMILAR_RECIPES_LIMIT)),
+                SIMILAR_RECIPES_MAX_LIMIT
+            )
+        except ValueError:
+            limit = SIMILAR_RECIPES_LIMIT
+        similar_ids = similarity.get_similar_ids(recipe.id, limit)
+        if similar_ids is None:
+            return Response(
+                {'errors': 'Индекс похожих рецептов строится, повторите '
+                           'запрос позже'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': '60'}
+            )
+        recipes = Recipe.objects.in_bulk(similar_ids)
+        return Response(RecipeMinifiedSerializer(
+            [recipes[id] for id in similar_ids if id in recipes],
+            many=True,
+            context={'request': request}
+        ).data)
+
     @action(detail=True, methods=['get'], url_path='get-link')
     def get_link(self, request, pk=None):
         recipe = get_object_or_404(Recipe, id=pk)
         frontend_url = request.build_absolute_uri(f'/recipes/{recipe.id}/')
         return Response({'short-link': frontend_url})
 
-    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    @action(
+        detail=False, methods=['get'], permission_classes=[IsAuthenticated]
+    )
     def download_shopping_cart(self, request):
         # Получаем ID рецептов из корзины пользователя
-        recipes_in_cart = ShoppingCart.objects.filter(user=request.user).values_list('recipe', flat=True)
+        recipes_in_cart = ShoppingCart.objects.filter(
+            user=request.user, recipe__deleted_at__isnull=True
+        ).values_list('recipe', flat=True)
 
         if not recipes_in_cart:
             return Response(
@@ -226,6 +566,7 @@ class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = IngredientSerializer
     permission_classes = [AllowAny]
     pagination_class = None
+    throttle_scope = 'ingredients'
 
     def get_queryset(self):
         queryset = Ingredient.objects.all()
@@ -235,3 +576,32 @@ class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
             queryset = queryset.filter(name__istartswith=name)
             
         return queryset.order_by('name')
+
+    def list(self, request, *args, **kwargs):
+        ingredients = INGREDIENT_CATALOG.get_or_set('all', lambda: list(
+            IngredientSerializer(
+                Ingredient.objects.order_by('name'), many=True
+            ).data
+        ))
+        name = request.query_params.get('name')
+        if name:
+            # Как name__istartswith в PostgreSQL (UPPER ... LIKE)
+            prefix = name.upper()
+            ingredients = [
+                ingredient for ingredient in ingredients
+                if ingredient['name'].upper().startswith(prefix)
+            ]
+        return Response(ingredients)
+
+
+def metrics_view(request):
+    # Без METRICS_TOKEN эндпоинт отключен
+    expected = f'Bearer {settings.METRICS_TOKEN}'
+    if not settings.METRICS_TOKEN or not constant_time_compare(
+        request.META.get('HTTP_AUTHORIZATION', ''), expected
+    ):
+        raise Http404
+    return HttpResponse(
+        registry.exposition(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
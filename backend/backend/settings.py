@@ -31,12 +31,15 @@ ALLOWED_HOSTS = ['localhost', '127.0.0.1', os.getenv('ALLOWED_HOSTS')]
 INSTALLED_APPS = [
     'recipes.apps.RecipesConfig',
     'api.apps.ApiConfig',
+    'tasks.apps.TasksConfig',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # OpClass в функциональных индексах (recipes.models.Ingredient)
+    'django.contrib.postgres',
     'corsheaders',
     'rest_framework',
     'rest_framework.authtoken',
@@ -44,14 +47,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    # Запросы к /api/ с токеном пропускают сессии, CSRF, сообщения и
+    # X-Frame-Options (см. api/middleware.py)
+    'api.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.middleware.CsrfViewMiddleware',
+    'api.middleware.AuthenticationMiddleware',
+    'api.middleware.MessageMiddleware',
+    'api.middleware.XFrameOptionsMiddleware',
+    'api.profiling.ProfilingMiddleware',
 ]
 
 CORS_URLS_REGEX = r'^/api/.*$'
@@ -149,6 +156,17 @@ STATIC_ROOT = BASE_DIR / 'collected_static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Загруженные изображения хранятся под хешем содержимого
+# (см. recipes/storage.py, осиротевшие файлы удаляет gc_media)
+STORAGES = {
+    'default': {
+        'BACKEND': 'recipes.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
 # File upload settings
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
@@ -170,7 +188,112 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 6,
+    # Корзины токенов клиента (см. api/throttling.py): общие 'user'
+    # и 'anon' и дополнительные для областей view
+    'DEFAULT_THROTTLE_CLASSES': [
+        'api.throttling.ApiThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'user': os.getenv('THROTTLE_USER_RATE', '600/min'),
+        'anon': os.getenv('THROTTLE_ANON_RATE', '300/min'),
+        'ingredients': '120/min',
+        'uploads': '30/min',
+        'exports': '10/min',
+    },
+}
+
+# Профилирование запросов к API (см. api/profiling.py)
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0.01))
+PROFILING_DIR = os.getenv('PROFILING_DIR', BASE_DIR / 'profiles')
+PROFILING_MAX_FILES = int(os.getenv('PROFILING_MAX_FILES', 10))
+PROFILING_FLUSH_EVERY = 20
+PROFILING_FLUSH_INTERVAL = 60
+PROFILING_TOKEN_MAX_AGE = 60 * 60
+
+# Метрики Prometheus (см. api/metrics.py)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False') == 'True'
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/foodgram_metrics')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Рейтинг популярных рецептов (см. update_trending)
+TRENDING_HALF_LIFE_HOURS = 48
+TRENDING_INITIAL_WINDOW_DAYS = 7
+# Дольше этого транзакция с добавлением в избранное не выполняется
+TRENDING_COMMIT_LAG_SECONDS = 300
+TRENDING_WEIGHTS = {'favorite': 1.0, 'cart': 0.5, 'publish': 2.0}
+TRENDING_MIN_SCORE = 0.01
+TRENDING_SIZE = 500
+TRENDING_CACHE_SECONDS = 300
+
+# Индекс похожих рецептов (см. recipes/similarity.py)
+SIMILARITY_DIR = os.getenv('SIMILARITY_DIR', BASE_DIR / 'similarity')
+
+# Поиск рецептов по продуктам (см. recipes/pantry.py)
+PANTRY_DIR = os.getenv('PANTRY_DIR', BASE_DIR / 'pantry')
+PANTRY_LOG_MAX_BYTES = 1024 * 1024
+
+# Фоновое удаление пользователей и рецептов (purge_deleted):
+# строк в одной порции DELETE
+DELETION_CHUNK_SIZE = int(os.getenv('DELETION_CHUNK_SIZE', 1000))
+
+# Очередь фоновых задач (run_workers): пул по умолчанию, число
+# одновременных задач, интервал опроса, попытки и задержка повтора
+# (удваивается с каждой попыткой), через сколько секунд без продления
+# задача упавшего обработчика возвращается в очередь и как часто
+# обработчик продлевает свои задачи
+TASKS_POOL = os.getenv('TASKS_POOL', 'thread')
+TASKS_CONCURRENCY = int(os.getenv('TASKS_CONCURRENCY', 4))
+TASKS_POLL_INTERVAL = 1
+TASKS_MAX_ATTEMPTS = 5
+TASKS_RETRY_DELAY = 10
+TASKS_MAX_RETRY_DELAY = 3600
+TASKS_LOCK_TIMEOUT = 600
+TASKS_HEARTBEAT_INTERVAL = 30
+
+# Шина сброса кешей воркеров (api/cachebus.py): кольцевой буфер в общей
+# памяти машины или, если воркеры на разных машинах, таблица в БД
+# с опросом раз в CACHE_BUS_POLL_INTERVAL секунд
+CACHE_BUS_TRANSPORT = os.getenv('CACHE_BUS_TRANSPORT', 'mmap')
+CACHE_BUS_PATH = os.getenv('CACHE_BUS_PATH', '/tmp/foodgram_cachebus')
+CACHE_BUS_SIZE = 4096
+CACHE_BUS_POLL_INTERVAL = 1
+
+# POST /api/batch/: максимум подзапросов в пакете и потоков
+# для параллельного выполнения подряд идущих GET (каждый поток открывает
+# своё соединение с БД и закрывает его после подзапроса)
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_WORKERS = 4
+
+# Поток событий /api/events/ (api/events.py): размер очереди подключения,
+# после переполнения которой клиент отключается, интервалы опроса шины
+# и пинга в секундах, пауза перед переподключением клиента в мс
+# и предел подключений на процесс
+EVENTS_QUEUE_SIZE = 100
+EVENTS_POLL_INTERVAL = 1
+EVENTS_HEARTBEAT_INTERVAL = 15
+EVENTS_RETRY_MS = 3000
+EVENTS_MAX_CONNECTIONS = int(os.getenv('EVENTS_MAX_CONNECTIONS', 10000))
+# Срок билета подключения к потоку событий: переподключение EventSource
+# после истечения получает 401, и клиент запрашивает новый билет
+EVENTS_TICKET_MAX_AGE = 3600
+
+# Ограничение частоты запросов (api/throttling.py): таблица корзин в общей
+# памяти машины, стоимость запроса области в токенах общей корзины,
+# предел одновременных запросов клиента и через сколько секунд
+# незакрытое место считается освободившимся
+THROTTLE_ENABLED = os.getenv('THROTTLE_ENABLED', 'True') == 'True'
+THROTTLE_PATH = os.getenv('THROTTLE_PATH', '/tmp/foodgram_throttle')
+THROTTLE_SLOTS = 16384
+THROTTLE_COSTS = {
+    'uploads': 10,
+    'exports': 20,
+}
+THROTTLE_CONCURRENCY = {
+    'uploads': 2,
+    'exports': 1,
 }
+THROTTLE_CONCURRENCY_TIMEOUT = 300
 
 DJOSER = {
     'LOGIN_FIELD': 'email',
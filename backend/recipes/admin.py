@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Recipe, Ingredient, RecipeIngredient
+from .models import User, Recipe, Ingredient, RecipeIngredient, Deletion
+from . import deletion
 from django.utils.safestring import mark_safe
 from statistics import quantiles
 
@@ -70,8 +71,36 @@ class CookingTimeFilter(admin.SimpleListFilter):
             return queryset.filter(cooking_time__gt=q2_value)
         return queryset
 
+
+class DeferredDeletionAdmin(admin.ModelAdmin):
+    """Удаление только скрывает объекты, строки удаляет purge_deleted."""
+
+    hide_object = None
+
+    def get_deleted_objects(self, objs, request):
+        # Обход каскада для страницы подтверждения загружал бы все
+        # зависимые строки в память
+        objs = list(objs)
+        return (
+            [str(obj) for obj in objs],
+            {self.opts.verbose_name_plural: len(objs)},
+            set(),
+            []
+        )
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(deleted_at__isnull=True)
+
+    def delete_model(self, request, obj):
+        self.hide_object(obj)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            self.hide_object(obj)
+
+
 @admin.register(User)
-class UserAdmin(UserAdmin):
+class UserAdmin(DeferredDeletionAdmin, UserAdmin):
     list_display = (
         'id', 'username', 'get_full_name', 'email',
         'get_avatar', 'get_recipes_count',
@@ -81,6 +110,7 @@ class UserAdmin(UserAdmin):
     search_fields = ('username', 'email', 'first_name', 'last_name')
     ordering = ('username',)
     filter_horizontal = ('groups', 'user_permissions',)
+    hide_object = staticmethod(deletion.hide_user)
 
     @admin.display(description='ФИО')
     def get_full_name(self, obj):
@@ -95,7 +125,7 @@ class UserAdmin(UserAdmin):
 
     @admin.display(description='Рецептов')
     def get_recipes_count(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
     @admin.display(description='Подписок')
     def get_subscriptions_count(self, obj):
@@ -103,24 +133,25 @@ class UserAdmin(UserAdmin):
 
     @admin.display(description='Подписчиков')
     def get_subscribers_count(self, obj):
-        return obj.authors.count()
+        return obj.subscribers_count
 
     def get_queryset(self, request):
         return super().get_queryset(request).prefetch_related(
-            'recipes', 'subscriptions', 'authors'
+            'subscriptions'
         )
 
 @admin.register(Recipe)
-class RecipeAdmin(admin.ModelAdmin):
+class RecipeAdmin(DeferredDeletionAdmin):
     list_display = ('id', 'name', 'cooking_time', 'author', 'get_favorites_count', 'get_ingredients', 'get_image')
     list_filter = ('author', CookingTimeFilter)
     search_fields = ('name', 'author__username')
     inlines = [RecipeIngredientInline]
-    readonly_fields = ('get_favorites_count',)
+    readonly_fields = ('favorites_count', 'carts_count')
+    hide_object = staticmethod(deletion.hide_recipe)
 
     @admin.display(description='В избранном')
     def get_favorites_count(self, recipe):
-        return recipe.in_favorites.count()
+        return recipe.favorites_count
 
     @admin.display(description='Продукты')
     @mark_safe
@@ -151,3 +182,12 @@ class IngredientAdmin(admin.ModelAdmin):
     def get_recipes_count(self, obj):
         return obj.recipe_ingredients.count()
 
+
+@admin.register(Deletion)
+class DeletionAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'object_id', 'step', 'deleted_rows', 'created_at')
+    list_filter = ('kind',)
+    readonly_fields = list_display
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,152 @@
+"""Фоновое удаление пользователей и рецептов.
+
+Удаление из API или админки только скрывает объект (deleted_at), ставит
+задачу Deletion и фоновую задачу purge. Она (или команда purge_deleted,
+подбирающая пропущенное) удаляет зависимые строки порциями
+по DELETION_CHUNK_SIZE запросами DELETE ... WHERE id IN (SELECT ... LIMIT n),
+каждая порция — в своей короткой транзакции. Номер шага и число удалённых
+строк сохраняются после каждой порции, поэтому прерванное удаление
+продолжается с того же шага.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from api.cachebus import publish_on_commit
+from tasks.queue import task
+
+from .indexes import recipe_changed
+from .models import (
+    Deletion, Favorite, Recipe, RecipeIngredient, RecipeTrending,
+    ShoppingCart, Subscription, User
+)
+
+
+def hide_user(user):
+    now = timezone.now()
+    with transaction.atomic():
+        hidden = User.all_objects.filter(
+            pk=user.pk, deleted_at__isnull=True
+        ).update(deleted_at=now, is_active=False)
+        if not hidden:
+            return
+        # Счетчики связанных объектов обновляются сразу, а не при очистке
+        User.objects.filter(authors__user=user).update(
+            subscribers_count=F('subscribers_count') - 1
+        )
+        Recipe.objects.filter(in_favorites__user=user).update(
+            favorites_count=F('favorites_count') - 1
+        )
+        Recipe.objects.filter(in_shopping_carts__user=user).update(
+            carts_count=F('carts_count') - 1
+        )
+        recipe_ids = list(
+            Recipe.objects.filter(author=user).values_list('pk', flat=True)
+        )
+        Recipe.objects.filter(pk__in=recipe_ids).update(deleted_at=now)
+        # update() не отправляет сигналы: кеши воркеров и поисковые
+        # индексы узнают о скрытии отсюда
+        publish_on_commit(User, user.pk)
+        publish_on_commit(Recipe)
+        for recipe_id in recipe_ids:
+            recipe_changed(recipe_id)
+        deletion, _ = Deletion.objects.get_or_create(
+            kind=Deletion.USER, object_id=user.pk
+        )
+        purge.delay(deletion.pk)
+
+
+def hide_recipe(recipe):
+    now = timezone.now()
+    with transaction.atomic():
+        hidden = Recipe.objects.filter(pk=recipe.pk).update(deleted_at=now)
+        if not hidden:
+            return
+        User.all_objects.filter(pk=recipe.author_id).update(
+            recipes_count=F('recipes_count') - 1, updated_at=now
+        )
+        publish_on_commit(Recipe, recipe.pk)
+        recipe_changed(recipe.pk)
+        deletion, _ = Deletion.objects.get_or_create(
+            kind=Deletion.RECIPE, object_id=recipe.pk
+        )
+        purge.delay(deletion.pk)
+
+
+def get_steps(deletion):
+    """Querysets зависимых строк в порядке удаления."""
+    if deletion.kind == Deletion.RECIPE:
+        recipe = {'recipe_id': deletion.object_id}
+        return [
+            RecipeIngredient.objects.filter(**recipe),
+            Favorite.objects.filter(**recipe),
+            ShoppingCart.objects.filter(**recipe),
+            RecipeTrending.objects.filter(**recipe),
+        ]
+    recipes = {'recipe__author_id': deletion.object_id}
+    return [
+        RecipeIngredient.objects.filter(**recipes),
+        Favorite.objects.filter(**recipes),
+        ShoppingCart.objects.filter(**recipes),
+        RecipeTrending.objects.filter(**recipes),
+        Recipe.all_objects.filter(author_id=deletion.object_id),
+        Favorite.objects.filter(user_id=deletion.object_id),
+        ShoppingCart.objects.filter(user_id=deletion.object_id),
+        Subscription.objects.filter(user_id=deletion.object_id),
+        Subscription.objects.filter(author_id=deletion.object_id),
+    ]
+
+
+def delete_chunk(queryset, chunk_size):
+    """Удаляет до chunk_size строк queryset и возвращает их первичные ключи."""
+    model = queryset.model
+    select_sql, params = (
+        queryset.order_by().values('pk')[:chunk_size].query.sql_with_params()
+    )
+    table = connection.ops.quote_name(model._meta.db_table)
+    pk = connection.ops.quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} WHERE {pk} IN ({select_sql}) '
+            f'RETURNING {pk}',
+            params
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def process(deletion, chunk_size=None):
+    chunk_size = chunk_size or settings.DELETION_CHUNK_SIZE
+    steps = get_steps(deletion)
+    while deletion.step < len(steps):
+        queryset = steps[deletion.step]
+        while True:
+            deleted = delete_chunk(queryset, chunk_size)
+            if deleted:
+                Deletion.objects.filter(pk=deletion.pk).update(
+                    deleted_rows=F('deleted_rows') + len(deleted)
+                )
+            if queryset.model is Recipe:
+                for recipe_id in deleted:
+                    recipe_changed(recipe_id)
+            if len(deleted) < chunk_size:
+                break
+        deletion.step += 1
+        Deletion.objects.filter(pk=deletion.pk).update(step=deletion.step)
+
+    # Остаток (токены, журнал админки, связи M2M) невелик,
+    # его удаляет обычный каскад Django
+    model = Recipe if deletion.kind == Deletion.RECIPE else User
+    with transaction.atomic():
+        model.all_objects.filter(pk=deletion.object_id).delete()
+        Deletion.objects.filter(pk=deletion.pk).delete()
+    if model is Recipe:
+        recipe_changed(deletion.object_id)
+
+
+@task(priority=-1)
+def purge(deletion_id):
+    deletion = Deletion.objects.filter(pk=deletion_id).first()
+    # Удаление могла уже завершить команда purge_deleted
+    if deletion is not None:
+        process(deletion)
@@ -0,0 +1,17 @@
+from django.db import transaction
+
+from . import pantry, similarity
+
+
+def recipe_changed(recipe_id):
+    """Обновляет поисковые индексы рецепта после фиксации транзакции.
+
+    Ошибка обновления индекса записывается в лог и не превращает
+    уже сохранённое изменение в ответ 500.
+    """
+    transaction.on_commit(
+        lambda: similarity.update_recipe(recipe_id), robust=True
+    )
+    transaction.on_commit(
+        lambda: pantry.record_change(recipe_id), robust=True
+    )
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from recipes import similarity
+
+
+class Command(BaseCommand):
+    help = 'Полностью пересобирает индекс похожих рецептов'
+
+    def handle(self, *args, **options):
+        count = similarity.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Рецептов в индексе: {count}'
+        ))
@@ -0,0 +1,71 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db.models import Prefetch
+
+from recipes.models import Recipe, RecipeIngredient
+
+
+class Command(BaseCommand):
+    help = (
+        'Потоково выгружает рецепты в NDJSON: одна строка на рецепт, '
+        'с автором, продуктами и путём к изображению'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='Файл для выгрузки, по умолчанию stdout'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Количество рецептов, загружаемых из БД за раз'
+        )
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.select_related('author').prefetch_related(
+            Prefetch(
+                'recipe_ingredients',
+                queryset=RecipeIngredient.objects.select_related('ingredient')
+            )
+        ).order_by('id')
+
+        output = (
+            sys.stdout if options['output'] == '-'
+            else open(options['output'], 'w', encoding='utf-8')
+        )
+        exported = 0
+        try:
+            for recipe in recipes.iterator(chunk_size=options['chunk_size']):
+                output.write(json.dumps({
+                    'author': {
+                        'email': recipe.author.email,
+                        'username': recipe.author.username,
+                        'first_name': recipe.author.first_name,
+                        'last_name': recipe.author.last_name,
+                    },
+                    'name': recipe.name,
+                    'text': recipe.text,
+                    'image': recipe.image.name,
+                    'cooking_time': recipe.cooking_time,
+                    'pub_date': recipe.pub_date.isoformat(),
+                    'ingredients': [
+                        {
+                            'name': link.ingredient.name,
+                            'measurement_unit': (
+                                link.ingredient.measurement_unit
+                            ),
+                            'amount': link.amount,
+                        }
+                        for link in recipe.recipe_ingredients.all()
+                    ],
+                }, ensure_ascii=False) + '\n')
+                exported += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write(f'Выгружено рецептов: {exported}')
@@ -0,0 +1,77 @@
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe, User
+from recipes.storage import BLOBS_DIR
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет файлы из media/blobs, на которые не ссылается ни один '
+        'рецепт или пользователь'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-hours',
+            type=float,
+            default=24,
+            help=(
+                'Не удалять файлы моложе указанного возраста: объект, '
+                'ссылающийся на них, может быть ещё не сохранён'
+            )
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, что будет удалено'
+        )
+
+    def is_referenced(self, name):
+        return (
+            Recipe.all_objects.filter(image=name).exists()
+            or User.all_objects.filter(avatar=name).exists()
+        )
+
+    def handle(self, *args, **options):
+        # Скрытые объекты ещё ссылаются на свои файлы
+        references = Counter(
+            Recipe.all_objects.values_list('image', flat=True).iterator()
+        )
+        references.update(
+            User.all_objects.exclude(avatar='').exclude(
+                avatar__isnull=True
+            ).values_list('avatar', flat=True).iterator()
+        )
+
+        root = Path(default_storage.path(BLOBS_DIR))
+        if not root.exists():
+            self.stdout.write('Каталог blobs пуст')
+            return
+        deadline = time.time() - options['grace_hours'] * 3600
+        removed = kept = freed = 0
+        for path in root.glob('*/*/*'):
+            name = path.relative_to(root.parent).as_posix()
+            if references[name] or path.stat().st_mtime > deadline:
+                kept += 1
+                continue
+            # Пока шёл обход, файл могли загрузить повторно и сослаться
+            # на него: повторная загрузка обновляет время изменения
+            if path.stat().st_mtime > deadline or self.is_referenced(name):
+                kept += 1
+                continue
+            removed += 1
+            freed += path.stat().st_size
+            if options['dry_run']:
+                self.stdout.write(f'Будет удалён: {name}')
+            else:
+                default_storage.delete_blob(name)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено файлов: {removed} ({freed // 1024} КБ), '
+            f'оставлено: {kept}'
+        ))
@@ -0,0 +1,199 @@
+import json
+import os
+from itertools import count
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from api.cachebus import bus
+from recipes import pantry, similarity
+from recipes.models import Ingredient, Recipe, RecipeIngredient, User
+
+
+class Command(BaseCommand):
+    help = (
+        'Загружает рецепты из NDJSON, созданного export_recipes, пакетами '
+        'в отдельных транзакциях. После каждого пакета позиция во входном '
+        'файле сохраняется в файл контрольной точки, поэтому прерванный '
+        'импорт можно продолжить. Файлы изображений не копируются: '
+        'каталог media переносится отдельно.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='Файл NDJSON')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Количество рецептов в одной транзакции'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Файл контрольной точки, по умолчанию <input>.checkpoint'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Игнорировать сохранённую контрольную точку'
+        )
+
+    def handle(self, *args, **options):
+        path = Path(options['input'])
+        if not path.is_file():
+            raise CommandError(f'Файл {path} не найден')
+        checkpoint = Path(
+            options['checkpoint'] or f'{path}.checkpoint'
+        )
+        offset = 0
+        if checkpoint.exists() and not options['restart']:
+            offset = int(checkpoint.read_text())
+            self.stdout.write(f'Продолжение с позиции {offset}')
+        total_size = path.stat().st_size
+
+        self.ingredients = {
+            (name, unit): ingredient_id
+            for ingredient_id, name, unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit'
+            )
+        }
+        imported = 0
+
+        with open(path, 'rb') as source:
+            source.seek(offset)
+            batch = []
+            for line in source:
+                offset += len(line)
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) >= options['batch_size']:
+                    imported += self.import_batch(batch)
+                    self.save_checkpoint(checkpoint, offset)
+                    self.stdout.write(
+                        f'Импортировано рецептов: {imported} '
+                        f'({offset * 100 // max(total_size, 1)}%)'
+                    )
+                    batch = []
+            if batch:
+                imported += self.import_batch(batch)
+                self.save_checkpoint(checkpoint, offset)
+
+        checkpoint.unlink(missing_ok=True)
+        call_command('recount_counters', stdout=self.stdout)
+        similarity.rebuild()
+        pantry.invalidate()
+        # bulk_create и update не отправляют сигналы моделей
+        bus.publish_all()
+        self.stdout.write(self.style.SUCCESS(
+            f'Импорт завершён, рецептов: {imported}'
+        ))
+
+    def save_checkpoint(self, checkpoint, offset):
+        tmp_path = checkpoint.with_suffix('.tmp')
+        tmp_path.write_text(str(offset))
+        os.replace(tmp_path, checkpoint)
+
+    @transaction.atomic
+    def import_batch(self, batch):
+        authors = self.get_authors(batch)
+        # Рецепты пользователей, ожидающих удаления, не импортируются
+        batch = [
+            item for item in batch
+            if authors[item['author']['email']].deleted_at is None
+        ]
+        self.create_missing_ingredients(batch)
+
+        # Рецепты могли быть сохранены прерванным или повторным импортом
+        existing = set(Recipe.all_objects.filter(
+            author__in=authors.values(),
+            pub_date__in=[parse_datetime(item['pub_date']) for item in batch]
+        ).values_list('author_id', 'name', 'pub_date'))
+        batch = [
+            item for item in batch
+            if (
+                authors[item['author']['email']].id,
+                item['name'],
+                parse_datetime(item['pub_date'])
+            ) not in existing
+        ]
+
+        recipes = Recipe.objects.bulk_create(
+            Recipe(
+                author=authors[item['author']['email']],
+                name=item['name'],
+                text=item['text'],
+                image=item['image'],
+                cooking_time=item['cooking_time'],
+                pub_date=parse_datetime(item['pub_date']),
+            )
+            for item in batch
+        )
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
+                recipe=recipe,
+                ingredient_id=self.ingredients[
+                    (ingredient['name'], ingredient['measurement_unit'])
+                ],
+                amount=ingredient['amount'],
+            )
+            for recipe, item in zip(recipes, batch)
+            for ingredient in item['ingredients']
+        )
+        return len(recipes)
+
+    def get_authors(self, batch):
+        data = {item['author']['email']: item['author'] for item in batch}
+        authors = {
+            user.email: user
+            for user in User.all_objects.filter(email__in=data)
+        }
+        missing = [
+            author for email, author in data.items() if email not in authors
+        ]
+        taken = set(User.all_objects.filter(
+            username__in=[author['username'] for author in missing]
+        ).values_list('username', flat=True))
+        users = []
+        for author in missing:
+            user = User(**author)
+            user.username = self.free_username(author['username'], taken)
+            if user.username != author['username']:
+                self.stdout.write(
+                    f'Никнейм {author["username"]} занят, {user.email} '
+                    f'импортирован как {user.username}'
+                )
+            taken.add(user.username)
+            user.set_unusable_password()
+            users.append(user)
+        for user in User.objects.bulk_create(users):
+            authors[user.email] = user
+        return authors
+
+    def free_username(self, username, taken):
+        """Никнейм, не занятый в базе и в текущем пакете."""
+        if username not in taken:
+            return username
+        max_length = User._meta.get_field('username').max_length
+        for number in count(2):
+            suffix = f'-{number}'
+            candidate = username[:max_length - len(suffix)] + suffix
+            if candidate not in taken and not User.all_objects.filter(
+                username=candidate
+            ).exists():
+                return candidate
+
+    def create_missing_ingredients(self, batch):
+        missing = {
+            (ingredient['name'], ingredient['measurement_unit'])
+            for item in batch
+            for ingredient in item['ingredients']
+        } - self.ingredients.keys()
+        for ingredient in Ingredient.objects.bulk_create(
+            Ingredient(name=name, measurement_unit=unit)
+            for name, unit in missing
+        ):
+            self.ingredients[
+                (ingredient.name, ingredient.measurement_unit)
+            ] = ingredient.id
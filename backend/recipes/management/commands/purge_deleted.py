@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from recipes import deletion
+from recipes.models import Deletion
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет скрытых пользователей и рецепты вместе с зависимыми '
+        'строками порциями. Прерванное удаление продолжается с того же '
+        'шага. Запускается периодически, например из cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            help='Строк в одной порции, по умолчанию DELETION_CHUNK_SIZE'
+        )
+
+    def handle(self, *args, **options):
+        pending = list(Deletion.objects.all())
+        if not pending:
+            self.stdout.write('Нет объектов, ожидающих удаления')
+            return
+        for task in pending:
+            self.stdout.write(
+                f'{task}: шаг {task.step}, удалено строк {task.deleted_rows}'
+            )
+            deletion.process(task, options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено объектов: {len(pending)}'
+        ))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Recipe, ShoppingCart, Subscription, User
+
+
+def count_subquery(queryset, field):
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(total=Count('pk'))
+            .values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def visible_users(model):
+    # Связи скрытых пользователей уже вычтены из счетчиков при скрытии
+    return model.objects.filter(user__deleted_at__isnull=True)
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает денормализованные счетчики рецептов и пользователей'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            recipes = Recipe.objects.update(
+                favorites_count=count_subquery(
+                    visible_users(Favorite), 'recipe'
+                ),
+                carts_count=count_subquery(
+                    visible_users(ShoppingCart), 'recipe'
+                ),
+            )
+            users = User.objects.update(
+                recipes_count=count_subquery(Recipe.objects, 'author'),
+                subscribers_count=count_subquery(
+                    visible_users(Subscription), 'author'
+                ),
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано рецептов: {recipes}, пользователей: {users}'
+        ))
@@ -0,0 +1,100 @@
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from recipes.models import (
+    Favorite, Recipe, RecipeTrending, ShoppingCart, TrendingState
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Обновляет рейтинг популярных рецептов. Учитываются только события '
+        'с момента прошлого запуска, накопленные очки экспоненциально '
+        'затухают. Запускается периодически, например из cron.'
+    )
+
+    def handle(self, *args, **options):
+        # Время события ставится до фиксации транзакции, поэтому события
+        # моложе TRENDING_COMMIT_LAG_SECONDS ждут следующего запуска:
+        # иначе ещё не зафиксированные строки оказались бы за отметкой
+        until = timezone.now() - timedelta(
+            seconds=settings.TRENDING_COMMIT_LAG_SECONDS
+        )
+        decay_rate = math.log(2) / (settings.TRENDING_HALF_LIFE_HOURS * 3600)
+
+        with transaction.atomic():
+            state = TrendingState.objects.select_for_update().first()
+            if state is None:
+                state = TrendingState(
+                    processed_until=until - timedelta(
+                        days=settings.TRENDING_INITIAL_WINDOW_DAYS
+                    )
+                )
+            since = state.processed_until
+
+            contributions = {}
+            weights = settings.TRENDING_WEIGHTS
+            sources = (
+                (Favorite.objects, 'recipe_id', 'added', weights['favorite']),
+                (ShoppingCart.objects, 'recipe_id', 'added', weights['cart']),
+                (Recipe.objects, 'id', 'pub_date', weights['publish']),
+            )
+            for manager, recipe_field, time_field, weight in sources:
+                events = manager.filter(**{
+                    f'{time_field}__gt': since,
+                    f'{time_field}__lte': until,
+                }).values_list(recipe_field, time_field)
+                for recipe_id, happened in events.iterator(chunk_size=2000):
+                    age = (until - happened).total_seconds()
+                    contributions[recipe_id] = (
+                        contributions.get(recipe_id, 0.0)
+                        + weight * math.exp(-decay_rate * age)
+                    )
+
+            # Таблица рейтинга компактна, поэтому пересобирается целиком;
+            # затухают только очки, сохранённые прошлым запуском
+            decay = math.exp(-decay_rate * (until - since).total_seconds())
+            scores = {
+                recipe_id: score * decay for recipe_id, score
+                in RecipeTrending.objects.values_list('recipe_id', 'score')
+            }
+            for recipe_id, contribution in contributions.items():
+                scores[recipe_id] = scores.get(recipe_id, 0.0) + contribution
+
+            # Рецепты, удалённые или скрытые после события, в рейтинг
+            # не попадают
+            live_ids = set(
+                Recipe.objects.filter(id__in=scores).values_list(
+                    'id', flat=True
+                )
+            )
+            ranking = sorted(
+                (
+                    (score, recipe_id) for recipe_id, score in scores.items()
+                    if recipe_id in live_ids
+                    and score >= settings.TRENDING_MIN_SCORE
+                ),
+                reverse=True
+            )[:settings.TRENDING_SIZE]
+
+            RecipeTrending.objects.all().delete()
+            RecipeTrending.objects.bulk_create(
+                (
+                    RecipeTrending(recipe_id=recipe_id, score=score, rank=rank)
+                    for rank, (score, recipe_id) in enumerate(ranking, 1)
+                ),
+                batch_size=1000
+            )
+
+            state.processed_until = until
+            state.save()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Рецептов с новыми событиями: {len(contributions)}, '
+            f'в рейтинге: {len(ranking)}'
+        ))
@@ -1,5 +1,7 @@
 from django.db import models
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
+from django.contrib.postgres.indexes import OpClass
+from django.db.models.functions import Upper
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator, MinValueValidator
 import re
@@ -11,6 +13,18 @@ def validate_image(value):
         raise ValidationError('Загруженный файл должен быть изображением')
 
 
+class VisibleUserManager(UserManager):
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
+class VisibleManager(models.Manager):
+    """Скрывает объекты, ожидающие фонового удаления."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class User(AbstractUser):
     email = models.EmailField(
         max_length=254,
@@ -42,18 +56,36 @@ class User(AbstractUser):
         null=True,
         verbose_name='Аватар'
     )
-    shopping_carts = models.ManyToManyField(
-        'ShoppingCart',
-        related_name='users',
+    recipes_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество рецептов'
+    )
+    subscribers_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество подписчиков'
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Дата изменения'
+    )
+    deleted_at = models.DateTimeField(
+        null=True,
         blank=True,
-        verbose_name='Списки покупок'
+        editable=False,
+        verbose_name='Дата удаления'
     )
 
+    objects = VisibleUserManager()
+    all_objects = UserManager()
+
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('username', 'first_name', 'last_name')
 
     class Meta:
         ordering = ['username']
+        # Проверки уникальности (UniqueValidator DRF, формы) должны видеть
+        # скрытых пользователей: их email и никнейм ещё заняты
+        default_manager_name = 'all_objects'
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
 
@@ -66,6 +98,8 @@ class Recipe(models.Model):
         User,
         on_delete=models.CASCADE,
         related_name='recipes',
+        # Поиск по автору покрывает индекс recipe_author_pub_date_idx
+        db_index=False,
         verbose_name='Автор'
     )
     name = models.CharField(
@@ -92,11 +126,47 @@ class Recipe(models.Model):
         default=timezone.now,
         verbose_name='Дата публикации'
     )
+    favorites_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='В избранном'
+    )
+    carts_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='В списках покупок'
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Дата изменения'
+    )
+    deleted_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name='Дата удаления'
+    )
+
+    objects = VisibleManager()
+    all_objects = models.Manager()
 
     class Meta:
         ordering = ['-pub_date']
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(fields=['-pub_date'], name='recipe_pub_date_idx'),
+            models.Index(
+                fields=['author', '-pub_date'],
+                name='recipe_author_pub_date_idx'
+            ),
+            models.Index(
+                fields=['-favorites_count', '-pub_date'],
+                name='recipe_popular_idx'
+            ),
+            models.Index(
+                fields=['cooking_time', '-pub_date'],
+                name='recipe_cooking_time_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -120,6 +190,14 @@ class Ingredient(models.Model):
                 name='unique_ingredient'
             )
         ]
+        indexes = [
+            # Для name__istartswith: UPPER(name) LIKE 'ПРЕФИКС%'
+            # при любой сортировке (collation) базы
+            models.Index(
+                OpClass(Upper('name'), name='varchar_pattern_ops'),
+                name='ingredient_name_upper_idx'
+            ),
+        ]
 
     def __str__(self):
         return f'{self.name}, {self.measurement_unit}'
@@ -244,3 +322,81 @@ class Subscription(models.Model):
 
     def __str__(self):
         return f'{self.user.username} -> {self.author.username}'
+
+
+class RecipeTrending(models.Model):
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='trending',
+        verbose_name='Рецепт'
+    )
+    score = models.FloatField(verbose_name='Рейтинг')
+    rank = models.PositiveIntegerField(
+        db_index=True,
+        verbose_name='Место'
+    )
+
+    class Meta:
+        ordering = ['rank']
+        verbose_name = 'Популярный рецепт'
+        verbose_name_plural = 'Популярные рецепты'
+
+    def __str__(self):
+        return f'{self.rank}. {self.recipe_id} ({self.score:.2f})'
+
+
+class TrendingState(models.Model):
+    processed_until = models.DateTimeField(
+        verbose_name='События учтены до'
+    )
+
+    class Meta:
+        verbose_name = 'Состояние рейтинга'
+        verbose_name_plural = 'Состояние рейтинга'
+
+    def __str__(self):
+        return f'{self.processed_until:%d.%m.%Y %H:%M}'
+
+
+class Deletion(models.Model):
+    USER = 'user'
+    RECIPE = 'recipe'
+    KIND_CHOICES = (
+        (USER, 'Пользователь'),
+        (RECIPE, 'Рецепт'),
+    )
+
+    kind = models.CharField(
+        max_length=10,
+        choices=KIND_CHOICES,
+        verbose_name='Тип объекта'
+    )
+    object_id = models.PositiveBigIntegerField(verbose_name='ID объекта')
+    step = models.PositiveSmallIntegerField(
+        default=0,
+        verbose_name='Текущий шаг'
+    )
+    deleted_rows = models.PositiveBigIntegerField(
+        default=0,
+        verbose_name='Удалено строк'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Дата постановки'
+    )
+
+    class Meta:
+        ordering = ['created_at']
+        verbose_name = 'Удаление'
+        verbose_name_plural = 'Удаления'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'object_id'],
+                name='unique_deletion'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.object_id}'
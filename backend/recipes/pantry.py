@@ -0,0 +1,183 @@
+"""Поиск рецептов по имеющимся продуктам.
+
+Каждый воркер держит в памяти инвертированный индекс: для ингредиента —
+отсортированный массив строк рецептов, в которых он встречается.
+Изменения рецептов дописываются в общий журнал PANTRY_DIR/changes.log;
+воркер перед поиском дочитывает журнал и точечно обновляет индекс.
+При ротации журнала (смене inode) индекс строится заново.
+"""
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+from .models import RecipeIngredient
+
+ORDER_MISSING = 'missing'
+ORDER_COVERAGE = 'coverage'
+ORDERINGS = (ORDER_MISSING, ORDER_COVERAGE)
+
+_state = {'index': None, 'inode': None, 'offset': 0}
+_lock = threading.Lock()
+
+
+class PantryIndex:
+    def __init__(self):
+        self.rows = {}
+        self.recipe_ids = np.zeros(0, dtype=np.int64)
+        self.sizes = np.zeros(0, dtype=np.int32)
+        self.recipe_ingredients = {}
+        self.postings = {}
+
+    @classmethod
+    def build(cls, links):
+        index = cls()
+        recipes = {}
+        for recipe_id, ingredient_id in links:
+            recipes.setdefault(recipe_id, []).append(ingredient_id)
+
+        index.recipe_ids = np.fromiter(recipes, dtype=np.int64)
+        index.sizes = np.fromiter(map(len, recipes.values()), dtype=np.int32)
+        postings = {}
+        for row, (recipe_id, ingredient_ids) in enumerate(recipes.items()):
+            index.rows[recipe_id] = row
+            index.recipe_ingredients[recipe_id] = frozenset(ingredient_ids)
+            for ingredient_id in ingredient_ids:
+                postings.setdefault(ingredient_id, []).append(row)
+        # Строки добавлялись по возрастанию, массивы уже отсортированы
+        index.postings = {
+            ingredient_id: np.array(rows, dtype=np.int64)
+            for ingredient_id, rows in postings.items()
+        }
+        return index
+
+    def update(self, recipe_id, ingredient_ids):
+        new = frozenset(ingredient_ids)
+        old = self.recipe_ingredients.pop(recipe_id, frozenset())
+        row = self.rows.get(recipe_id)
+        if row is None:
+            if not new:
+                return
+            row = len(self.recipe_ids)
+            self.rows[recipe_id] = row
+            self.recipe_ids = np.append(self.recipe_ids, recipe_id)
+            self.sizes = np.append(self.sizes, 0)
+
+        for ingredient_id in old - new:
+            rows = self.postings[ingredient_id]
+            self.postings[ingredient_id] = np.delete(
+                rows, np.searchsorted(rows, row)
+            )
+        for ingredient_id in new - old:
+            rows = self.postings.get(
+                ingredient_id, np.zeros(0, dtype=np.int64)
+            )
+            self.postings[ingredient_id] = np.insert(
+                rows, np.searchsorted(rows, row), row
+            )
+        self.sizes[row] = len(new)
+        if new:
+            self.recipe_ingredients[recipe_id] = new
+
+    def search(self, ingredient_ids, max_missing=None, ordering=ORDER_MISSING):
+        """Список (id рецепта, есть продуктов, не хватает продуктов)."""
+        postings = [
+            self.postings[ingredient_id]
+            for ingredient_id in set(ingredient_ids)
+            if ingredient_id in self.postings
+        ]
+        if not postings:
+            return []
+        have = np.bincount(
+            np.concatenate(postings), minlength=len(self.sizes)
+        )
+        rows = np.flatnonzero(have)
+        have = have[rows]
+        missing = self.sizes[rows] - have
+        if max_missing is not None:
+            keep = missing <= max_missing
+            rows, have, missing = rows[keep], have[keep], missing[keep]
+
+        if ordering == ORDER_COVERAGE:
+            order = np.lexsort((missing, -have / self.sizes[rows]))
+        else:
+            order = np.lexsort((-have, missing))
+        return list(zip(
+            self.recipe_ids[rows[order]].tolist(),
+            have[order].tolist(),
+            missing[order].tolist()
+        ))
+
+
+def _log_path():
+    return Path(settings.PANTRY_DIR) / 'changes.log'
+
+
+def record_change(recipe_id):
+    """Дописывает изменённый рецепт в журнал, общий для всех воркеров."""
+    path = _log_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if path.stat().st_size > settings.PANTRY_LOG_MAX_BYTES:
+            invalidate()
+            return
+    except FileNotFoundError:
+        pass
+    with open(path, 'a') as log:
+        log.write(f'{recipe_id}\n')
+
+
+def invalidate():
+    """Заменяет журнал новым файлом: воркеры перестроят индекс целиком."""
+    path = _log_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text('')
+    os.replace(tmp_path, path)
+
+
+def _ingredients_by_recipe(recipe_ids=None):
+    # Скрытые рецепты ждут удаления и в индекс не попадают
+    links = RecipeIngredient.objects.filter(
+        recipe__deleted_at__isnull=True
+    ).order_by('recipe_id', 'ingredient_id')
+    if recipe_ids is not None:
+        links = links.filter(recipe_id__in=recipe_ids)
+    return links.values_list('recipe_id', 'ingredient_id').iterator(
+        chunk_size=5000
+    )
+
+
+def get_index():
+    path = _log_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    inode = os.stat(path).st_ino
+
+    if _state['index'] is None or _state['inode'] != inode:
+        # Смещение берётся до построения: изменения, сделанные во время
+        # построения, будут повторно применены ниже, что безопасно
+        _state['offset'] = path.stat().st_size
+        _state['index'] = PantryIndex.build(_ingredients_by_recipe())
+        _state['inode'] = inode
+
+    with open(path, 'rb') as log:
+        log.seek(_state['offset'])
+        data = log.read()
+    complete = data.rfind(b'\n') + 1
+    if complete:
+        _state['offset'] += complete
+        recipe_ids = {int(line) for line in data[:complete].split()}
+        changed = {recipe_id: [] for recipe_id in recipe_ids}
+        for recipe_id, ingredient_id in _ingredients_by_recipe(recipe_ids):
+            changed[recipe_id].append(ingredient_id)
+        for recipe_id, ingredient_ids in changed.items():
+            _state['index'].update(recipe_id, ingredient_ids)
+    return _state['index']
+
+
+def search(ingredient_ids, max_missing=None, ordering=ORDER_MISSING):
+    with _lock:
+        return get_index().search(ingredient_ids, max_missing, ordering)
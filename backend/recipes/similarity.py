@@ -0,0 +1,389 @@
+"""Поиск похожих рецептов по совпадению ингредиентов.
+
+Индекс лежит в SIMILARITY_DIR/<поколение>/ и открывается через
+np.load(mmap_mode='r'), поэтому все воркеры gunicorn читают одну копию
+данных из page cache:
+
+- ids.npy — id рецепта в каждой строке;
+- live.npy — 1, если строка актуальна;
+- bits.npy — упакованная в биты матрица рецепт × ингредиент;
+- signatures.npy — MinHash-сигнатуры рецептов;
+- bands.npy — ключи LSH-корзин по BAND_ROWS значений сигнатуры;
+- bucket_keys.npy, bucket_rows.npy — для каждой полосы ключи строк,
+  собранных при построении, в порядке возрастания и номера этих строк;
+- state.npy — число занятых строк.
+
+Строки, собранные при построении, упорядочены по id рецепта, а их корзины
+ищутся двоичным поиском. Сохранённый после построения рецепт дописывается
+в хвост индекса (старая строка помечается неактуальной), хвост
+просматривается целиком. Когда хвост заполнен, индекс пересобирается
+фоновой задачей; до первой сборки похожие рецепты не отдаются.
+Кандидаты отбираются по совпадению хотя бы одной LSH-корзины, затем
+ранжируются по точному коэффициенту Жаккара.
+"""
+import fcntl
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Max
+
+from tasks.queue import task
+
+from .models import Ingredient, RecipeIngredient
+
+NUM_HASHES = 64
+BAND_ROWS = 2
+NUM_BANDS = NUM_HASHES // BAND_ROWS
+MERSENNE_PRIME = (1 << 31) - 1
+MIN_CAPACITY = 1024
+
+# Фиксированное зерно: сигнатуры должны совпадать во всех процессах
+_random = np.random.default_rng(20250501)
+HASH_A = _random.integers(1, MERSENNE_PRIME, NUM_HASHES, dtype=np.uint64)
+HASH_B = _random.integers(0, MERSENNE_PRIME, NUM_HASHES, dtype=np.uint64)
+BAND_MULTIPLIERS = _random.integers(
+    1, 1 << 63, BAND_ROWS, dtype=np.uint64
+) | np.uint64(1)
+
+# Число единичных битов каждого байта
+BYTE_BITS = np.unpackbits(
+    np.arange(256, dtype=np.uint8)[:, None], axis=1
+).sum(axis=1)
+
+ARRAYS = (
+    'ids', 'live', 'bits', 'signatures', 'bands', 'bucket_keys',
+    'bucket_rows', 'state'
+)
+
+_cache = {'generation': None, 'index': None}
+# Поколения, пересборка которых уже запрошена этим процессом
+_requested = set()
+
+
+def _popcount_bytes(values):
+    values = np.ascontiguousarray(values)
+    return BYTE_BITS[values.view(np.uint8)].reshape(
+        *values.shape, values.itemsize
+    ).sum(axis=-1)
+
+
+# np.bitwise_count появился в numpy 2.0
+popcount = getattr(np, 'bitwise_count', _popcount_bytes)
+
+
+def minhash(indices, indptr):
+    """Сигнатуры строк разреженной матрицы в формате CSR."""
+    hashed = (
+        HASH_A[:, None] * indices.astype(np.uint64)[None, :] + HASH_B[:, None]
+    ) % MERSENNE_PRIME
+    return np.minimum.reduceat(hashed, indptr[:-1], axis=1).T.astype(
+        np.uint32
+    )
+
+
+def band_keys(signatures):
+    rows = signatures.reshape(
+        len(signatures), NUM_BANDS, BAND_ROWS
+    ).astype(np.uint64)
+    return (rows * BAND_MULTIPLIERS).sum(axis=2, dtype=np.uint64)
+
+
+def pack_bits(indices, indptr, width):
+    bits = np.zeros((len(indptr) - 1, width), dtype=np.uint64)
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    np.bitwise_or.at(
+        bits,
+        (rows, indices // 64),
+        np.left_shift(np.uint64(1), (indices % 64).astype(np.uint64))
+    )
+    return bits
+
+
+def to_csr(ingredient_lists):
+    lengths = [len(ingredients) for ingredients in ingredient_lists]
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.fromiter(
+        (
+            ingredient_id for ingredients in ingredient_lists
+            for ingredient_id in sorted(ingredients)
+        ),
+        dtype=np.int64,
+        count=int(indptr[-1])
+    )
+    return indices, indptr
+
+
+class SimilarityIndex:
+    def __init__(self, path, writable=False):
+        mode = 'r+' if writable else 'r'
+        for name in ARRAYS:
+            setattr(self, name, np.load(path / f'{name}.npy', mmap_mode=mode))
+
+    @property
+    def count(self):
+        return int(self.state[0])
+
+    @property
+    def sorted_count(self):
+        return self.bucket_keys.shape[1]
+
+    def _row(self, recipe_id):
+        # Строка в хвосте новее строки того же рецепта в начале индекса
+        sorted_count = self.sorted_count
+        rows = np.flatnonzero(self.ids[sorted_count:self.count] == recipe_id)
+        if rows.size:
+            return sorted_count + int(rows[0])
+        row = int(np.searchsorted(self.ids[:sorted_count], recipe_id))
+        if row < sorted_count and self.ids[row] == recipe_id:
+            return row
+        return None
+
+    def _candidates(self, row):
+        query = self.bands[row]
+        sorted_count = self.sorted_count
+        tail = np.flatnonzero(
+            (self.bands[sorted_count:self.count] == query).any(axis=1)
+        )
+        parts = [tail + sorted_count]
+        for band in range(NUM_BANDS):
+            keys = self.bucket_keys[band]
+            start = np.searchsorted(keys, query[band], side='left')
+            end = np.searchsorted(keys, query[band], side='right')
+            parts.append(self.bucket_rows[band, start:end])
+        candidates = np.unique(np.concatenate(parts))
+        return candidates[
+            (candidates != row) & (self.live[candidates] == 1)
+        ]
+
+    def similar(self, recipe_id, limit):
+        """Id похожих рецептов по убыванию коэффициента Жаккара."""
+        row = self._row(recipe_id)
+        if row is None or not self.live[row]:
+            return []
+        candidates = self._candidates(row)
+        if not candidates.size:
+            return []
+
+        query = self.bits[row]
+        bits = self.bits[candidates]
+        intersection = popcount(bits & query).sum(axis=1)
+        union = popcount(bits | query).sum(axis=1)
+        scores = intersection / np.maximum(union, 1)
+        order = np.argsort(-scores, kind='stable')[:limit]
+        return [
+            int(self.ids[candidates[position]])
+            for position in order if scores[position] > 0
+        ]
+
+    def put(self, recipe_id, ingredient_ids):
+        """Записывает строку рецепта; False, если нужна пересборка."""
+        row = self._row(recipe_id)
+        old_row = None
+        if row is not None and row < self.sorted_count:
+            # Корзины собранных строк не меняются, поэтому новая версия
+            # рецепта занимает строку в хвосте
+            old_row, row = row, None
+        if row is None:
+            row = self.count
+        width = self.bits.shape[1]
+        if row >= len(self.ids) or max(ingredient_ids) >= width * 64:
+            return False
+
+        indices, indptr = to_csr([ingredient_ids])
+        signature = minhash(indices, indptr)
+        self.bits[row] = pack_bits(indices, indptr, width)[0]
+        self.signatures[row] = signature[0]
+        self.bands[row] = band_keys(signature)[0]
+        self.ids[row] = recipe_id
+        self.live[row] = 1
+        if old_row is not None:
+            self.live[old_row] = 0
+        if row == self.count:
+            self.state[0] = row + 1
+        self.flush()
+        return True
+
+    def remove(self, recipe_id):
+        row = self._row(recipe_id)
+        if row is not None:
+            self.live[row] = 0
+            self.flush()
+
+    def flush(self):
+        for name in ARRAYS:
+            getattr(self, name).flush()
+
+
+def _directory():
+    return Path(settings.SIMILARITY_DIR)
+
+
+def _current_generation():
+    try:
+        return (_directory() / 'CURRENT').read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def _write_lock():
+    _directory().mkdir(parents=True, exist_ok=True)
+    with open(_directory() / '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_ingredients(recipe_ids=None):
+    # Скрытые рецепты ждут удаления и в индекс не попадают
+    links = RecipeIngredient.objects.filter(
+        recipe__deleted_at__isnull=True
+    ).order_by('recipe_id')
+    if recipe_ids is not None:
+        links = links.filter(recipe_id__in=recipe_ids)
+    recipes = {}
+    for recipe_id, ingredient_id in links.values_list(
+        'recipe_id', 'ingredient_id'
+    ).iterator(chunk_size=5000):
+        recipes.setdefault(recipe_id, []).append(ingredient_id)
+    return recipes
+
+
+def _build():
+    recipes = _load_ingredients()
+    max_ingredient_id = Ingredient.objects.aggregate(
+        max_id=Max('id')
+    )['max_id'] or 0
+    # Запас по ширине, чтобы новые ингредиенты не требовали пересборки
+    width = (max_ingredient_id + max_ingredient_id // 4 + 64) // 64 + 1
+    # Хвост для рецептов, сохранённых после сборки; переполненный хвост
+    # пересобирается, так что он не бывает длиннее восьмой части индекса
+    count = len(recipes)
+    capacity = count + max(MIN_CAPACITY, count // 8)
+
+    generation = uuid.uuid4().hex
+    path = _directory() / generation
+    path.mkdir(parents=True)
+    arrays = {
+        'ids': ((capacity,), np.int64),
+        'live': ((capacity,), np.uint8),
+        'bits': ((capacity, width), np.uint64),
+        'signatures': ((capacity, NUM_HASHES), np.uint32),
+        'bands': ((capacity, NUM_BANDS), np.uint64),
+        'state': ((1,), np.int64),
+    }
+    for name, (shape, dtype) in arrays.items():
+        np.lib.format.open_memmap(
+            path / f'{name}.npy', mode='w+', dtype=dtype, shape=shape
+        ).flush()
+
+    bands = np.zeros((0, NUM_BANDS), dtype=np.uint64)
+    if recipes:
+        indices, indptr = to_csr(list(recipes.values()))
+        signatures = minhash(indices, indptr)
+        bands = band_keys(signatures)
+    bucket_rows = np.argsort(bands, axis=0, kind='stable')
+    np.save(
+        path / 'bucket_keys.npy',
+        np.take_along_axis(bands, bucket_rows, axis=0).T
+    )
+    np.save(path / 'bucket_rows.npy', bucket_rows.T.astype(np.int64))
+
+    index = SimilarityIndex(path, writable=True)
+    if recipes:
+        # Рецепты загружены по возрастанию id
+        index.ids[:count] = list(recipes)
+        index.live[:count] = 1
+        index.bits[:count] = pack_bits(indices, indptr, width)
+        index.signatures[:count] = signatures
+        index.bands[:count] = bands
+        index.state[0] = count
+    index.flush()
+
+    old_generation = _current_generation()
+    pointer = _directory() / 'CURRENT.tmp'
+    pointer.write_text(generation)
+    os.replace(pointer, _directory() / 'CURRENT')
+    # Воркеры, отобразившие старые файлы, дочитают их и после удаления
+    if old_generation:
+        shutil.rmtree(_directory() / old_generation, ignore_errors=True)
+    return len(recipes)
+
+
+def rebuild():
+    with _write_lock():
+        return _build()
+
+
+@task(priority=-1)
+def rebuild_index(generation):
+    """Пересобирает индекс, если поколение generation ещё текущее.
+
+    Несколько процессов могут запросить пересборку одного поколения,
+    собирает его только первая задача.
+    """
+    with _write_lock():
+        if _current_generation() == generation:
+            _build()
+
+
+def request_rebuild(generation):
+    if generation not in _requested:
+        _requested.add(generation)
+        rebuild_index.delay(generation)
+
+
+def update_recipe(recipe_id):
+    """Обновляет строку рецепта после сохранения."""
+    ingredient_ids = _load_ingredients([recipe_id]).get(recipe_id)
+    with _write_lock():
+        generation = _current_generation()
+        if generation is None:
+            return
+        try:
+            index = SimilarityIndex(_directory() / generation, writable=True)
+        except FileNotFoundError:
+            # Поколение старого формата
+            request_rebuild(generation)
+            return
+        if not ingredient_ids:
+            index.remove(recipe_id)
+        elif not index.put(recipe_id, ingredient_ids):
+            request_rebuild(generation)
+
+
+def get_index():
+    """Текущий индекс или None, пока он строится."""
+    generation = _current_generation()
+    if generation is None:
+        request_rebuild(None)
+        return None
+    if _cache['generation'] != generation:
+        try:
+            index = SimilarityIndex(_directory() / generation)
+        except FileNotFoundError:
+            if _current_generation() != generation:
+                # Поколение успели заменить между чтением CURRENT
+                # и загрузкой
+                return get_index()
+            request_rebuild(generation)
+            return None
+        _cache['generation'] = generation
+        _cache['index'] = index
+    return _cache['index']
+
+
+def get_similar_ids(recipe_id, limit):
+    """Id похожих рецептов или None, если индекс ещё не построен."""
+    index = get_index()
+    if index is None:
+        return None
+    return index.similar(recipe_id, limit)
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import tempfile
+from pathlib import PurePosixPath
+
+from django.core.files.storage import FileSystemStorage
+
+BLOBS_DIR = 'blobs'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранит файлы под именем, равным SHA-256 содержимого.
+
+    Одинаковые изображения записываются один раз и раскладываются по
+    каталогам blobs/ab/cd/. Файл может использоваться несколькими
+    объектами, поэтому delete() его не удаляет: осиротевшие файлы
+    удаляет команда gc_media. Содержимое по адресу никогда не меняется,
+    и nginx отдаёт blobs/ с неограниченным временем кеширования.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content_hash = digest.hexdigest()
+        extension = PurePosixPath(name).suffix.lower()
+        name = (
+            f'{BLOBS_DIR}/{content_hash[:2]}/{content_hash[2:4]}/'
+            f'{content_hash}{extension}'
+        )
+        full_path = self.path(name)
+        try:
+            # Файл уже есть: свежее время изменения не даст gc_media
+            # удалить его, пока объект со ссылкой ещё не сохранён
+            os.utime(full_path)
+            return name
+        except FileNotFoundError:
+            pass
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        # Запись во временный файл и переименование атомарны: параллельная
+        # загрузка того же изображения запишет тот же самый файл
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                content.seek(0)
+                for chunk in content.chunks():
+                    tmp_file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return name
+
+    def delete(self, name):
+        pass
+
+    def delete_blob(self, name):
+        super().delete(name)
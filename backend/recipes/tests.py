@@ -0,0 +1,974 @@
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api import throttling
+from api.throttling import UNTRACKED, BucketTable
+from recipes import deletion, similarity
+from recipes.models import (
+    Deletion, Favorite, Ingredient, Recipe, RecipeIngredient, RecipeTrending,
+    ShoppingCart, Subscription, User
+)
+
+TEST_MEDIA_ROOT = tempfile.mkdtemp()
+IMAGE = (
+    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABAgMAAABieywaAAAA'
+    'CVBMVEUAAAD///9fX1/S0ecCAAAACXBIWXMAAA7EAAAOxAGVKw4bAAAACklEQVQImWNoAAAA'
+    'ggCByxOyYQAAAABJRU5ErkJggg=='
+)
+
+
+def tearDownModule():
+    shutil.rmtree(TEST_MEDIA_ROOT, ignore_errors=True)
+
+
+def create_user(name):
+    return User.objects.create_user(
+        email=f'{name}@example.com', username=name,
+        first_name=name, last_name=name, password='pass12345!'
+    )
+
+
+def create_recipe(author, amounts, name='Рецепт'):
+    """Рецепт с ингредиентами {ингредиент: количество}."""
+    recipe = Recipe.objects.create(
+        author=author, name=name, text='Текст',
+        image='recipes/images/test.png', cooking_time=10
+    )
+    RecipeIngredient.objects.bulk_create([
+        RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=amount)
+        for ingredient, amount in amounts.items()
+    ])
+    return recipe
+
+
+def writes_to(context, table):
+    """Изменяющие запросы к таблице: {'INSERT': n, 'UPDATE': n, ...}."""
+    counts = {}
+    for query in context.captured_queries:
+        statement = query['sql'].split(None, 1)[0].upper()
+        if statement in ('INSERT', 'UPDATE', 'DELETE') and (
+            f'"{table}"' in query['sql'].split('WHERE')[0]
+        ):
+            counts[statement] = counts.get(statement, 0) + 1
+    return counts
+
+
+@override_settings(THROTTLE_ENABLED=False, MEDIA_ROOT=TEST_MEDIA_ROOT)
+class ApiTestCase(TestCase):
+    """Запросы к API без ограничения частоты, файлы — во временном каталоге."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author')
+        cls.ingredients = Ingredient.objects.bulk_create([
+            Ingredient(name=f'Ингредиент {number}', measurement_unit='г')
+            for number in range(40)
+        ])
+
+    def client_for(self, user=None):
+        client = APIClient()
+        if user is not None:
+            client.force_authenticate(user)
+        return client
+
+
+class RecipeIngredientsUpdateTestCase(ApiTestCase):
+    """Изменение рецепта трогает только изменившиеся ингредиенты."""
+
+    def setUp(self):
+        first, second, third, self.fourth = self.ingredients[:4]
+        self.recipe = create_recipe(
+            self.author, {first: 1, second: 2, third: 3}
+        )
+        self.links = {
+            link.ingredient_id: link.id
+            for link in self.recipe.recipe_ingredients.all()
+        }
+        self.client = self.client_for(self.author)
+
+    def patch(self, data):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                f'/api/recipes/{self.recipe.id}/', data, format='json'
+            )
+        self.assertEqual(response.status_code, 200, response.data)
+        return writes_to(context, 'recipes_recipeingredient')
+
+    def current_links(self):
+        return dict(self.recipe.recipe_ingredients.values_list(
+            'ingredient_id', 'amount'
+        ))
+
+    def test_patch_without_ingredients_keeps_rows(self):
+        writes = self.patch({'name': 'Новое название'})
+        self.assertEqual(writes, {})
+        self.assertEqual(
+            dict(self.recipe.recipe_ingredients.values_list(
+                'ingredient_id', 'id'
+            )),
+            self.links
+        )
+
+    def test_unchanged_ingredients_are_not_written(self):
+        first, second, third = self.ingredients[:3]
+        writes = self.patch({'ingredients': [
+            {'id': first.id, 'amount': 1},
+            {'id': second.id, 'amount': 2},
+            {'id': third.id, 'amount': 3},
+        ]})
+        self.assertEqual(writes, {})
+
+    def test_only_changed_rows_are_written(self):
+        first, second, third = self.ingredients[:3]
+        writes = self.patch({'ingredients': [
+            {'id': first.id, 'amount': 1},
+            {'id': second.id, 'amount': 5},
+            {'id': self.fourth.id, 'amount': 4},
+        ]})
+        self.assertEqual(writes, {'DELETE': 1, 'INSERT': 1, 'UPDATE': 1})
+        self.assertEqual(self.current_links(), {
+            first.id: 1, second.id: 5, self.fourth.id: 4
+        })
+        # Оставшиеся строки обновлены на месте, а не пересозданы
+        self.assertEqual(
+            self.recipe.recipe_ingredients.get(ingredient=second).id,
+            self.links[second.id]
+        )
+
+
+class QueryPlanTestCase(ApiTestCase):
+    """Частые запросы должны использовать индексы.
+
+    На нескольких строках планировщик всегда выбирает полный просмотр
+    таблицы, поэтому он отключается: если подходящего индекса нет,
+    в плане всё равно останется Seq Scan.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.reader = create_user('reader')
+        Ingredient.objects.bulk_create([
+            Ingredient(name=name, measurement_unit='г')
+            for name in ('Мука', 'Молоко', 'Сахар')
+        ])
+        cls.recipe, *_ = [
+            create_recipe(cls.author, {}, f'Рецепт {number}')
+            for number in range(3)
+        ]
+        Favorite.objects.create(user=cls.reader, recipe=cls.recipe)
+        ShoppingCart.objects.create(user=cls.reader, recipe=cls.recipe)
+        Subscription.objects.create(user=cls.reader, author=cls.author)
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def explain(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def scanned_indexes(self, plan, table):
+        nodes = [plan]
+        indexes = []
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('Plans', ()))
+            if node.get('Relation Name') == table:
+                self.assertNotEqual(
+                    node['Node Type'], 'Seq Scan', f'Seq Scan по {table}'
+                )
+            if 'Index Name' in node:
+                indexes.append(node['Index Name'])
+        return indexes
+
+    def assertQuerysetUsesIndex(self, queryset, index):
+        sql, params = queryset.query.sql_with_params()
+        plan = self.explain(sql, params)
+        self.assertIn(
+            index, self.scanned_indexes(plan, queryset.model._meta.db_table)
+        )
+
+    def assertEndpointUsesIndex(self, url, index):
+        """Запрос страницы рецептов из ответа API использует индекс."""
+        client = self.client_for()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        page_queries = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT')
+            and 'FROM "recipes_recipe"' in query['sql']
+            and 'LIMIT' in query['sql']
+        ]
+        self.assertTrue(page_queries)
+        plan = self.explain(page_queries[0])
+        self.assertIn(index, self.scanned_indexes(plan, 'recipes_recipe'))
+
+    def test_recipe_list_uses_pub_date_index(self):
+        """Лента рецептов читается по индексу даты публикации."""
+        self.assertEndpointUsesIndex('/api/recipes/', 'recipe_pub_date_idx')
+
+    def test_recipe_list_by_author_uses_composite_index(self):
+        """Рецепты автора читаются по индексу (author, pub_date)."""
+        self.assertEndpointUsesIndex(
+            f'/api/recipes/?author={self.author.pk}',
+            'recipe_author_pub_date_idx'
+        )
+
+    def test_ingredient_prefix_search_uses_upper_index(self):
+        """Поиск ингредиента по началу названия без учёта регистра."""
+        # Без сортировки по умолчанию: иначе планировщик может выбрать
+        # полный просмотр unique_ingredient, чтобы не сортировать
+        self.assertQuerysetUsesIndex(
+            Ingredient.objects.filter(name__istartswith='мо').order_by(),
+            'ingredient_name_upper_idx'
+        )
+
+    def test_reverse_foreign_keys_use_indexes(self):
+        """Избранное, списки покупок и подписки ищутся по рецепту/автору."""
+        for queryset, column in (
+            (Favorite.objects.filter(recipe=self.recipe), 'recipe_id'),
+            (ShoppingCart.objects.filter(recipe=self.recipe), 'recipe_id'),
+            (Subscription.objects.filter(author=self.author), 'author_id'),
+        ):
+            with self.subTest(model=queryset.model.__name__):
+                sql, params = queryset.query.sql_with_params()
+                indexes = self.scanned_indexes(
+                    self.explain(sql, params), queryset.model._meta.db_table
+                )
+                self.assertTrue(any(
+                    index.startswith(
+                        f'{queryset.model._meta.db_table}_{column}'
+                    )
+                    for index in indexes
+                ), indexes)
+
+
+class RecipeCreateQueriesTestCase(ApiTestCase):
+    """Число запросов при создании рецепта не зависит от ингредиентов."""
+
+    def create(self, ingredients):
+        client = self.client_for(self.author)
+        with CaptureQueriesContext(connection) as context:
+            response = client.post('/api/recipes/', {
+                'name': f'Рецепт из {len(ingredients)}',
+                'text': 'Текст',
+                'cooking_time': 10,
+                'image': IMAGE,
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': 1}
+                    for ingredient in ingredients
+                ],
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_ingredients(self):
+        self.assertEqual(
+            self.create(self.ingredients[:1]),
+            self.create(self.ingredients[:30])
+        )
+        self.assertEqual(
+            RecipeIngredient.objects.filter(
+                recipe__name='Рецепт из 30'
+            ).count(),
+            30
+        )
+
+
+class CountersTestCase(ApiTestCase):
+    """Денормализованные счётчики меняются вместе со связями."""
+
+    def setUp(self):
+        self.reader = create_user('reader')
+        self.client = self.client_for(self.reader)
+        self.recipe = create_recipe(self.author, {self.ingredients[0]: 1})
+
+    def counters(self):
+        self.recipe.refresh_from_db()
+        self.author.refresh_from_db()
+        return {
+            'favorites': self.recipe.favorites_count,
+            'carts': self.recipe.carts_count,
+            'subscribers': self.author.subscribers_count,
+        }
+
+    def test_favorite_and_cart(self):
+        for action, counter in (
+            ('favorite', 'favorites'), ('shopping_cart', 'carts')
+        ):
+            with self.subTest(action=action):
+                url = f'/api/recipes/{self.recipe.id}/{action}/'
+                self.assertEqual(self.client.post(url).status_code, 201)
+                # Повторное добавление не меняет счётчик
+                self.assertEqual(self.client.post(url).status_code, 400)
+                self.assertEqual(self.counters()[counter], 1)
+                self.assertEqual(self.client.delete(url).status_code, 204)
+                self.assertEqual(self.counters()[counter], 0)
+
+    def test_subscribers(self):
+        url = f'/api/users/{self.author.id}/subscribe/'
+        self.assertEqual(self.client.post(url).status_code, 201)
+        self.assertEqual(self.client.post(url).status_code, 400)
+        self.assertEqual(self.counters()['subscribers'], 1)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertEqual(self.counters()['subscribers'], 0)
+
+    def test_recipes_count(self):
+        client = self.client_for(self.author)
+        response = client.post('/api/recipes/', {
+            'name': 'Новый', 'text': 'Текст', 'cooking_time': 5,
+            'image': IMAGE,
+            'ingredients': [{'id': self.ingredients[0].id, 'amount': 1}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.author.refresh_from_db()
+        # create_recipe в setUp счётчик не трогает
+        self.assertEqual(self.author.recipes_count, 1)
+        recipe = Recipe.objects.get(name='Новый')
+        self.assertEqual(
+            client.delete(f'/api/recipes/{recipe.id}/').status_code, 204
+        )
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.recipes_count, 0)
+
+    def test_recount_counters(self):
+        Favorite.objects.create(user=self.reader, recipe=self.recipe)
+        Subscription.objects.create(user=self.reader, author=self.author)
+        hidden = create_user('hidden')
+        hidden.deleted_at = hidden.date_joined
+        hidden.save()
+        Favorite.objects.create(user=hidden, recipe=self.recipe)
+        call_command('recount_counters', stdout=StringIO())
+        self.author.refresh_from_db()
+        self.assertEqual(self.counters(), {
+            'favorites': 1, 'carts': 0, 'subscribers': 1
+        })
+        self.assertEqual(self.author.recipes_count, 1)
+
+    def test_ordering(self):
+        newer = create_recipe(self.author, {self.ingredients[0]: 1})
+        Recipe.objects.filter(pk=self.recipe.pk).update(favorites_count=5)
+        for ordering, expected in (
+            ('', [newer.id, self.recipe.id]),
+            ('?ordering=popular', [self.recipe.id, newer.id]),
+        ):
+            response = self.client.get(f'/api/recipes/{ordering}')
+            self.assertEqual(
+                [recipe['id'] for recipe in response.data['results']],
+                expected
+            )
+        response = self.client.get('/api/recipes/?ordering=-popular')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('popular, cooking_time', response.data['errors'])
+
+
+class ConditionalGetTestCase(ApiTestCase):
+    """ETag ответов меняется вместе с данными, иначе ответ — 304."""
+
+    def setUp(self):
+        self.reader = create_user('reader')
+        self.recipe = create_recipe(self.author, {self.ingredients[0]: 1})
+        # С токеном пользователь читается заново в каждом запросе,
+        # и его updated_at попадает в ETag
+        token = Token.objects.create(user=self.reader)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def get(self, url, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, **headers)
+
+    def assertNotModified(self, url):
+        etag = self.get(url)['ETag']
+        # Пользователь по токену и агрегат отметок времени; страница
+        # списка и сериализация не выполняются
+        with self.assertNumQueries(2):
+            response = self.get(url, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        return etag
+
+    def assertModified(self, url, etag):
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_not_modified(self):
+        for url in ('/api/recipes/', f'/api/recipes/{self.recipe.id}/'):
+            with self.subTest(url=url):
+                self.assertNotModified(url)
+
+    def test_recipe_change(self):
+        list_etag = self.assertNotModified('/api/recipes/')
+        detail_url = f'/api/recipes/{self.recipe.id}/'
+        detail_etag = self.assertNotModified(detail_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client_for(self.author).patch(
+                detail_url, {'name': 'Новое название'}, format='json'
+            )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertModified('/api/recipes/', list_etag)
+        self.assertModified(detail_url, detail_etag)
+
+    def test_recipe_delete(self):
+        create_recipe(self.author, {self.ingredients[1]: 1}, 'Второй')
+        etag = self.assertNotModified('/api/recipes/')
+        self.recipe.delete()
+        # Максимум updated_at не изменился, изменилось количество строк
+        self.assertModified('/api/recipes/', etag)
+
+    def test_ingredient_rename(self):
+        # У ингредиентов нет updated_at, их изменения видны по версии шины
+        detail_url = f'/api/recipes/{self.recipe.id}/'
+        etag = self.assertNotModified(detail_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ingredients[0].name = 'Переименованный'
+            self.ingredients[0].save()
+        self.assertModified(detail_url, etag)
+
+    def test_user_relations(self):
+        detail_url = f'/api/recipes/{self.recipe.id}/'
+        etag = self.assertNotModified(detail_url)
+        response = self.client.post(f'{detail_url}favorite/')
+        self.assertEqual(response.status_code, 201)
+        # Поле is_favorited изменилось у этого пользователя
+        self.assertModified(detail_url, etag)
+
+
+class SparseFieldsTestCase(ApiTestCase):
+    """Параметры ?fields= и ?omit= сокращают ответ и запросы к БД."""
+
+    def setUp(self):
+        self.recipe = create_recipe(self.author, {self.ingredients[0]: 1})
+        self.client = self.client_for(self.author)
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, ' '.join(
+            query['sql'] for query in context.captured_queries
+        )
+
+    def test_fields(self):
+        response, sql = self.get('/api/recipes/?fields=id,name')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name'})
+        self.assertNotIn('recipes_recipeingredient', sql)
+        self.assertNotIn('"recipes_recipe"."text"', sql)
+        self.assertNotIn('recipes_favorite', sql)
+
+    def test_omit(self):
+        response, sql = self.get(
+            f'/api/recipes/{self.recipe.id}/?omit=ingredients,author'
+        )
+        self.assertNotIn('ingredients', response.data)
+        self.assertNotIn('author', response.data)
+        self.assertIn('is_favorited', response.data)
+        self.assertNotIn('recipes_recipeingredient', sql)
+        self.assertNotIn('recipes_subscription', sql)
+
+    def test_users(self):
+        response, sql = self.get('/api/users/?fields=id,username')
+        self.assertEqual(
+            set(response.data['results'][0]), {'id', 'username'}
+        )
+        self.assertNotIn('recipes_subscription', sql)
+
+    def test_ignored_on_write(self):
+        response = self.client.patch(
+            f'/api/recipes/{self.recipe.id}/?fields=id',
+            {'name': 'Новое название'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['name'], 'Новое название')
+        self.assertIn('text', response.data)
+
+
+class RecipesByIdsTestCase(ApiTestCase):
+    """/api/recipes/by-ids/ отвечает в порядке запроса, null — не найден."""
+
+    def setUp(self):
+        self.first, self.second, self.hidden = [
+            create_recipe(self.author, {self.ingredients[0]: 1}, name)
+            for name in ('Первый', 'Второй', 'Скрытый')
+        ]
+        Recipe.all_objects.filter(pk=self.hidden.pk).update(
+            deleted_at=self.hidden.pub_date
+        )
+        self.client = self.client_for(self.author)
+
+    def get(self, ids):
+        return self.client.get(f'/api/recipes/by-ids/?ids={ids}')
+
+    def test_order_and_nulls(self):
+        missing = self.hidden.id + 1000
+        response = self.get(
+            f'{self.second.id},{missing},{self.first.id},{self.hidden.id}'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [recipe and recipe['id'] for recipe in response.data],
+            [self.second.id, None, self.first.id, None]
+        )
+
+    def test_duplicates(self):
+        response = self.get(f'{self.first.id},{self.first.id}')
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data],
+            [self.first.id, self.first.id]
+        )
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as single:
+            self.get(self.first.id)
+        with self.assertNumQueries(len(single)):
+            self.get(f'{self.first.id},{self.second.id}')
+
+    def test_invalid(self):
+        for ids in ('', 'a,1', ','.join(['1'] * 51)):
+            with self.subTest(ids=ids[:10]):
+                self.assertEqual(self.get(ids).status_code, 400)
+
+
+class DeletionTestCase(ApiTestCase):
+    """Удаление скрывает объект сразу, а строки удаляются порциями."""
+
+    def setUp(self):
+        self.reader = create_user('reader')
+        self.recipe = create_recipe(
+            self.author, {ingredient: 1 for ingredient in self.ingredients[:5]}
+        )
+        Favorite.objects.create(user=self.reader, recipe=self.recipe)
+        Subscription.objects.create(user=self.reader, author=self.author)
+        Recipe.objects.filter(pk=self.recipe.pk).update(favorites_count=1)
+        User.objects.filter(pk=self.author.pk).update(
+            recipes_count=1, subscribers_count=1
+        )
+
+    def test_hide_recipe(self):
+        client = self.client_for(self.author)
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.assertEqual(client.delete(url).status_code, 204)
+        self.assertEqual(client.get(url).status_code, 404)
+        self.assertEqual(client.get('/api/recipes/').data['count'], 0)
+        self.assertIsNotNone(
+            Recipe.all_objects.get(pk=self.recipe.pk).deleted_at
+        )
+        # Строки остаются до фоновой очистки
+        self.assertEqual(self.recipe.recipe_ingredients.count(), 5)
+        self.assertTrue(Deletion.objects.filter(
+            kind=Deletion.RECIPE, object_id=self.recipe.pk
+        ).exists())
+        # Повторное удаление скрытого рецепта
+        self.assertEqual(client.delete(url).status_code, 404)
+
+    def test_purge_recipe(self):
+        deletion.hide_recipe(self.recipe)
+        task = Deletion.objects.get()
+        deletion.process(task, chunk_size=2)
+        self.assertFalse(Recipe.all_objects.filter(pk=self.recipe.pk).exists())
+        self.assertFalse(RecipeIngredient.objects.exists())
+        self.assertFalse(Favorite.objects.exists())
+        self.assertFalse(Deletion.objects.exists())
+
+    def test_purge_resumes_from_step(self):
+        deletion.hide_recipe(self.recipe)
+        # Ингредиенты уже удалены прерванной очисткой
+        Deletion.objects.update(step=1)
+        call_command('purge_deleted', chunk_size=2, stdout=StringIO())
+        self.assertFalse(Recipe.all_objects.filter(pk=self.recipe.pk).exists())
+        self.assertFalse(Favorite.objects.exists())
+        self.assertFalse(Deletion.objects.exists())
+
+    def test_hide_and_purge_user(self):
+        deletion.hide_user(self.reader)
+        self.recipe.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 0)
+        self.assertEqual(self.author.subscribers_count, 0)
+        self.assertFalse(User.objects.filter(pk=self.reader.pk).exists())
+
+        deletion.hide_user(self.author)
+        self.assertFalse(Recipe.objects.exists())
+        call_command('purge_deleted', chunk_size=2, stdout=StringIO())
+        self.assertFalse(User.all_objects.filter(
+            pk__in=(self.author.pk, self.reader.pk)
+        ).exists())
+        self.assertFalse(Recipe.all_objects.exists())
+        self.assertFalse(RecipeIngredient.objects.exists())
+        self.assertFalse(Favorite.objects.exists())
+        self.assertFalse(Subscription.objects.exists())
+        self.assertFalse(Deletion.objects.exists())
+
+
+THROTTLE_RATES = {'user': '20/min', 'anon': '2/min', 'exports': '10/min'}
+
+
+@override_settings(
+    THROTTLE_ENABLED=True,
+    REST_FRAMEWORK={
+        **settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': THROTTLE_RATES
+    }
+)
+class ThrottlingTestCase(ApiTestCase):
+    """Превышение лимитов запросов — ответ 429 с Retry-After."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.table = BucketTable(os.path.join(self.directory, 'table'), 64)
+        # Таблица воркера создаётся один раз на процесс
+        patcher = mock.patch.dict(
+            throttling._tables, {os.getpid(): self.table}, clear=True
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertThrottled(self, response):
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+
+    def test_rate(self):
+        client = self.client_for()
+        for _ in range(2):
+            self.assertEqual(client.get('/api/recipes/').status_code, 200)
+        self.assertThrottled(client.get('/api/recipes/'))
+        # Корзина своя у каждого клиента
+        client = self.client_for(self.author)
+        self.assertEqual(client.get('/api/recipes/').status_code, 200)
+
+    def test_scope_cost(self):
+        # Загрузка стоит THROTTLE_COSTS['uploads'] токенов общей корзины
+        client = self.client_for(self.author)
+        for _ in range(2):
+            self.assertEqual(
+                client.post('/api/recipes/', {}, format='json').status_code,
+                400
+            )
+        self.assertThrottled(client.get('/api/recipes/'))
+
+    @override_settings(THROTTLE_COSTS={})
+    def test_concurrency(self):
+        # Отказ по числу мест тоже тратит токены, поэтому выгрузка здесь
+        # стоит один токен, а не всю корзину
+        ShoppingCart.objects.create(
+            user=self.author,
+            recipe=create_recipe(self.author, {self.ingredients[0]: 1})
+        )
+        client = self.client_for(self.author)
+        url = '/api/recipes/download_shopping_cart/'
+        key = f'running:exports:{self.author.pk}'
+        self.assertTrue(self.table.acquire(key, 1, 300))
+        self.assertThrottled(client.get(url))
+        self.table.release(key)
+        self.assertEqual(client.get(url).status_code, 200)
+        # Место освободилось и после ответа
+        self.assertTrue(self.table.acquire(key, 1, 300))
+
+    def test_all_or_nothing(self):
+        buckets = [('first', 1, 1, 1), ('second', 2, 1, 1)]
+        self.assertEqual(self.table.take(buckets, now=100), 0)
+        self.assertEqual(self.table.take(buckets, now=100), 1)
+        # Отказ не списал токен из второй корзины
+        self.assertEqual(self.table.take([buckets[1]], now=100), 0)
+        self.assertEqual(self.table.take(buckets, now=101), 0)
+
+    def test_table_full(self):
+        table = BucketTable(os.path.join(self.directory, 'small'), 1)
+        self.assertEqual(table.take([('first', 2, 1, 1)], now=100), 0)
+        # Единственный слот занят неполной корзиной
+        self.assertIs(table.take([('second', 2, 1, 1)], now=100), UNTRACKED)
+        # Корзина пополнилась, и слот можно вытеснить
+        self.assertEqual(table.take([('second', 2, 1, 1)], now=101), 0)
+
+
+@override_settings(TRENDING_COMMIT_LAG_SECONDS=0)
+class TrendingTestCase(ApiTestCase):
+    """update_trending учитывает каждое событие один раз."""
+
+    def setUp(self):
+        self.first, self.second, self.hidden = [
+            create_recipe(self.author, {self.ingredients[0]: 1}, name)
+            for name in ('Первый', 'Второй', 'Скрытый')
+        ]
+        for name in ('first', 'second'):
+            Favorite.objects.create(user=create_user(name), recipe=self.second)
+        Favorite.objects.create(user=self.author, recipe=self.hidden)
+        Recipe.objects.filter(pk=self.hidden.pk).update(
+            deleted_at=self.hidden.pub_date
+        )
+        self.client = self.client_for()
+
+    def update(self):
+        call_command('update_trending', stdout=StringIO())
+        return dict(RecipeTrending.objects.values_list('recipe_id', 'score'))
+
+    def test_ranking(self):
+        scores = self.update()
+        # Публикация — 2 очка, добавление в избранное — 1
+        self.assertAlmostEqual(scores[self.second.id], 4, places=3)
+        self.assertAlmostEqual(scores[self.first.id], 2, places=3)
+        self.assertNotIn(self.hidden.id, scores)
+        response = self.client.get('/api/recipes/trending/')
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [self.second.id, self.first.id]
+        )
+        self.assertIn('max-age=300', response['Cache-Control'])
+
+    def test_events_are_counted_once(self):
+        first = self.update()
+        second = self.update()
+        # Повторный запуск только немного состаривает очки
+        self.assertLessEqual(second[self.second.id], first[self.second.id])
+        self.assertAlmostEqual(
+            second[self.second.id], first[self.second.id], places=3
+        )
+
+    def test_commit_lag(self):
+        # События моложе отставания ждут следующего запуска, а не теряются
+        with override_settings(TRENDING_COMMIT_LAG_SECONDS=300):
+            self.assertEqual(self.update(), {})
+        self.assertAlmostEqual(self.update()[self.second.id], 4, places=3)
+
+
+class SimilarRecipesTestCase(ApiTestCase):
+    """Индекс похожих рецептов: сборка, запрос и обновление после коммита."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        overrides = override_settings(
+            SIMILARITY_DIR=os.path.join(directory, 'similarity'),
+            PANTRY_DIR=os.path.join(directory, 'pantry')
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        for patcher in (
+            mock.patch.dict(similarity._cache, generation=None, index=None),
+            mock.patch.object(similarity, '_requested', set()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        ingredients = self.ingredients
+        self.base = self.create(ingredients[:10])
+        # Коэффициенты Жаккара с base: 9/11 и 7/13
+        self.close = self.create(ingredients[:9] + ingredients[10:11])
+        self.half = self.create(ingredients[:7] + ingredients[11:14])
+        self.other = self.create(ingredients[20:30])
+        self.client = self.client_for(self.author)
+
+    def create(self, ingredients, name='Рецепт'):
+        return create_recipe(
+            self.author, {ingredient: 1 for ingredient in ingredients}, name
+        )
+
+    def similar(self, recipe):
+        response = self.client.get(f'/api/recipes/{recipe.id}/similar/')
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data]
+
+    def test_rebuild_and_query(self):
+        response = self.client.get(f'/api/recipes/{self.base.id}/similar/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(similarity.rebuild(), 4)
+        self.assertEqual(
+            self.similar(self.base), [self.close.id, self.half.id]
+        )
+        self.assertEqual(self.similar(self.other), [])
+
+    def test_update_after_commit(self):
+        similarity.rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/recipes/', {
+                'name': 'Копия', 'text': 'Текст', 'cooking_time': 5,
+                'image': IMAGE,
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': 1}
+                    for ingredient in self.ingredients[:10]
+                ],
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        copy = Recipe.objects.get(name='Копия')
+        self.assertEqual(
+            self.similar(self.base), [copy.id, self.close.id, self.half.id]
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/recipes/{self.other.id}/', {
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': 1}
+                    for ingredient in self.ingredients[:10]
+                ],
+            }, format='json')
+            self.client.delete(f'/api/recipes/{copy.id}/')
+        self.assertEqual(
+            self.similar(self.base),
+            [self.other.id, self.close.id, self.half.id]
+        )
+
+    def test_popcount_fallback(self):
+        values = np.array([[0, 1, 3], [2 ** 64 - 1, 5, 8]], dtype=np.uint64)
+        expected = [[0, 1, 2], [64, 2, 1]]
+        self.assertEqual(similarity._popcount_bytes(values).tolist(), expected)
+        self.assertEqual(similarity.popcount(values).tolist(), expected)
+
+
+class ImportRecipesTestCase(ApiTestCase):
+    """import_recipes не дублирует рецепты и не падает на занятых никнеймах."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        overrides = override_settings(
+            SIMILARITY_DIR=os.path.join(directory, 'similarity'),
+            PANTRY_DIR=os.path.join(directory, 'pantry')
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.path = os.path.join(directory, 'recipes.ndjson')
+        authors = [
+            {'email': self.author.email, 'username': 'author'},
+            # Никнейм занят пользователем с другой почтой
+            {'email': 'new@example.com', 'username': 'author'},
+            {'email': 'other@example.com', 'username': 'author'},
+        ]
+        with open(self.path, 'w', encoding='utf-8') as output:
+            for number, author in enumerate(authors):
+                output.write(json.dumps({
+                    'author': {
+                        **author, 'first_name': 'Имя', 'last_name': 'Фамилия'
+                    },
+                    'name': f'Импорт {number}',
+                    'text': 'Текст',
+                    'image': 'recipes/images/test.png',
+                    'cooking_time': 5,
+                    'pub_date': f'2025-01-0{number + 1}T10:00:00+00:00',
+                    'ingredients': [
+                        {'name': 'Ингредиент 0', 'measurement_unit': 'г',
+                         'amount': 1},
+                        {'name': 'Новый', 'measurement_unit': 'шт',
+                         'amount': 2},
+                    ],
+                }, ensure_ascii=False) + '\n')
+
+    def run_import(self, *args):
+        call_command(
+            'import_recipes', self.path, '--batch-size=1', *args,
+            stdout=StringIO()
+        )
+        return sorted(Recipe.objects.values_list('author__username', 'name'))
+
+    def test_import(self):
+        expected = [
+            ('author', 'Импорт 0'),
+            ('author-2', 'Импорт 1'),
+            ('author-3', 'Импорт 2'),
+        ]
+        self.assertEqual(self.run_import(), expected)
+        self.assertEqual(
+            User.objects.get(username='author-2').email, 'new@example.com'
+        )
+        self.assertEqual(Ingredient.objects.filter(name='Новый').count(), 1)
+        self.assertEqual(RecipeIngredient.objects.count(), 6)
+        # Повторный импорт того же файла ничего не добавляет
+        self.assertEqual(self.run_import(), expected)
+
+    def test_resume(self):
+        with open(self.path, 'rb') as source:
+            first_line = len(source.readline())
+        self.run_import()
+        # Контрольная точка отстала от сохранённых пакетов
+        with open(f'{self.path}.checkpoint', 'w') as checkpoint:
+            checkpoint.write(str(first_line))
+        self.assertEqual(len(self.run_import()), 3)
+        self.assertFalse(os.path.exists(f'{self.path}.checkpoint'))
+
+
+class MediaStorageTestCase(ApiTestCase):
+    """Одинаковые файлы хранятся один раз, gc_media удаляет только сирот."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        overrides = override_settings(MEDIA_ROOT=directory)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.root = Path(directory)
+        self.client = self.client_for(self.author)
+
+    def blobs(self):
+        return sorted(
+            path.relative_to(self.root).as_posix()
+            for path in self.root.glob('blobs/*/*/*')
+        )
+
+    def create(self, name):
+        response = self.client.post('/api/recipes/', {
+            'name': name, 'text': 'Текст', 'cooking_time': 5,
+            'image': IMAGE,
+            'ingredients': [{'id': self.ingredients[0].id, 'amount': 1}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return Recipe.objects.get(name=name)
+
+    def gc(self, *args):
+        call_command('gc_media', *args, stdout=StringIO())
+
+    def test_identical_uploads_are_stored_once(self):
+        first, second = self.create('Первый'), self.create('Второй')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(self.blobs(), [first.image.name])
+        self.assertTrue(first.image.name.endswith('.png'))
+        name = default_storage.save('avatar.txt', ContentFile(b'avatar'))
+        self.assertEqual(
+            default_storage.save('other.txt', ContentFile(b'avatar')), name
+        )
+        self.assertEqual(len(self.blobs()), 2)
+
+    def test_gc_keeps_shared_blobs(self):
+        first, second = self.create('Первый'), self.create('Второй')
+        orphan = default_storage.save('orphan.txt', ContentFile(b'orphan'))
+        # Молодые файлы не трогаются: ссылка на них может быть не сохранена
+        self.gc()
+        self.assertEqual(len(self.blobs()), 2)
+
+        deletion.hide_recipe(first)
+        deletion.process(Deletion.objects.get())
+        self.gc('--grace-hours=0')
+        self.assertEqual(self.blobs(), [second.image.name])
+        self.assertNotIn(orphan, self.blobs())
+
+        deletion.hide_recipe(second)
+        # Скрытый рецепт ещё ссылается на файл
+        self.gc('--grace-hours=0')
+        self.assertEqual(self.blobs(), [second.image.name])
+        deletion.process(Deletion.objects.get())
+        self.gc('--grace-hours=0', '--dry-run')
+        self.assertEqual(len(self.blobs()), 1)
+        self.gc('--grace-hours=0')
+        self.assertEqual(self.blobs(), [])
@@ -0,0 +1,25 @@
+from django.contrib import admin
+from django.utils import timezone
+
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'name', 'status', 'priority', 'attempts',
+        'max_attempts', 'run_at', 'locked_by'
+    )
+    list_filter = ('status', 'name')
+    search_fields = ('name',)
+    readonly_fields = (
+        'name', 'args', 'kwargs', 'attempts', 'locked_at',
+        'locked_by', 'last_error', 'created_at'
+    )
+    actions = ('requeue',)
+
+    @admin.action(description='Повторить выбранные задачи')
+    def requeue(self, request, queryset):
+        queryset.update(
+            status=Job.QUEUED, attempts=0, run_at=timezone.now()
+        )
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from tasks.worker import POOL_PROCESS, POOL_THREAD, Worker
+
+
+class Command(BaseCommand):
+    help = (
+        'Запускает обработчики фоновых задач. Несколько экземпляров '
+        'команды могут работать одновременно, в том числе на разных машинах.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.TASKS_CONCURRENCY,
+            help='Количество задач, выполняемых одновременно'
+        )
+        parser.add_argument(
+            '--pool',
+            choices=(POOL_THREAD, POOL_PROCESS),
+            default=settings.TASKS_POOL,
+            help='Пул потоков или процессов'
+        )
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            help='Завершиться, когда очередь опустеет'
+        )
+
+    def handle(self, *args, **options):
+        worker = Worker(
+            concurrency=options['concurrency'],
+            pool=options['pool'],
+            log=self.stdout.write
+        )
+        self.stdout.write(
+            f'Обработчик {worker.worker_id}: пул {options["pool"]}, '
+            f'задач одновременно {options["concurrency"]}'
+        )
+        processed = worker.run(burst=options['burst'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано задач: {processed}'
+        ))
@@ -0,0 +1,137 @@
+"""Очередь фоновых задач в основной базе данных.
+
+Функция, помеченная декоратором @task, ставится в очередь вызовом
+func.delay(*args, **kwargs) — запись Job создаётся только после коммита
+текущей транзакции. Обработчики (run_workers) забирают задачи через
+SELECT ... FOR UPDATE SKIP LOCKED, поэтому несколько процессов не
+получат одну задачу дважды. Упавшая задача повторяется с экспоненциальной
+задержкой, пока не исчерпает max_attempts. Выполненные задачи удаляются.
+Обработчик продлевает locked_at своих задач (heartbeat); задача, которую
+не продлевали дольше TASKS_LOCK_TIMEOUT, считается брошенной упавшим
+обработчиком и возвращается в очередь, а исчерпав попытки — в FAILED.
+"""
+import random
+import traceback
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+
+def task(func=None, *, priority=0, max_attempts=None):
+    """Регистрирует функцию как задачу и добавляет ей метод delay."""
+    def decorate(func):
+        func.task_name = f'{func.__module__}.{func.__qualname__}'
+        func.delay = partial(
+            enqueue_on_commit, func,
+            priority=priority, max_attempts=max_attempts
+        )
+        return func
+
+    return decorate(func) if func is not None else decorate
+
+
+def enqueue(func, args=(), kwargs=None, priority=0, max_attempts=None,
+            delay=None):
+    return Job.objects.create(
+        name=func.task_name,
+        args=list(args),
+        kwargs=kwargs or {},
+        priority=priority,
+        max_attempts=max_attempts or settings.TASKS_MAX_ATTEMPTS,
+        run_at=timezone.now() + (delay or timedelta())
+    )
+
+
+def enqueue_on_commit(func, *args, priority=0, max_attempts=None, **kwargs):
+    # Задача не должна увидеть данные, которые ещё не закоммичены
+    # или будут откачены
+    transaction.on_commit(partial(
+        enqueue, func, args, kwargs,
+        priority=priority, max_attempts=max_attempts
+    ))
+
+
+def claim(limit, worker_id):
+    """Забирает до limit готовых задач и возвращает их id."""
+    now = timezone.now()
+    # Задачи упавшего обработчика возвращаются в очередь по таймауту;
+    # каждый такой возврат — израсходованная попытка
+    stale = Q(
+        status=Job.RUNNING,
+        locked_at__lt=now - timedelta(seconds=settings.TASKS_LOCK_TIMEOUT)
+    )
+    with transaction.atomic():
+        Job.objects.filter(
+            stale, attempts__gte=F('max_attempts')
+        ).update(
+            status=Job.FAILED,
+            last_error='Обработчик завершился, не выполнив задачу'
+        )
+        job_ids = list(
+            Job.objects.select_for_update(skip_locked=True).filter(
+                Q(status=Job.QUEUED, run_at__lte=now)
+                | (stale & Q(attempts__lt=F('max_attempts')))
+            ).order_by('-priority', 'run_at').values_list(
+                'id', flat=True
+            )[:limit]
+        )
+        if job_ids:
+            Job.objects.filter(id__in=job_ids).update(
+                status=Job.RUNNING,
+                locked_at=now,
+                locked_by=worker_id,
+                attempts=F('attempts') + 1
+            )
+    return job_ids
+
+
+def heartbeat(job_ids, worker_id):
+    """Продлевает блокировку выполняющихся задач обработчика."""
+    Job.objects.filter(
+        id__in=job_ids, status=Job.RUNNING, locked_by=worker_id
+    ).update(locked_at=timezone.now())
+
+
+def retry_delay(attempts):
+    delay = min(
+        settings.TASKS_RETRY_DELAY * 2 ** (attempts - 1),
+        settings.TASKS_MAX_RETRY_DELAY
+    )
+    # Разброс, чтобы одновременно упавшие задачи не повторялись разом
+    return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+
+def run_job(job_id):
+    close_old_connections()
+    try:
+        job = Job.objects.filter(id=job_id, status=Job.RUNNING).first()
+        if job is None:
+            return
+        try:
+            func = import_string(job.name)
+            if getattr(func, 'task_name', None) != job.name:
+                raise ValueError(f'{job.name} не является задачей')
+            func(*job.args, **job.kwargs)
+        except Exception:
+            error = traceback.format_exc()
+            if job.attempts >= job.max_attempts:
+                Job.objects.filter(id=job.id).update(
+                    status=Job.FAILED, last_error=error
+                )
+            else:
+                Job.objects.filter(id=job.id).update(
+                    status=Job.QUEUED,
+                    run_at=timezone.now() + retry_delay(job.attempts),
+                    last_error=error
+                )
+        else:
+            Job.objects.filter(id=job.id).delete()
+    finally:
+        close_old_connections()
@@ -0,0 +1,98 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .models import Job
+from .queue import claim, enqueue, heartbeat, run_job, task
+
+calls = []
+
+
+@task
+def record(value):
+    calls.append(value)
+
+
+@task(priority=5)
+def fail():
+    raise RuntimeError('Ошибка задачи')
+
+
+@override_settings(TASKS_MAX_ATTEMPTS=2, TASKS_LOCK_TIMEOUT=60)
+class QueueTestCase(TransactionTestCase):
+    """Задачи забираются один раз, повторяются и не теряются.
+
+    run_job закрывает соединение, как обработчик между задачами,
+    поэтому тесты выполняются вне общей транзакции TestCase.
+    """
+
+    def setUp(self):
+        calls.clear()
+
+    def test_delay_on_commit(self):
+        with transaction.atomic():
+            record.delay(1)
+            # До коммита задачи в очереди нет
+            self.assertFalse(Job.objects.exists())
+        self.assertEqual(Job.objects.get().args, [1])
+
+    def test_claim_and_run(self):
+        first = enqueue(record, [1])
+        later = enqueue(record, [2], delay=timedelta(hours=1))
+        urgent = enqueue(fail, priority=5)
+        self.assertEqual(claim(10, 'worker'), [urgent.id, first.id])
+        # Взятые задачи не достаются другому обработчику
+        self.assertEqual(claim(10, 'other'), [])
+        run_job(first.id)
+        self.assertEqual(calls, [1])
+        self.assertFalse(Job.objects.filter(pk=first.pk).exists())
+        self.assertEqual(Job.objects.get(pk=later.pk).status, Job.QUEUED)
+
+    def test_retry_then_fail(self):
+        job = enqueue(fail)
+        claim(1, 'worker')
+        run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('Ошибка задачи', job.last_error)
+        self.assertGreater(job.run_at, timezone.now())
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(claim(1, 'worker'), [job.id])
+        run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_stale_job_is_reclaimed(self):
+        job = enqueue(record, [1])
+        claim(1, 'dead')
+        # Живой обработчик продлевает блокировку
+        heartbeat([job.id], 'dead')
+        self.assertEqual(claim(1, 'worker'), [])
+
+        expired = timezone.now() - timedelta(seconds=61)
+        Job.objects.filter(pk=job.pk).update(locked_at=expired)
+        self.assertEqual(claim(1, 'worker'), [job.id])
+        job.refresh_from_db()
+        self.assertEqual(job.locked_by, 'worker')
+        self.assertEqual(job.attempts, 2)
+
+        # Попытки исчерпаны: задача помечается упавшей, а не теряется
+        Job.objects.filter(pk=job.pk).update(locked_at=expired)
+        self.assertEqual(claim(1, 'worker'), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+
+    def test_unknown_task(self):
+        job = Job.objects.create(
+            name='tasks.queue.claim', status=Job.RUNNING,
+            attempts=1, max_attempts=1
+        )
+        run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('не является задачей', job.last_error)
@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+
+import django
+from django.conf import settings
+
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+
+
+# Модуль импортируется в дочернем процессе до django.setup(), поэтому
+# модели и очередь импортируются внутри функций
+def _setup_process(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()
+
+
+def _run_job(job_id):
+    from .queue import run_job
+    run_job(job_id)
+
+
+def make_executor(pool, concurrency):
+    if pool == POOL_PROCESS:
+        # spawn вместо fork: дочерние процессы не наследуют соединения с БД
+        return ProcessPoolExecutor(
+            max_workers=concurrency,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_setup_process,
+            initargs=(os.environ['DJANGO_SETTINGS_MODULE'],)
+        )
+    return ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix='task'
+    )
+
+
+class Worker:
+    """Забирает задачи из очереди и выполняет их в пуле."""
+
+    def __init__(self, concurrency=4, pool=POOL_THREAD, log=None):
+        self.concurrency = concurrency
+        self.pool = pool
+        self.log = log or (lambda message: None)
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = False
+
+    def stop(self, *args):
+        self.log('Остановка: новые задачи не берутся, ждём текущие')
+        self.stopping = True
+
+    def run(self, burst=False):
+        """Цикл обработки; при burst выходит, когда очередь пуста."""
+        from .queue import claim
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        running = set()
+        self.jobs = {}
+        self.beaten_at = time.monotonic()
+        processed = 0
+        with make_executor(self.pool, self.concurrency) as executor:
+            while not self.stopping:
+                free = self.concurrency - len(running)
+                job_ids = claim(free, self.worker_id) if free else []
+                for job_id in job_ids:
+                    future = executor.submit(_run_job, job_id)
+                    self.jobs[future] = job_id
+                    running.add(future)
+                self.heartbeat()
+                if burst and not job_ids and not running:
+                    break
+                if job_ids and len(running) < self.concurrency:
+                    # Очередь не пуста, сразу добираем свободные места
+                    continue
+                if running:
+                    done, running = wait(
+                        running,
+                        timeout=settings.TASKS_POLL_INTERVAL,
+                        return_when=FIRST_COMPLETED
+                    )
+                    processed += self.collect(done)
+                else:
+                    time.sleep(settings.TASKS_POLL_INTERVAL)
+            while running:
+                done, running = wait(
+                    running, timeout=settings.TASKS_POLL_INTERVAL
+                )
+                processed += self.collect(done)
+                self.heartbeat()
+        return processed
+
+    def heartbeat(self):
+        # Долгие задачи (например, purge) не должны вернуться в очередь,
+        # пока обработчик жив
+        from .queue import heartbeat
+        now = time.monotonic()
+        if self.jobs and (
+            now - self.beaten_at >= settings.TASKS_HEARTBEAT_INTERVAL
+        ):
+            heartbeat(list(self.jobs.values()), self.worker_id)
+            self.beaten_at = now
+
+    def collect(self, futures):
+        # Ошибки самих задач run_job сохраняет в Job, сюда доходят
+        # только сбои очереди, например потеря соединения с БД
+        for future in futures:
+            self.jobs.pop(future, None)
+            if future.exception() is not None:
+                self.log(f'Сбой обработчика: {future.exception()!r}')
+        return len(futures)
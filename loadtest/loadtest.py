@@ -0,0 +1,437 @@
+"""Нагрузочный тест Foodgram: виртуальные пользователи на asyncio.
+
+Каждый пользователь регистрируется, получает токен и затем выполняет
+сценарии в заданной пропорции, переиспользуя одно keep-alive соединение.
+Отчёт в JSON (ключи отсортированы) удобно сравнивать между запусками.
+
+    python loadtest/loadtest.py --base-url http://localhost --users 20 \\
+        --duration 60 --mix browse=50,search=20,favorite=10 -o report.json
+
+Зависимостей, кроме стандартной библиотеки, нет.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import ssl
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+SCENARIOS = (
+    'browse', 'search', 'create', 'favorite', 'cart', 'download', 'subscribe'
+)
+DEFAULT_MIX = (
+    'browse=40,search=20,create=5,favorite=12,cart=10,'
+    'download=3,subscribe=10'
+)
+SEARCH_PREFIXES = (
+    'мол', 'сах', 'соль', 'мук', 'яйц', 'мас', 'лук', 'кар', 'пер', 'сыр',
+    'чес', 'том', 'рис', 'кур', 'гов', 'сли', 'ябл', 'лим', 'мед', 'орех'
+)
+# Прозрачный PNG 1x1
+IMAGE = (
+    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAA'
+    'DUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+)
+# Числовые части пути заменяются на {id}, чтобы группировать запросы
+ID_PATTERN = re.compile(r'/\d+(?=/|$)')
+
+
+class HttpError(Exception):
+    pass
+
+
+class Connection:
+    """HTTP/1.1 с keep-alive поверх asyncio streams."""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.secure = parts.scheme == 'https'
+        self.port = parts.port or (443 if self.secure else 80)
+        self.host_header = parts.netloc
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method, path, headers=None, body=None):
+        # Сервер мог закрыть простаивающее соединение: одна повторная попытка
+        for attempt in range(2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        self.host, self.port,
+                        ssl=ssl.create_default_context()
+                        if self.secure else None
+                    ),
+                    self.timeout
+                )
+            try:
+                return await asyncio.wait_for(
+                    self._exchange(method, path, headers or {}, body),
+                    self.timeout
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                if attempt:
+                    raise
+
+    async def _exchange(self, method, path, headers, body):
+        payload = b''
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers = {**headers, 'Content-Type': 'application/json'}
+        lines = [
+            f'{method} {path} HTTP/1.1',
+            f'Host: {self.host_header}',
+            f'Content-Length: {len(payload)}',
+            'Accept: application/json',
+            *(f'{name}: {value}' for name, value in headers.items()),
+        ]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + payload)
+        await self.writer.drain()
+
+        status_line = await self.reader.readuntil(b'\r\n')
+        if not status_line:
+            raise ConnectionResetError
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding') == 'chunked':
+            content = bytearray()
+            while True:
+                size_line = await self.reader.readuntil(b'\r\n')
+                size = int(size_line.split(b';')[0], 16)
+                if size == 0:
+                    # Пропускаем трейлеры до пустой строки
+                    while await self.reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                content += await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+            content = bytes(content)
+        elif 'content-length' in response_headers:
+            content = await self.reader.readexactly(
+                int(response_headers['content-length'])
+            )
+        else:
+            content = await self.reader.read()
+            await self.close()
+        if response_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, response_headers, content
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, label, seconds, ok):
+        self.latencies[label].append(seconds)
+        if not ok:
+            self.errors[label] += 1
+
+    def report(self, elapsed, config):
+        endpoints = {}
+        for label, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            count = len(latencies)
+            endpoints[label] = {
+                'requests': count,
+                'errors': self.errors[label],
+                'error_rate': round(self.errors[label] / count, 4),
+                'throughput_rps': round(count / elapsed, 2),
+                'mean_ms': round(sum(latencies) / count * 1000, 2),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'max_ms': round(latencies[-1] * 1000, 2),
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        errors = sum(self.errors.values())
+        everything = sorted(
+            value for latencies in self.latencies.values()
+            for value in latencies
+        )
+        return {
+            'config': config,
+            'duration_s': round(elapsed, 2),
+            'requests': total,
+            'errors': errors,
+            'error_rate': round(errors / total, 4) if total else 0,
+            'throughput_rps': round(total / elapsed, 2),
+            'p50_ms': percentile(everything, 50),
+            'p95_ms': percentile(everything, 95),
+            'p99_ms': percentile(everything, 99),
+            'endpoints': endpoints,
+        }
+
+
+def percentile(values, percent):
+    """Процентиль по методу ближайшего ранга, в миллисекундах."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * percent // 100))
+    return round(values[rank - 1] * 1000, 2)
+
+
+class VirtualUser:
+    def __init__(self, number, options, stats, catalog):
+        self.number = number
+        self.options = options
+        self.stats = stats
+        self.catalog = catalog
+        self.connection = Connection(options.base_url, options.timeout)
+        self.token = None
+        self.user_id = None
+        self.recipes = []
+        self.authors = set()
+        self.in_favorites = set()
+        self.in_cart = set()
+        self.following = set()
+        self.random = random.Random(f'{options.seed}-{number}')
+
+    async def call(self, method, path, body=None, expected=(200, 201, 204)):
+        headers = {}
+        if self.token:
+            headers['Authorization'] = f'Token {self.token}'
+        label = f'{method} {ID_PATTERN.sub("/{id}", path.split("?")[0])}'
+        start = time.perf_counter()
+        try:
+            status, headers, content = await self.connection.request(
+                method, path, headers, body
+            )
+        except (OSError, asyncio.TimeoutError, ValueError):
+            await self.connection.close()
+            self.stats.record(label, time.perf_counter() - start, False)
+            raise HttpError(f'{label}: соединение прервано')
+        self.stats.record(
+            label, time.perf_counter() - start, status in expected
+        )
+        if status not in expected:
+            raise HttpError(f'{label}: {status}')
+        if headers.get('content-type', '').startswith('application/json'):
+            return json.loads(content)
+        return content
+
+    async def sign_up(self):
+        name = f'load{uuid.uuid4().hex[:12]}'
+        password = f'Load-{uuid.uuid4().hex}'
+        user = await self.call('POST', '/api/users/', {
+            'email': f'{name}@example.com',
+            'username': name,
+            'first_name': 'Нагрузка',
+            'last_name': str(self.number),
+            'password': password,
+        })
+        self.user_id = user['id']
+        token = await self.call('POST', '/api/auth/token/login/', {
+            'email': f'{name}@example.com',
+            'password': password,
+        })
+        self.token = token['auth_token']
+
+    def remember(self, recipes):
+        for recipe in recipes:
+            self.recipes.append(recipe['id'])
+            author = recipe.get('author') or {}
+            if author.get('id') and author['id'] != self.user_id:
+                self.authors.add(author['id'])
+        del self.recipes[:-200]
+
+    async def browse(self):
+        page = self.random.randint(1, self.catalog['pages'])
+        data = await self.call('GET', f'/api/recipes/?page={page}')
+        self.catalog['pages'] = max(
+            1, -(-data['count'] // max(len(data['results']), 1))
+        )
+        self.remember(data['results'])
+        if data['results']:
+            recipe = self.random.choice(data['results'])
+            await self.call('GET', f'/api/recipes/{recipe["id"]}/')
+
+    async def search(self):
+        prefix = self.random.choice(SEARCH_PREFIXES)
+        found = await self.call(
+            'GET', '/api/ingredients/?' + urlencode({'name': prefix})
+        )
+        self.catalog['ingredients'].update(item['id'] for item in found)
+
+    async def create(self):
+        if not self.catalog['ingredients']:
+            await self.search()
+        if not self.catalog['ingredients']:
+            return
+        ingredients = self.random.sample(
+            sorted(self.catalog['ingredients']),
+            min(len(self.catalog['ingredients']), self.random.randint(2, 8))
+        )
+        recipe = await self.call('POST', '/api/recipes/', {
+            'name': f'Нагрузочный рецепт {uuid.uuid4().hex[:8]}',
+            'text': 'Создан нагрузочным тестом',
+            'cooking_time': self.random.randint(5, 120),
+            'image': IMAGE,
+            'ingredients': [
+                {'id': ingredient_id, 'amount': self.random.randint(1, 500)}
+                for ingredient_id in ingredients
+            ],
+        })
+        if isinstance(recipe, dict) and 'id' in recipe:
+            self.recipes.append(recipe['id'])
+
+    async def toggle(self, chosen, path, target):
+        if target in chosen:
+            await self.call('DELETE', path)
+            chosen.discard(target)
+        else:
+            await self.call('POST', path)
+            chosen.add(target)
+
+    async def favorite(self):
+        if not self.recipes:
+            return await self.browse()
+        recipe_id = self.random.choice(self.recipes)
+        await self.toggle(
+            self.in_favorites, f'/api/recipes/{recipe_id}/favorite/',
+            recipe_id
+        )
+
+    async def cart(self):
+        if not self.recipes:
+            return await self.browse()
+        recipe_id = self.random.choice(self.recipes)
+        await self.toggle(
+            self.in_cart, f'/api/recipes/{recipe_id}/shopping_cart/',
+            recipe_id
+        )
+
+    async def download(self):
+        if not self.in_cart:
+            return await self.cart()
+        await self.call('GET', '/api/recipes/download_shopping_cart/')
+
+    async def subscribe(self):
+        if not self.authors:
+            return await self.browse()
+        author_id = self.random.choice(sorted(self.authors))
+        await self.toggle(
+            self.following, f'/api/users/{author_id}/subscribe/',
+            author_id
+        )
+
+    async def run(self, deadline, scenarios, weights):
+        try:
+            await self.sign_up()
+        except HttpError:
+            await self.connection.close()
+            return
+        while time.monotonic() < deadline:
+            scenario = self.random.choices(scenarios, weights)[0]
+            try:
+                await getattr(self, scenario)()
+            except HttpError:
+                pass
+            if self.options.think_time:
+                await asyncio.sleep(
+                    self.random.uniform(0, 2 * self.options.think_time)
+                )
+        await self.connection.close()
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'Неизвестный сценарий: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def main(options):
+    stats = Stats()
+    catalog = {'pages': 1, 'ingredients': set()}
+    scenarios, weights = zip(*options.mix.items())
+    start = time.monotonic()
+    deadline = start + options.duration
+    users = []
+    for number in range(options.users):
+        users.append(asyncio.create_task(
+            VirtualUser(number, options, stats, catalog).run(
+                deadline, scenarios, weights
+            )
+        ))
+        # Плавный набор нагрузки
+        await asyncio.sleep(options.ramp_up / options.users)
+    await asyncio.gather(*users)
+    elapsed = time.monotonic() - start
+    return stats.report(elapsed, {
+        'base_url': options.base_url,
+        'users': options.users,
+        'duration_s': options.duration,
+        'mix': options.mix,
+        'think_time_s': options.think_time,
+    })
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost')
+    parser.add_argument(
+        '--users', type=int, default=10,
+        help='Количество одновременных пользователей'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=60,
+        help='Длительность теста в секундах'
+    )
+    parser.add_argument(
+        '--ramp-up', type=float, default=5,
+        help='За сколько секунд подключаются все пользователи'
+    )
+    parser.add_argument(
+        '--think-time', type=float, default=0.5,
+        help='Средняя пауза между сценариями в секундах'
+    )
+    parser.add_argument(
+        '--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+        help=f'Веса сценариев, по умолчанию {DEFAULT_MIX}'
+    )
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', default='foodgram')
+    parser.add_argument(
+        '-o', '--output',
+        help='Файл для JSON-отчёта, по умолчанию stdout'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    report = json.dumps(
+        asyncio.run(main(options)), ensure_ascii=False, indent=2,
+        sort_keys=True
+    )
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as output:
+            output.write(report + '\n')
+    else:
+        print(report)